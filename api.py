@@ -19,17 +19,118 @@ Author: Howard Man
 """
 
 
+import atexit
+import functools
+import hashlib
+import json
+import math
+import random
+import threading
+from typing import Iterator
+from urllib.parse import urlsplit
 import psycopg2
 import psycopg2.extras
 from os import environ  # Gives the program access to the environment variables
+import click
 from dotenv import load_dotenv  # Loads variables from a file into the environment
-from flask import Flask, current_app, jsonify, request
+from flask import Flask, current_app, g, jsonify, make_response, request, stream_with_context
 from psycopg2 import sql
+from psycopg2.errors import UniqueViolation
 from psycopg2.extensions import connection
 
+from bulk_stories import export_stories, import_stories, iter_json_records
+from db_pool import ConnectionPool, PoolTimeout
+from hot_ranking import HotRanking
+from news_scraper import (DEFAULT_SOURCES, HostRateLimiter, allowed_source, insert_stories,
+                          scrape_sources)
+from query_stats import InstrumentedConnection, query_stats
+from rate_limit import RateLimiter
+from response_cache import MemoryBackend, ResponseCache
+from sampling_profiler import ProfileStore, SamplingProfiler
+from story_core import (DEFAULT_PAGE_SIZE, DELETE_STORY, EDIT_COLUMNS, INSERT_STORY, INSERT_VOTE,
+                        MAX_PAGE_SIZE, SELECT_ALL_STORIES, SELECT_HOT_STORIES,
+                        SELECT_STORIES_FINGERPRINT, UPDATE_STORY, UPSERT_VOTES, VOTE_COLUMNS,
+                        build_stories_query, duplicate_url, fingerprint_etag, identify_voter,
+                        paginate, refund_vote_tokens, take_vote_tokens, too_many_votes,
+                        vote_params)
+from story_stats import (DEFAULT_PERIODS, DOMAIN_SORTS, GRANULARITIES, HOURLY_RETENTION,
+                         MAX_MOVER_HOURS, MAX_PERIODS, compact_vote_buckets, fold_domain_stats,
+                         load_domain_stats, load_top_movers, load_vote_activity, rebuild_stats)
+from streaming import encode_json_array, encode_ndjson, stream_query
+from vote_buffer import VoteBuffer
+
 
 app = Flask(__name__)
 
+# Actions accepted by POST /stories/batch, and how many one request may carry
+BATCH_OPS = {"edit", "delete", "vote"}
+MAX_BATCH_ACTIONS = 100
+# Largest id of the stories.id INT column
+MAX_STORY_ID = 2 ** 31 - 1
+
+SELECT_STORY_EXISTS = sql.SQL("""SELECT EXISTS (SELECT 1 FROM stories WHERE id = %s)""")
+# Casts many votes in one statement, like INSERT_VOTE in story_core.py
+INSERT_VOTES = UPSERT_VOTES.format(sql.SQL("%s")) + sql.SQL("""SELECT * FROM story""")
+# Multi-row statements of POST /stories/batch. Locking in id order keeps concurrent
+# batches from deadlocking, and the locked stories cannot be deleted until the batch commits
+LOCK_STORIES = sql.SQL("""SELECT id FROM stories
+                       WHERE id = ANY(%s)
+                       ORDER BY id
+                       FOR UPDATE""")
+UPDATE_STORIES = sql.SQL("""UPDATE stories
+                         SET url = edits.url,
+                         title = edits.title,
+                         updated_at = CURRENT_TIMESTAMP
+                         FROM (VALUES %s) AS edits (id, url, title)
+                         WHERE stories.id = edits.id
+                         RETURNING stories.*""")
+DELETE_STORIES = sql.SQL("""DELETE FROM stories
+                         WHERE id = ANY(%s)
+                         RETURNING id""")
+
+pool = None
+pool_lock = threading.Lock()
+vote_buffer = None
+vote_buffer_lock = threading.Lock()
+hot_ranking = HotRanking(capacity=int(environ.get("HOT_RANKING_CAPACITY", 500)),
+                         refresh_interval=float(environ.get("HOT_RANKING_REFRESH_INTERVAL", 60)))
+story_cache = ResponseCache(ttl=float(environ.get("STORIES_CACHE_TTL", 10)),
+                            max_entries=int(environ.get("STORIES_CACHE_MAX_ENTRIES", 1000)))
+query_stats.slow_query_ms = float(environ.get("SLOW_QUERY_MS", 500))
+query_stats.explain_slow_queries = environ.get("SLOW_QUERY_EXPLAIN", "1") == "1"
+# Requests are only profiled when PROFILING_ENABLED is set: on ?profile=1, or at random
+PROFILING_ENABLED = environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL = float(environ.get("PROFILE_INTERVAL", 0.005))
+profiles = ProfileStore()
+# POST /scrape only fetches pages on these hosts, each at most once per SCRAPE_MIN_INTERVAL
+SCRAPE_SOURCES = DEFAULT_SOURCES + [
+    {"url": f"https://{host.strip()}"}
+    for host in environ.get("SCRAPE_ALLOWED_HOSTS", "").split(",") if host.strip()]
+scrape_limiter = HostRateLimiter(float(environ.get("SCRAPE_MIN_INTERVAL", 1)))
+address_rate_limiter = RateLimiter(rate=float(environ.get("ADDRESS_RATE_LIMIT", 5)),
+                                   burst=int(environ.get("ADDRESS_RATE_BURST", 50)))
+voter_rate_limiter = RateLimiter(rate=float(environ.get("VOTER_RATE_LIMIT", 1)),
+                                 burst=int(environ.get("VOTER_RATE_BURST", 10)))
+story_rate_limiter = RateLimiter(rate=float(environ.get("STORY_RATE_LIMIT", 100)),
+                                 burst=int(environ.get("STORY_RATE_BURST", 200)))
+IDEMPOTENCY_TTL = float(environ.get("IDEMPOTENCY_TTL", 24 * 3600))
+
+
+def stored_response_size(stored: tuple) -> int:
+    """Estimates the bytes of a stored (fingerprint, response) pair, mostly its body"""
+    _, response = stored
+    return 256 + (0 if response is None else len(response[1]))
+
+
+# Stored responses are bounded by their bodies' bytes, as a write answered with every story
+# is as large as the table
+idempotent_responses = MemoryBackend(
+    max_entries=int(environ.get("IDEMPOTENCY_MAX_KEYS", 100000)),
+    max_bytes=int(environ.get("IDEMPOTENCY_MAX_BYTES", 64 * 1024 * 1024)),
+    sizeof=stored_response_size)
+idempotency_lock = threading.Lock()
+
 
 def get_db_connection() -> connection:
     """Creates a connection from our API to the social_news database"""
@@ -38,80 +139,204 @@ def get_db_connection() -> connection:
         host=environ["DATABASE_IP"],
         database=environ.get("DATABASE_NAME", "social_news"),
         password=environ.get("DATABASE_PASSWORD"),
-        port=environ.get("DATABASE_PORT")
+        port=environ.get("DATABASE_PORT"),
+        connection_factory=InstrumentedConnection
     )
     # "dbname=social_news user=howardman host=localhost"
 
 
-def fetch_scores(conn: connection) -> list[dict[str, any]]:
-    """
-    Fetches scores for all stories whose story_id are 
-    in the votes table
-    """
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+def get_pool() -> ConnectionPool:
+    """Returns the API's connection pool, creating it on first use"""
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ConnectionPool(
+                get_db_connection,
+                min_size=int(environ.get("DATABASE_POOL_MIN", 1)),
+                max_size=int(environ.get("DATABASE_POOL_MAX", 10)),
+                timeout=float(environ.get("DATABASE_POOL_TIMEOUT", 5))
+            )
+    return pool
+
 
-    cur.execute(sql.SQL("""SELECT stories.*, SUM(CASE direction WHEN 'up' THEN 1 ELSE -1 END)
-                        AS score
-                        FROM stories
-                        JOIN votes
-                        ON (stories.id = votes.story_id) 
-                        WHERE stories.id = votes.story_id
-                        GROUP BY stories.id"""))
+def get_conn() -> connection:
+    """Checks a connection out of the pool for the lifetime of the current request"""
+    if "db_conn" not in g:
+        g.db_conn = get_pool().getconn()
+    return g.db_conn
 
 
-def loads_stories(conn: connection, sort_by: str, order_by: str, search: str) -> list[dict[str, any]]:
+def write_buffered_votes(votes: dict[tuple[str, int], str]) -> None:
+    """Writes a batch of buffered votes using a connection from the pool"""
+    conn = get_pool().getconn()
+    try:
+        stories = create_votes_in_bulk(conn, votes)
+    finally:
+        get_pool().putconn(conn)
+
+    for story in stories:
+        hot_ranking.update(story)
+        story_cache.invalidate_story(story["id"], VOTE_COLUMNS)
+
+
+def get_vote_buffer() -> VoteBuffer:
+    """
+    Returns the API's write-behind vote buffer, creating and starting it
+    on first use, or None unless VOTE_BUFFER_ENABLED is set
     """
-    Loads the content within the stories database,
-    with an option for customising sort, order, and search
+    global vote_buffer
+    if environ.get("VOTE_BUFFER_ENABLED", "0") != "1":
+        return None
+    with vote_buffer_lock:
+        if vote_buffer is None:
+            vote_buffer = VoteBuffer(
+                write_buffered_votes,
+                max_pending=int(environ.get("VOTE_BUFFER_MAX_PENDING", 10000)),
+                flush_interval=float(environ.get("VOTE_BUFFER_FLUSH_INTERVAL", 0.5)),
+                flush_size=int(environ.get("VOTE_BUFFER_FLUSH_SIZE", 500)),
+                max_attempts=int(environ.get("VOTE_BUFFER_MAX_ATTEMPTS", 5))
+            )
+            vote_buffer.start()
+            atexit.register(vote_buffer.close)
+    return vote_buffer
+
+
+@app.before_request
+def start_request_stats() -> None:
+    """Starts timing the request's statements, and profiling it if asked to"""
+    query_stats.begin_request()
+    if PROFILING_ENABLED and (request.args.get("profile") == "1"
+                              or random.random() < PROFILE_SAMPLE_RATE):
+        g.profiler = SamplingProfiler(interval=PROFILE_INTERVAL).start()
+
+
+@app.after_request
+def finish_request_stats(response):
     """
+    Records the request's timings, reporting its database and remaining
+    time in a Server-Timing header, and stores its profile if it had one.
+    A streamed response is recorded once its body is sent, so the fetches
+    made while streaming count towards its request; it has no header
+    """
+    endpoint = request.endpoint or "unmatched"
+    if response.is_streamed:
+        response.call_on_close(lambda: query_stats.end_request(endpoint))
+        stats = None
+    else:
+        stats = query_stats.end_request(endpoint)
+    if stats is not None:
+        total_ms = stats.elapsed() * 1000
+        db_ms = stats.db_seconds * 1000
+        response.headers["Server-Timing"] = (
+            f'db;dur={db_ms:.2f};desc="{stats.round_trips} round-trips, {stats.rows} rows", '
+            f'app;dur={total_ms - db_ms:.2f}')
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        profile_id = profiles.add(f"{request.method} {request.full_path}", profiler.folded())
+        response.headers["X-Profile-Id"] = str(profile_id)
+    return response
+
+
+@app.teardown_request
+def stop_profiler(exception) -> None:
+    """Stops the profiler of a request that failed before its response was built"""
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+
+
+@app.teardown_appcontext
+def release_conn(exception) -> None:
+    """Hands the request's connection back to the pool"""
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
+
+def reconcile_scores(conn: connection) -> int:
+    """
+    Rebuilds the maintained score, upvotes and downvotes of every story
+    from the votes table in one bulk statement, returning how many
+    stories had drifted
+    """
+    cur = conn.cursor()
 
-    if search is None:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(sql.SQL("""UPDATE stories
+                        SET score = tallies.upvotes - tallies.downvotes,
+                        upvotes = tallies.upvotes,
+                        downvotes = tallies.downvotes
+                        FROM (SELECT stories.id,
+                              COUNT(votes.id) FILTER (WHERE direction = 'up') AS upvotes,
+                              COUNT(votes.id) FILTER (WHERE direction = 'down') AS downvotes
+                              FROM stories
+                              LEFT JOIN votes
+                              ON (stories.id = votes.story_id)
+                              GROUP BY stories.id) AS tallies
+                        WHERE stories.id = tallies.id
+                        AND (stories.score, stories.upvotes, stories.downvotes)
+                        IS DISTINCT FROM
+                        (tallies.upvotes - tallies.downvotes, tallies.upvotes, tallies.downvotes)"""))
+
+    updated = cur.rowcount
+    conn.commit()
+    cur.close()
+    return updated
 
-        cur.execute(sql.SQL("""SELECT * FROM stories ORDER BY {} {}""")
-                    .format(sql.Identifier(sort_by), sql.SQL(order_by)))
 
-    else:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+def loads_stories(conn: connection, sort_by: str, order_by: str, search: str,
+                  limit: int = DEFAULT_PAGE_SIZE, cursor: str = None,
+                  fields: list[str] = None) -> tuple[list[dict[str, any]], str]:
+    """
+    Loads one page of the content within the stories database,
+    with an option for customising sort, order, search and the fields
+    returned. Searches are full-text searches over titles and urls, and
+    may be sorted by relevance. Pages are keyset paginated on
+    (sort_by, id), so every page costs one index range scan. Returns the
+    page and the cursor of the next page (None on the last page)
+    """
+    query, params = build_stories_query(sort_by, order_by, search, cursor, fields, limit + 1)
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-        cur.execute(
-            sql.SQL("""SELECT * FROM stories 
-                    WHERE title ILIKE '%{}%' 
-                    ORDER BY {} {}""").format(sql.SQL(search), sql.Identifier(sort_by), sql.SQL(order_by)))
+    cur.execute(query, params)
 
     rows = cur.fetchall()
     conn.commit()
     cur.close()
-    return rows
+    return paginate(rows, sort_by, limit, fields)
+
 
+def stream_stories(conn: connection, sort_by: str, order_by: str, search: str,
+                   cursor: str = None, fields: list[str] = None,
+                   arrays: bool = False) -> Iterator[any]:
+    """
+    Streams every story matching a listing, from a starting cursor, through
+    a server-side cursor, as dicts or (with `arrays`) as a header of column
+    names and then value arrays. The arguments are checked before streaming starts
+    """
+    query, params = build_stories_query(sort_by, order_by, search, cursor, fields)
+    return stream_query(conn, query, params, name="stream_stories", arrays=arrays)
 
-def get_highest_id(conn: connection) -> int:
-    """Returns the highest id number within a list of stories"""
-    sort_by = 'id'
-    order_by = 'DESC'
 
+def load_all_stories(conn: connection) -> list[dict[str, any]]:
+    """Loads every story in the stories table, ordered by id"""
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(sql.SQL("""SELECT id FROM stories ORDER BY {} {} LIMIT 1""")
-                .format(sql.Identifier(sort_by), sql.SQL(order_by))
-                )
 
-    rows = cur.fetchone()
+    cur.execute(SELECT_ALL_STORIES)
+
+    rows = cur.fetchall()
     conn.commit()
     cur.close()
-    return rows.get("id")
+    return rows
 
 
-def post_new_story(conn: connection, url: str, title: str) -> list[dict[str, any]]:
-    """Adds new story into social_news database, returning the updated
-    social_news database"""
+def load_hot_stories(conn: connection, limit: int) -> list[dict[str, any]]:
+    """Loads the hottest stories, hottest first"""
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute(sql.SQL("""INSERT INTO stories (title, url, created_at, updated_at)
-                        VALUES (%s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"""
-                        ), (title, url)
-                )
-
-    cur.execute(sql.SQL("""SELECT * FROM stories"""))
+    cur.execute(SELECT_HOT_STORIES, (limit, ))
 
     rows = cur.fetchall()
     conn.commit()
@@ -119,47 +344,73 @@ def post_new_story(conn: connection, url: str, title: str) -> list[dict[str, any
     return rows
 
 
-def valid_input_id_test(conn: connection, id: int) -> bool:
-    """Criteria for checking whether a story id is valid"""
-    max_id = get_highest_id(conn)
-    if not isinstance(id, int):
-        return "id_not_int"
-    if id <= 0 or id > max_id:
-        return "id_not_in_range"
-    return True
+def get_stories_etag(conn: connection) -> str:
+    """
+    Fingerprints the stories table without reading its rows. Every write
+    changes the row count, the highest id or the latest updated_at
+    """
+    cur = conn.cursor()
 
+    cur.execute(SELECT_STORIES_FINGERPRINT)
 
-def patch_existing_story(conn: connection, url: str, title: str, id: int) -> list[dict[str, any]]:
-    """Edits the url and title of a row in the stories table via a PATCH request"""
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    fingerprint = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return fingerprint_etag(fingerprint)
 
-    cur.execute(sql.SQL("""UPDATE stories
-                        SET url = %s,
-                        title = %s
-                        WHERE id = %s"""), (url, title, id))
 
-    cur.execute(sql.SQL("""SELECT * FROM stories"""))
+def story_exists(conn: connection, id: int) -> bool:
+    """Checks whether a story exists with a single primary key probe"""
+    cur = conn.cursor()
 
-    rows = cur.fetchall()
+    cur.execute(SELECT_STORY_EXISTS, (id, ))
+
+    exists = cur.fetchone()[0]
     conn.commit()
     cur.close()
-    return rows
+    return exists
 
 
-def delete_existing_story(conn: connection, id: int) -> list[dict[str, any]]:
-    """Deletes an existing story in stories database"""
+def post_new_story(conn: connection, url: str, title: str) -> dict[str, any]:
+    """Adds new story into social_news database, returning the new story"""
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute(sql.SQL("""DELETE FROM stories
-                        WHERE id = %s"""), (id, )
-                )
+    cur.execute(INSERT_STORY, (title, url))
 
-    cur.execute(sql.SQL("""SELECT * FROM stories"""))
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return row
 
-    rows = cur.fetchall()
+
+def patch_existing_story(conn: connection, url: str, title: str, id: int) -> dict[str, any]:
+    """
+    Edits the url and title of a row in the stories table via a PATCH request,
+    returning the edited story (or None if there is no story with that id)
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(UPDATE_STORY, (url, title, id))
+
+    row = cur.fetchone()
     conn.commit()
     cur.close()
-    return rows
+    return row
+
+
+def delete_existing_story(conn: connection, id: int) -> dict[str, any]:
+    """
+    Deletes an existing story in stories database, returning the deleted
+    story (or None if there is no story with that id)
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(DELETE_STORY, (id, ))
+
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return row
 
 
 def find_story_by_id(conn: connection, id: int):
@@ -175,33 +426,93 @@ def find_story_by_id(conn: connection, id: int):
     return rows
 
 
-def update_story_date(conn: connection, id: int) -> list[dict[str, any]]:
+def create_new_votes_record(conn: connection, id: int, direction: str,
+                            voter_id: str) -> dict[str, any]:
     """
-    Updates the updated_at field of a story to the stories table 
-    after an upvote/downvote
+    Records a voter's vote on a story, replacing any earlier vote of theirs
+    on it, and applies the change to the story's maintained score in the
+    same statement. Returns the story, or None if there is no such story
     """
-
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute(sql.SQL("""UPDATE stories
-                        SET updated_at = CURRENT_TIMESTAMP
-                        WHERE id = %s"""), (id, ))
+    cur.execute(INSERT_VOTE, vote_params(voter_id, id, direction))
+
+    row = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return row
 
-    cur.execute(sql.SQL("""SELECT * FROM stories"""))
 
-    rows = cur.fetchall()
+def create_votes_in_bulk(conn: connection,
+                        votes: dict[tuple[str, int], str]) -> list[dict[str, any]]:
+    """
+    Writes a batch of votes, given as {(voter_id, story_id): direction},
+    in one statement with the same upsert as create_new_votes_record.
+    Votes for stories deleted since they were queued are dropped.
+    Returns the stories whose scores changed
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    rows = psycopg2.extras.execute_values(
+        cur, INSERT_VOTES,
+        [(voter_id, story_id, direction) for (voter_id, story_id), direction in votes.items()],
+        page_size=len(votes), fetch=True)
+
     conn.commit()
     cur.close()
     return rows
 
 
-def create_new_votes_record(conn: connection, id: int, direction: str) -> None:
-    """Creates a new row in the votes table"""
-
+def apply_story_batch(conn: connection, actions: list[tuple[int, dict[str, any]]],
+                      voter_id: str) -> tuple[dict[int, dict[str, any]], list[dict[str, any]]]:
+    """
+    Applies a batch of validated (position, action) pairs in one transaction:
+    one query locks the stories they name, then one multi-row statement
+    each applies the edits, the votes and the deletes. The outcome is that
+    of applying the actions in order, so actions naming a missing story, or
+    one deleted earlier in the batch, fail with 404. Returns each action's
+    result by position, and the stories left updated
+    """
     cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
-    cur.execute(sql.SQL("""INSERT INTO votes (direction, created_at, updated_at, story_id)
-                        VALUES (%s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, %s)"""), (direction, id))
+    cur.execute(LOCK_STORIES, (sorted({action["id"] for _, action in actions}), ))
+    existing = {row["id"] for row in cur.fetchall()}
+
+    results = {}
+    edits, votes, deletes = {}, {}, set()
+    for position, action in actions:
+        id = action["id"]
+        if id not in existing or id in deletes:
+            results[position] = {"id": id, "status": 404, "message": "No stories with this id"}
+            continue
+        results[position] = {"id": id, "status": 200}
+        if action["op"] == "edit":
+            edits[id] = (action["url"], action["title"])
+        elif action["op"] == "vote":
+            votes[(voter_id, id)] = action["direction"]
+        else:
+            deletes.add(id)
+
+    stories = {}
+    if edits:
+        rows = psycopg2.extras.execute_values(
+            cur, UPDATE_STORIES, [(id, url, title) for id, (url, title) in edits.items()],
+            page_size=len(edits), fetch=True)
+        stories.update((row["id"], row) for row in rows)
+    if votes:
+        rows = psycopg2.extras.execute_values(
+            cur, INSERT_VOTES,
+            [(voter_id, story_id, direction) for (voter_id, story_id), direction in votes.items()],
+            page_size=len(votes), fetch=True)
+        stories.update((row["id"], row) for row in rows)
+    if deletes:
+        cur.execute(DELETE_STORIES, (sorted(deletes), ))
+        for row in cur.fetchall():
+            stories.pop(row["id"], None)
+
+    conn.commit()
+    cur.close()
+    return results, list(stories.values())
 
 
 # ===============================================================================================================
@@ -209,6 +520,161 @@ def create_new_votes_record(conn: connection, id: int, direction: str) -> None:
 # ===============================================================================================================
 
 
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(error):
+    return jsonify({"error": True, "message": "Server is busy, please try again."}), 503
+
+
+app.register_error_handler(UniqueViolation, duplicate_url)
+
+
+def get_voter_id() -> str:
+    """Identifies the voter of the current request; see identify_voter in story_core.py"""
+    return identify_voter(request.remote_addr, request.headers.get("X-Voter-Id"))
+
+
+def vote_limits(voter_id: str, story_id: int) -> list[tuple[RateLimiter, any]]:
+    """Lists the buckets a vote takes a token from: its client address, voter and story"""
+    return [(address_rate_limiter, request.remote_addr or "unknown"),
+            (voter_rate_limiter, voter_id), (story_rate_limiter, story_id)]
+
+
+def vote_wait(voter_id: str, story_id: int) -> float:
+    """
+    Takes a vote's tokens from the client address, voter and story
+    buckets. Returns 0, or the seconds to wait when one of them is empty,
+    in which case the tokens already taken are given back. The address
+    bucket caps clients that rotate their X-Voter-Id
+    """
+    return take_vote_tokens(vote_limits(voter_id, story_id))
+
+
+def refund_vote(voter_id: str, story_id: int) -> None:
+    """Gives back the tokens vote_wait took, for a vote that was not cast"""
+    refund_vote_tokens(vote_limits(voter_id, story_id))
+
+
+def idempotent(view):
+    """
+    Makes a write route safe to retry: a request carrying an Idempotency-Key
+    that was already answered gets the stored response again instead of
+    being applied twice. Keys are per route and client, and are kept for
+    IDEMPOTENCY_TTL seconds. Busy (429) and server error responses are not
+    stored, so retrying those does apply the request. Neither are responses
+    larger than IDEMPOTENCY_MAX_BYTES; send ?return=row with the key
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None or request.method == "GET":
+            return view(*args, **kwargs)
+
+        try:
+            client = get_voter_id()
+        except ValueError as error:
+            return jsonify({"error": True, "message": str(error)}), 400
+        store_key = (request.endpoint, client, key)
+        fingerprint = hashlib.md5(request.full_path.encode() + request.get_data()).hexdigest()
+
+        with idempotency_lock:
+            stored = idempotent_responses.get(store_key)
+            if stored is None:
+                idempotent_responses.set(store_key, (fingerprint, None), IDEMPOTENCY_TTL)
+
+        if stored is not None:
+            stored_fingerprint, response = stored
+            if stored_fingerprint != fingerprint:
+                return jsonify({"error": True, "message":
+                                "'Idempotency-Key' was already used for a different request"}), 422
+            if response is None:
+                return jsonify({"error": True, "message":
+                                "A request with this 'Idempotency-Key' is in progress"}), 409
+            status, body, headers = response
+            replayed = app.response_class(body, status, headers)
+            replayed.headers["Idempotent-Replayed"] = "true"
+            return replayed
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            idempotent_responses.delete(store_key)
+            raise
+
+        if response.status_code == 429 or response.status_code >= 500:
+            idempotent_responses.delete(store_key)
+        else:
+            headers = {name: value for name, value in response.headers.items()
+                       if name in {"Content-Type", "ETag"}}
+            idempotent_responses.set(store_key, (fingerprint, (response.status_code,
+                                                               response.get_data(), headers)),
+                                     IDEMPOTENCY_TTL)
+        return response
+    return wrapper
+
+
+def parse_batch_action(action: any) -> dict[str, any]:
+    """Checks one action of a batch, raising ValueError when it is malformed"""
+    if not isinstance(action, dict) or action.get("op") not in BATCH_OPS:
+        raise ValueError(f"'op' only takes {', '.join(sorted(BATCH_OPS))} as values")
+    if (not isinstance(action.get("id"), int) or isinstance(action["id"], bool)
+            or not 1 <= action["id"] <= MAX_STORY_ID):
+        raise ValueError(f"'id' must be an integer between 1 and {MAX_STORY_ID}")
+    if action["op"] == "edit" and not (isinstance(action.get("title"), str)
+                                       and isinstance(action.get("url"), str)):
+        raise ValueError("'title' and 'url' of new story need to be specified")
+    if action["op"] == "vote" and action.get("direction") not in {"up", "down"}:
+        raise ValueError("'direction' only takes 'up', 'down' as values")
+    return action
+
+
+def write_response(conn: connection, story: dict[str, any], status: int):
+    """
+    Builds the response to a story write. With ?return=row only the
+    affected story is sent back; otherwise the full list of stories is
+    sent, unless the client's If-None-Match already holds its ETag
+    """
+    if story is None:
+        return jsonify({"error": True, "message": "No stories with this id"}), 404
+
+    if request.args.get("return", default="all") == "row":
+        return story, status
+
+    etag = get_stories_etag(conn)
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(jsonify(load_all_stories(conn)), status)
+    response.set_etag(etag)
+    return response
+
+
+def stream_stories_response(stream: str, sort_by: str, order_by: str, search: str,
+                            cursor: str, fields: list[str], rows: str = "objects"):
+    """
+    Streams a whole story listing, unpaginated and uncached, as NDJSON
+    (?stream=ndjson) or as a chunked JSON array (?stream=json). Stories
+    are objects, or with ?rows=arrays arrays of values after one array of
+    column names, which is faster to produce and smaller
+    """
+    encoders = {"ndjson": (encode_ndjson, "application/x-ndjson"),
+                "json": (encode_json_array, "application/json")}
+    if stream not in encoders:
+        return jsonify({"error": True,
+                        "message": "'stream' only takes 'ndjson', 'json' as values"}), 400
+    if rows not in {"objects", "arrays"}:
+        return jsonify({"error": True,
+                        "message": "'rows' only takes 'objects', 'arrays' as values"}), 400
+
+    try:
+        stories = stream_stories(get_conn(), sort_by, order_by, search, cursor, fields,
+                                 rows == "arrays")
+    except ValueError as error:
+        return jsonify({"error": True, "message": str(error)}), 400
+
+    encode, mimetype = encoders[stream]
+    return app.response_class(stream_with_context(encode(stories)), mimetype=mimetype)
+
+
 @app.route("/", methods=["GET"])
 def index():
     return current_app.send_static_file("index.html")
@@ -220,31 +686,183 @@ def addstory():
     return current_app.send_static_file("./addstory/index.html")
 
 
-@app.route("/scrape", methods=["GET"])
+@app.route("/scrape", methods=["GET", "POST"])
 def scrape():
-    return current_app.send_static_file("./scrape/index.html")
+    """
+    GET: Serves the scrape page
+    POST: Scrapes headlines from a page of one of SCRAPE_SOURCES into the
+    stories table, returning the stories that were new
+    """
+    if request.method == "GET":
+        return current_app.send_static_file("./scrape/index.html")
+
+    url = request.json.get("url")
+    source = allowed_source(url, SCRAPE_SOURCES) if isinstance(url, str) else None
+    if source is None:
+        hosts = ", ".join(urlsplit(allowed["url"]).hostname for allowed in SCRAPE_SOURCES)
+        return jsonify({"error": True,
+                        "message": f"'url' must be an http(s) page on one of: {hosts}"}), 400
+
+    stories = insert_stories(get_conn(), scrape_sources([source], limiter=scrape_limiter))
+    if stories:
+        for story in stories:
+            hot_ranking.update(story)
+        story_cache.invalidate_all()
+
+    return jsonify(stories), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    Reports connection pool, story cache and vote buffer usage, statement
+    and per-endpoint timing histograms, and the stored request profiles
+    """
+    report = {"pool": get_pool().stats(), "story_cache": story_cache.stats(),
+              "queries": query_stats.snapshot(),
+              "rate_limits": {"address": address_rate_limiter.stats(),
+                              "voter": voter_rate_limiter.stats(),
+                              "story": story_rate_limiter.stats()}}
+    buffer = get_vote_buffer()
+    if buffer is not None:
+        report["vote_buffer"] = buffer.stats()
+    if PROFILING_ENABLED:
+        report["profiles"] = profiles.list()
+    return jsonify(report), 200
+
+
+@app.route("/metrics/profiles/<int:id>", methods=["GET"])
+def get_profile(id: int):
+    """Serves a stored request profile as folded stacks, for flamegraph tools"""
+    profile = profiles.get(id)
+    if profile is None:
+        return jsonify({"error": True, "message": "No profile with this id"}), 404
+    return app.response_class(profile[1], mimetype="text/plain")
+
+
+@app.route("/stats/domains", methods=["GET"])
+def get_domain_stats():
+    """
+    Retrieves the domains with the most stories (?sort_by=stories) or score
+    (?sort_by=score)
+    """
+    sort_by = request.args.get("sort_by", default="stories")
+    limit = request.args.get("limit", default=DEFAULT_PAGE_SIZE, type=int)
+
+    if sort_by not in DOMAIN_SORTS:
+        return jsonify({"error": True,
+                        "message": f"'sort_by' only takes {', '.join(sorted(DOMAIN_SORTS))}"}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": True,
+                        "message": f"'limit' must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+    return jsonify(load_domain_stats(get_conn(), sort_by, limit)), 200
+
+
+@app.route("/stats/votes", methods=["GET"])
+def get_vote_stats():
+    """
+    Retrieves the up and down votes of each of the last ?periods hours
+    (?granularity=hour) or days (?granularity=day), oldest first
+    """
+    granularity = request.args.get("granularity", default="hour")
+    if granularity not in GRANULARITIES:
+        return jsonify({"error": True, "message": "'granularity' only takes 'hour', 'day'"}), 400
+
+    periods = request.args.get("periods", default=DEFAULT_PERIODS[granularity], type=int)
+    if not 1 <= periods <= MAX_PERIODS[granularity]:
+        return jsonify({"error": True, "message":
+                        f"'periods' must be between 1 and {MAX_PERIODS[granularity]}"}), 400
+
+    return jsonify(load_vote_activity(get_conn(), granularity, periods)), 200
+
+
+@app.route("/stats/movers", methods=["GET"])
+def get_top_movers():
+    """
+    Retrieves the stories whose scores rose (?direction=up) or fell
+    (?direction=down) the most in the last ?hours hours
+    """
+    hours = request.args.get("hours", default=24, type=int)
+    limit = request.args.get("limit", default=10, type=int)
+    direction = request.args.get("direction", default="up")
+
+    if not 1 <= hours <= MAX_MOVER_HOURS:
+        return jsonify({"error": True,
+                        "message": f"'hours' must be between 1 and {MAX_MOVER_HOURS}"}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": True,
+                        "message": f"'limit' must be between 1 and {MAX_PAGE_SIZE}"}), 400
+    if direction not in {"up", "down"}:
+        return jsonify({"error": True, "message": "'direction' only takes 'up', 'down'"}), 400
+
+    return jsonify(load_top_movers(get_conn(), hours, limit, rising=direction == "up")), 200
 
 
 @app.route("/stories", methods=["GET", "POST"])
+@idempotent
 def get_stories():
     """
     GET: Retrieves all available stories on the API, or 
     searches up for stories with a given title and orders them.
+    Pages are served from the story cache when possible.
     POST: Adds a new story onto the API.
     """
+
     if request.method == "GET":
         sort_by = request.args.get('sort_by', default='id')
-        order_by = request.args.get('order_by', default='ASC').upper()
-        search = request.args.get('search', default=None)
+        if sort_by == "hot":
+            return get_hot_stories()
 
-        data = loads_stories(conn, sort_by, order_by, search)
-        if len(data) == 0:
+        order_by = request.args.get(
+            'order_by', default='DESC' if sort_by == 'relevance' else 'ASC').upper()
+        search = request.args.get('search', default=None)
+        cursor = request.args.get('cursor', default=None)
+        limit = request.args.get('limit', default=DEFAULT_PAGE_SIZE, type=int)
+        fields = request.args.get('fields', default=None)
+        if fields is not None:
+            fields = fields.split(",")
+
+        stream = request.args.get('stream', default=None)
+        if stream is not None:
+            rows = request.args.get('rows', default='objects')
+            return stream_stories_response(stream, sort_by, order_by, search, cursor, fields, rows)
+
+        if not 1 <= limit <= MAX_PAGE_SIZE:
             return jsonify({"error": True,
-                            "message": "No results found for your search."}), 400
-
-        return data, 200
+                            "message": f"'limit' must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+        key = (sort_by, order_by, search, cursor, limit, fields and tuple(fields))
+        page = story_cache.get(key)
+
+        if page is None:
+            generation = story_cache.generation()
+            # Pages are tagged with their story ids, so id is loaded even when not requested
+            load_fields = fields if fields is None or "id" in fields else [*fields, "id"]
+            try:
+                data, next_cursor = loads_stories(get_conn(), sort_by, order_by, search,
+                                                  limit, cursor, load_fields)
+            except ValueError as error:
+                return jsonify({"error": True, "message": str(error)}), 400
+
+            if len(data) == 0 and cursor is None:
+                return jsonify({"error": True,
+                                "message": "No results found for your search."}), 400
+
+            story_ids = [row["id"] for row in data]
+            if load_fields is not fields:
+                data = [{field: row[field] for field in fields} for row in data]
+            page = story_cache.put(key, app.json.dumps(data).encode(), next_cursor, story_ids,
+                                   sort_by, search is not None, generation)
+
+        response = app.response_class(page.body, mimetype="application/json")
+        response.set_etag(page.etag)
+        if page.next_cursor is not None:
+            response.headers["X-Next-Cursor"] = page.next_cursor
+        return response.make_conditional(request)
 
     if request.method == "POST":
+        conn = get_conn()
         data = request.json
         url = data.get("url")
         title = data.get("title")
@@ -254,23 +872,126 @@ def get_stories():
                 {"error": True,
                     "message": "'title' and 'url' of new story need to be specified"}), 400
 
-        data = post_new_story(conn, url, title)
+        story = post_new_story(conn, url, title)
+        hot_ranking.update(story)
+        story_cache.invalidate_all()
 
-        return data, 201
+        return write_response(conn, story, 201)
 
     return jsonify(
         {"error": True, "message": "Only methods GET and POST are available."}), 404
 
 
+@app.route("/stories/bulk", methods=["POST"])
+def bulk_import_stories():
+    """
+    Imports many stories at once from a streamed JSON array or NDJSON
+    body, returning a report of what was inserted and rejected
+    """
+    report = import_stories(get_conn(), iter_json_records(request.stream))
+
+    if report["inserted"]:
+        story_cache.invalidate_all()
+        hot_ranking.expire()
+
+    return jsonify(report), 200
+
+
+@app.route("/stories/export", methods=["GET"])
+def bulk_export_stories():
+    """Streams every story as NDJSON"""
+    return app.response_class(stream_with_context(export_stories(get_conn())),
+                              mimetype="application/x-ndjson")
+
+
+@app.route("/stories/hot", methods=["GET"])
+def get_hot_stories():
+    """
+    Retrieves the front page: the hottest stories by score and age,
+    served from the in-memory ranking
+    """
+    limit = request.args.get('limit', default=min(DEFAULT_PAGE_SIZE, hot_ranking.capacity),
+                             type=int)
+
+    if not 1 <= limit <= hot_ranking.capacity:
+        return jsonify({"error": True,
+                        "message": f"'limit' must be between 1 and {hot_ranking.capacity}"}), 400
+
+    if hot_ranking.is_stale():
+        hot_ranking.refresh(load_hot_stories(get_conn(), hot_ranking.capacity))
+
+    return jsonify(hot_ranking.top(limit)), 200
+
+
+@app.route("/stories/batch", methods=["POST"])
+@idempotent
+def batch_stories():
+    """
+    Applies a JSON list of edits ({"op": "edit", "id", "title", "url"}),
+    deletes ({"op": "delete", "id"}) and votes ({"op": "vote", "id",
+    "direction"}) in one transaction, so the frontend can send a burst of
+    actions as a single request. Answers with one {"id", "status"} result
+    per action, in order, adding a "message" to those that failed
+    """
+    actions = request.get_json(silent=True)
+    if not isinstance(actions, list) or not 1 <= len(actions) <= MAX_BATCH_ACTIONS:
+        return jsonify({"error": True, "message":
+                        f"Send a list of 1 to {MAX_BATCH_ACTIONS} actions"}), 400
+
+    try:
+        voter_id = get_voter_id()
+    except ValueError as error:
+        return jsonify({"error": True, "message": str(error)}), 400
+
+    results, valid = {}, []
+    for position, action in enumerate(actions):
+        try:
+            parse_batch_action(action)
+        except ValueError as error:
+            results[position] = {"id": action.get("id") if isinstance(action, dict) else None,
+                                 "status": 400, "message": str(error)}
+            continue
+        if action["op"] == "vote":
+            wait = vote_wait(voter_id, action["id"])
+            if wait:
+                results[position] = {"id": action["id"], "status": 429,
+                                     "message": "Too many votes right now, please try again.",
+                                     "retry_after": max(1, math.ceil(wait))}
+                continue
+        valid.append((position, action))
+
+    if valid:
+        applied, stories = apply_story_batch(get_conn(), valid, voter_id)
+        results.update(applied)
+        for position, action in valid:
+            if action["op"] == "vote" and results[position]["status"] == 404:
+                refund_vote(voter_id, action["id"])
+
+        for story in stories:
+            hot_ranking.update(story)
+        for position, action in valid:
+            if results[position]["status"] != 200:
+                continue
+            if action["op"] == "edit":
+                story_cache.invalidate_story(action["id"], EDIT_COLUMNS, affects_search=True)
+            elif action["op"] == "vote":
+                story_cache.invalidate_story(action["id"], VOTE_COLUMNS)
+            else:
+                hot_ranking.remove(action["id"])
+                story_cache.invalidate_story(action["id"])
+
+    return jsonify([results[position] for position in range(len(actions))]), 200
+
+
 @app.route("/stories/<int:id>", methods=["PATCH", "DELETE"])
+@idempotent
 def existing_stories_id(id: int):
     """
     PATCH: Edits an existing story on the API
     DELETE: Deletes an existing story on the API
+    Both answer 404 when there is no story with the id.
     """
-
-    if not valid_input_id_test(conn, id):
-        return jsonify({"error": True, "message": "Inputted 'id' not valid"}), 400
+    conn = get_conn()
 
     if request.method == "PATCH":
         data = request.json
@@ -281,30 +1002,34 @@ def existing_stories_id(id: int):
             return jsonify(
                 {"error": True, "message": "'title' and 'url' of new story need to be specified"}), 400
 
-        data = patch_existing_story(conn, url, title, id)
+        story = patch_existing_story(conn, url, title, id)
+        if story is not None:
+            hot_ranking.update(story)
+            story_cache.invalidate_story(id, EDIT_COLUMNS, affects_search=True)
 
-        return data, 201
+        return write_response(conn, story, 201)
 
     if request.method == "DELETE":
-        data = delete_existing_story(conn, id)
+        story = delete_existing_story(conn, id)
+        hot_ranking.remove(id)
+        story_cache.invalidate_story(id)
 
-        return data, 200
+        return write_response(conn, story, 200)
 
     return jsonify(
         {"error": True, "message": "Only methods PATCH AND DELETE are available."}), 404
 
 
 @app.route("/stories/<int:id>/votes", methods=["POST"])
+@idempotent
 def post_vote_stories(id: int):
-    """Raises the vote of a story by 1"""
-
-    if valid_input_id_test(conn, id) == "id_not_int":
-        return jsonify(
-            {"error": True, "message": "'id' needs to be an integer"}), 400
-    if valid_input_id_test(conn, id) == "id_not_in_range":
-        return jsonify(
-            {"error": True, "message": "No stories with this id"}), 400
-
+    """
+    Records the voter's vote on a story. Each voter has one vote per
+    story: voting again in the other direction replaces it, and repeating
+    it changes nothing. Votes are rate limited per voter and per story.
+    When the vote buffer is enabled the vote is queued (202) and written
+    in the next batch
+    """
     if request.method == "POST":
         data = request.json
         direction = data.get("direction")
@@ -314,21 +1039,126 @@ def post_vote_stories(id: int):
                 "error": True, "message": "'direction' only takes 'up', 'down' as values"
             }), 400
 
-        create_new_votes_record(conn, id, direction)
+        try:
+            voter_id = get_voter_id()
+        except ValueError as error:
+            return jsonify({"error": True, "message": str(error)}), 400
+
+        wait = vote_wait(voter_id, id)
+        if wait:
+            return too_many_votes(wait)
+
+        conn = get_conn()
+
+        buffer = get_vote_buffer()
+        if buffer is not None:
+            if not story_exists(conn, id):
+                refund_vote(voter_id, id)
+                return jsonify(
+                    {"error": True, "message": "No stories with this id"}), 404
+            if not buffer.submit(voter_id, id, direction):
+                refund_vote(voter_id, id)
+                return too_many_votes(1)
+            return jsonify({"id": id, "direction": direction, "queued": True}), 202
+
+        story = create_new_votes_record(conn, id, direction, voter_id)
+        if story is None:
+            refund_vote(voter_id, id)
+        else:
+            hot_ranking.update(story)
+            story_cache.invalidate_story(id, VOTE_COLUMNS)
+
+        return write_response(conn, story, 200)
 
-        data = update_story_date(conn, id)
+    return {"error": True, "message": "Only method POST is available."}, 404
 
-        return data, 200
 
-    return {"error": True, "message": "Only method POST is available."}, 404
+@app.cli.command("reconcile-scores")
+def reconcile_scores_command():
+    """Rebuilds every story's score from the votes table"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        print(f"Reconciled scores of {reconcile_scores(conn)} stories.")
+    finally:
+        conn.close()
+
+
+@app.cli.command("fold-stats")
+def fold_stats_command():
+    """Adds the score changes logged by votes to the domain statistics"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        report = fold_domain_stats(conn)
+    finally:
+        conn.close()
+    print(f"Folded {report['changes']} score changes into {report['domains']} domains.")
+
+
+@app.cli.command("compact-stats")
+@click.option("--keep-hours", type=click.IntRange(min=HOURLY_RETENTION), show_default=True,
+              default=HOURLY_RETENTION,
+              help="Hours of votes kept in hourly buckets, at least the "
+                   "STATS_HOURLY_RETENTION hours /stats/votes serves.")
+@click.option("--keep-days", type=click.IntRange(min=1),
+              default=environ.get("STATS_DAILY_RETENTION"),
+              help="Days of votes kept in daily buckets. Kept forever by default.")
+def compact_stats_command(keep_hours, keep_days):
+    """Folds old hourly vote buckets into daily ones and expires old daily buckets"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        report = compact_vote_buckets(conn, keep_hours, keep_days)
+    finally:
+        conn.close()
+    print(f"Compacted {report['compacted']} hourly buckets into {report['daily']} daily buckets, "
+          f"expired {report['expired']} daily buckets.")
+
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Rebuilds the /stats rollups from the stories and votes tables"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        rebuild_stats(conn)
+    finally:
+        conn.close()
+    print("Rebuilt domain and vote statistics. Run compact-stats to fold old hours into days.")
+
+
+@app.cli.command("import-stories")
+@click.argument("file", type=click.File("rb"))
+def import_stories_command(file):
+    """Imports stories from a JSON array or NDJSON file ('-' for stdin)"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        report = import_stories(conn, iter_json_records(file))
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=4))
+
+
+@app.cli.command("export-stories")
+@click.argument("file", type=click.File("wb"))
+def export_stories_command(file):
+    """Exports every story as NDJSON to a file ('-' for stdout)"""
+    load_dotenv()
+    conn = get_db_connection()
+    try:
+        file.writelines(export_stories(conn))
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
     try:
         print("Establishing database connection...")
         load_dotenv()
-        conn = get_db_connection()
+        get_pool()
     except:
         print("Not able to establish a connection to database.")
     else:
-        app.run(debug=True, host="0.0.0.0", port=5000)
+        app.run(debug=True, host="0.0.0.0", port=5000, threaded=True)
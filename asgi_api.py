@@ -0,0 +1,418 @@
+"""
+Module Name: asgi_api.py
+
+Description:
+An async variant of the social news API in api.py, for serving many
+concurrent requests per worker. It exposes the same story routes:
+• GET/POST /stories (including ?sort_by=hot) and GET /stories/hot,
+• PATCH/DELETE /stories/<id>,
+• POST /stories/<id>/votes,
+• the static pages at /, /add and /scrape,
+with the same responses, on Quart and an async psycopg 3 connection pool.
+The SQL and the framework-agnostic helpers live in story_core.py, shared
+with api.py, so both apps run identical statements; this module does not
+import api.py or Flask.
+
+Routes not listed above (POST /scrape, bulk import/export, batch mutations,
+streamed listings, statistics, the vote buffer) and Idempotency-Key
+replays are only served by api.py.
+
+Run it under an ASGI server, for example with four worker processes:
+    hypercorn asgi_api:app --workers 4 --bind 0.0.0.0:5000
+Like api.py, each worker keeps its own story cache, hot ranking and
+vote rate limits.
+"""
+
+
+import asyncio
+from os import environ
+
+from dotenv import load_dotenv
+from psycopg import AsyncConnection, sql
+from psycopg.conninfo import make_conninfo
+from psycopg.errors import UniqueViolation
+from psycopg.rows import dict_row
+from psycopg2 import sql as sync_sql
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from quart import Quart, current_app, g, jsonify, make_response, request
+
+import story_core
+from hot_ranking import HotRanking
+from rate_limit import RateLimiter
+from response_cache import ResponseCache
+from story_core import (DEFAULT_PAGE_SIZE, EDIT_COLUMNS, MAX_PAGE_SIZE, VOTE_COLUMNS,
+                        build_stories_query, duplicate_url, fingerprint_etag, identify_voter,
+                        paginate, refund_vote_tokens, take_vote_tokens, too_many_votes,
+                        vote_params)
+
+
+app = Quart(__name__)
+
+pool = None
+pool_lock = asyncio.Lock()
+hot_ranking = HotRanking(capacity=int(environ.get("HOT_RANKING_CAPACITY", 500)),
+                         refresh_interval=float(environ.get("HOT_RANKING_REFRESH_INTERVAL", 60)))
+story_cache = ResponseCache(ttl=float(environ.get("STORIES_CACHE_TTL", 10)),
+                            max_entries=int(environ.get("STORIES_CACHE_MAX_ENTRIES", 1000)))
+address_rate_limiter = RateLimiter(rate=float(environ.get("ADDRESS_RATE_LIMIT", 5)),
+                                   burst=int(environ.get("ADDRESS_RATE_BURST", 50)))
+voter_rate_limiter = RateLimiter(rate=float(environ.get("VOTER_RATE_LIMIT", 1)),
+                                 burst=int(environ.get("VOTER_RATE_BURST", 10)))
+story_rate_limiter = RateLimiter(rate=float(environ.get("STORY_RATE_LIMIT", 100)),
+                                 burst=int(environ.get("STORY_RATE_BURST", 200)))
+
+
+def as_async_sql(query: sync_sql.Composable) -> sql.Composable:
+    """Rebuilds a psycopg2 query for psycopg 3, whose sql module mirrors psycopg2's"""
+    if isinstance(query, sync_sql.Composed):
+        return sql.Composed([as_async_sql(part) for part in query.seq])
+    if isinstance(query, sync_sql.SQL):
+        return sql.SQL(query.string)
+    if isinstance(query, sync_sql.Identifier):
+        return sql.Identifier(*query.strings)
+    if isinstance(query, sync_sql.Literal):
+        return sql.Literal(query.wrapped)
+    if isinstance(query, sync_sql.Placeholder):
+        return sql.Placeholder(query.name)
+    raise TypeError(f"Cannot convert {type(query).__name__}")
+
+
+SELECT_ALL_STORIES = as_async_sql(story_core.SELECT_ALL_STORIES)
+SELECT_HOT_STORIES = as_async_sql(story_core.SELECT_HOT_STORIES)
+SELECT_STORIES_FINGERPRINT = as_async_sql(story_core.SELECT_STORIES_FINGERPRINT)
+INSERT_STORY = as_async_sql(story_core.INSERT_STORY)
+UPDATE_STORY = as_async_sql(story_core.UPDATE_STORY)
+DELETE_STORY = as_async_sql(story_core.DELETE_STORY)
+INSERT_VOTE = as_async_sql(story_core.INSERT_VOTE)
+
+
+async def get_pool() -> AsyncConnectionPool:
+    """Returns the app's connection pool, opening it on first use"""
+    global pool
+    async with pool_lock:
+        if pool is None:
+            conninfo = make_conninfo(
+                user=environ["DATABASE_USERNAME"],
+                host=environ["DATABASE_IP"],
+                dbname=environ.get("DATABASE_NAME", "social_news"),
+                password=environ.get("DATABASE_PASSWORD"),
+                port=environ.get("DATABASE_PORT")
+            )
+            pool = AsyncConnectionPool(
+                conninfo,
+                min_size=int(environ.get("DATABASE_POOL_MIN", 1)),
+                max_size=int(environ.get("DATABASE_POOL_MAX", 10)),
+                timeout=float(environ.get("DATABASE_POOL_TIMEOUT", 5)),
+                kwargs={"row_factory": dict_row},
+                open=False
+            )
+            await pool.open()
+    return pool
+
+
+async def get_conn() -> AsyncConnection:
+    """Checks a connection out of the pool for the lifetime of the current request"""
+    if "db_conn" not in g:
+        g.db_conn = await (await get_pool()).getconn()
+    return g.db_conn
+
+
+@app.before_serving
+async def open_pool() -> None:
+    load_dotenv()
+    await get_pool()
+
+
+@app.after_serving
+async def close_pool() -> None:
+    if pool is not None:
+        await pool.close()
+
+
+@app.teardown_appcontext
+async def release_conn(exception) -> None:
+    """Hands the request's connection back to the pool"""
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        await (await get_pool()).putconn(conn)
+
+
+async def fetch_all(conn: AsyncConnection, query: sql.Composable,
+                    params: any = None) -> list[dict[str, any]]:
+    """Runs a query in its own transaction, returning every row"""
+    async with conn.cursor() as cur:
+        await cur.execute(query, params)
+        rows = await cur.fetchall()
+    await conn.commit()
+    return rows
+
+
+async def fetch_one(conn: AsyncConnection, query: sql.Composable,
+                    params: any = None) -> dict[str, any]:
+    """Runs a query in its own transaction, returning its first row (or None)"""
+    async with conn.cursor() as cur:
+        await cur.execute(query, params)
+        row = await cur.fetchone()
+    await conn.commit()
+    return row
+
+
+async def loads_stories(conn: AsyncConnection, sort_by: str, order_by: str, search: str,
+                        limit: int = DEFAULT_PAGE_SIZE, cursor: str = None,
+                        fields: list[str] = None) -> tuple[list[dict[str, any]], str]:
+    """Loads one page of stories; see loads_stories in api.py"""
+    query, params = build_stories_query(sort_by, order_by, search, cursor, fields, limit + 1)
+    rows = await fetch_all(conn, as_async_sql(query), params)
+    return paginate(rows, sort_by, limit, fields)
+
+
+async def load_all_stories(conn: AsyncConnection) -> list[dict[str, any]]:
+    """Loads every story in the stories table, ordered by id"""
+    return await fetch_all(conn, SELECT_ALL_STORIES)
+
+
+async def load_hot_stories(conn: AsyncConnection, limit: int) -> list[dict[str, any]]:
+    """Loads the hottest stories, hottest first"""
+    return await fetch_all(conn, SELECT_HOT_STORIES, (limit, ))
+
+
+async def get_stories_etag(conn: AsyncConnection) -> str:
+    """Fingerprints the stories table without reading its rows; see api.py"""
+    fingerprint = await fetch_one(conn, SELECT_STORIES_FINGERPRINT)
+    return fingerprint_etag(tuple(fingerprint.values()))
+
+
+async def post_new_story(conn: AsyncConnection, url: str, title: str) -> dict[str, any]:
+    """Adds new story into social_news database, returning the new story"""
+    return await fetch_one(conn, INSERT_STORY, (title, url))
+
+
+async def patch_existing_story(conn: AsyncConnection, url: str, title: str,
+                               id: int) -> dict[str, any]:
+    """Edits the url and title of a story, returning it (or None if there is no such story)"""
+    return await fetch_one(conn, UPDATE_STORY, (url, title, id))
+
+
+async def delete_existing_story(conn: AsyncConnection, id: int) -> dict[str, any]:
+    """Deletes a story, returning it (or None if there is no such story)"""
+    return await fetch_one(conn, DELETE_STORY, (id, ))
+
+
+async def create_new_votes_record(conn: AsyncConnection, id: int, direction: str,
+                                  voter_id: str) -> dict[str, any]:
+    """Records a voter's vote on a story; see create_new_votes_record in api.py"""
+    return await fetch_one(conn, INSERT_VOTE, vote_params(voter_id, id, direction))
+
+
+# ===============================================================================================================
+# ================================= API ROUTES ==================================================================
+# ===============================================================================================================
+
+
+@app.errorhandler(PoolTimeout)
+async def pool_exhausted(error):
+    return jsonify({"error": True, "message": "Server is busy, please try again."}), 503
+
+
+app.register_error_handler(UniqueViolation, duplicate_url)
+
+
+def get_voter_id() -> str:
+    """Identifies the voter of the current request; see identify_voter in story_core.py"""
+    return identify_voter(request.remote_addr, request.headers.get("X-Voter-Id"))
+
+
+def vote_limits(voter_id: str, story_id: int) -> list[tuple[RateLimiter, any]]:
+    """Lists the buckets a vote takes a token from: its client address, voter and story"""
+    return [(address_rate_limiter, request.remote_addr or "unknown"),
+            (voter_rate_limiter, voter_id), (story_rate_limiter, story_id)]
+
+
+async def write_response(conn: AsyncConnection, story: dict[str, any], status: int):
+    """Builds the response to a story write; see write_response in api.py"""
+    if story is None:
+        return jsonify({"error": True, "message": "No stories with this id"}), 404
+
+    if request.args.get("return", default="all") == "row":
+        return story, status
+
+    etag = await get_stories_etag(conn)
+    if request.if_none_match.contains(etag):
+        response = await make_response("", 304)
+    else:
+        response = await make_response(jsonify(await load_all_stories(conn)), status)
+    response.set_etag(etag)
+    return response
+
+
+@app.route("/", methods=["GET"])
+async def index():
+    return await current_app.send_static_file("index.html")
+
+
+@app.route("/add", methods=["GET"])
+async def addstory():
+    """Adds story via frontend"""
+    return await current_app.send_static_file("addstory/index.html")
+
+
+@app.route("/scrape", methods=["GET"])
+async def scrape():
+    """Serves the scrape page; scraping itself (POST /scrape) is served by api.py"""
+    return await current_app.send_static_file("scrape/index.html")
+
+
+@app.route("/stories", methods=["GET", "POST"])
+async def get_stories():
+    """
+    GET: Retrieves a page of stories, served from the story cache when possible
+    POST: Adds a new story onto the API
+    """
+    if request.method == "GET":
+        sort_by = request.args.get('sort_by', default='id')
+        if sort_by == "hot":
+            return await get_hot_stories()
+
+        order_by = request.args.get(
+            'order_by', default='DESC' if sort_by == 'relevance' else 'ASC').upper()
+        search = request.args.get('search', default=None)
+        cursor = request.args.get('cursor', default=None)
+        limit = request.args.get('limit', default=DEFAULT_PAGE_SIZE, type=int)
+        fields = request.args.get('fields', default=None)
+        if fields is not None:
+            fields = fields.split(",")
+
+        if request.args.get('stream') is not None:
+            return jsonify({"error": True,
+                            "message": "'stream' is only served by the synchronous API"}), 400
+
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"error": True,
+                            "message": f"'limit' must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+        key = (sort_by, order_by, search, cursor, limit, fields and tuple(fields))
+        page = story_cache.get(key)
+
+        if page is None:
+            generation = story_cache.generation()
+            # Pages are tagged with their story ids, so id is loaded even when not requested
+            load_fields = fields if fields is None or "id" in fields else [*fields, "id"]
+            try:
+                data, next_cursor = await loads_stories(await get_conn(), sort_by, order_by,
+                                                        search, limit, cursor, load_fields)
+            except ValueError as error:
+                return jsonify({"error": True, "message": str(error)}), 400
+
+            if len(data) == 0 and cursor is None:
+                return jsonify({"error": True,
+                                "message": "No results found for your search."}), 400
+
+            story_ids = [row["id"] for row in data]
+            if load_fields is not fields:
+                data = [{field: row[field] for field in fields} for row in data]
+            page = story_cache.put(key, app.json.dumps(data).encode(), next_cursor, story_ids,
+                                   sort_by, search is not None, generation)
+
+        response = app.response_class(page.body, mimetype="application/json")
+        response.set_etag(page.etag)
+        if page.next_cursor is not None:
+            response.headers["X-Next-Cursor"] = page.next_cursor
+        return await response.make_conditional(request)
+
+    conn = await get_conn()
+    data = await request.get_json()
+    url = data.get("url")
+    title = data.get("title")
+
+    if url is None or title is None:
+        return jsonify(
+            {"error": True, "message": "'title' and 'url' of new story need to be specified"}), 400
+
+    story = await post_new_story(conn, url, title)
+    hot_ranking.update(story)
+    story_cache.invalidate_all()
+
+    return await write_response(conn, story, 201)
+
+
+@app.route("/stories/hot", methods=["GET"])
+async def get_hot_stories():
+    """Retrieves the front page from the in-memory hot ranking"""
+    limit = request.args.get('limit', default=min(DEFAULT_PAGE_SIZE, hot_ranking.capacity),
+                             type=int)
+
+    if not 1 <= limit <= hot_ranking.capacity:
+        return jsonify({"error": True,
+                        "message": f"'limit' must be between 1 and {hot_ranking.capacity}"}), 400
+
+    if hot_ranking.is_stale():
+        hot_ranking.refresh(await load_hot_stories(await get_conn(), hot_ranking.capacity))
+
+    return jsonify(hot_ranking.top(limit)), 200
+
+
+@app.route("/stories/<int:id>", methods=["PATCH", "DELETE"])
+async def existing_stories_id(id: int):
+    """
+    PATCH: Edits an existing story on the API
+    DELETE: Deletes an existing story on the API
+    Both answer 404 when there is no story with the id.
+    """
+    conn = await get_conn()
+
+    if request.method == "PATCH":
+        data = await request.get_json()
+        url = data.get("url")
+        title = data.get("title")
+
+        if url is None or title is None:
+            return jsonify(
+                {"error": True, "message": "'title' and 'url' of new story need to be specified"}), 400
+
+        story = await patch_existing_story(conn, url, title, id)
+        if story is not None:
+            hot_ranking.update(story)
+            story_cache.invalidate_story(id, EDIT_COLUMNS, affects_search=True)
+
+        return await write_response(conn, story, 201)
+
+    story = await delete_existing_story(conn, id)
+    hot_ranking.remove(id)
+    story_cache.invalidate_story(id)
+
+    return await write_response(conn, story, 200)
+
+
+@app.route("/stories/<int:id>/votes", methods=["POST"])
+async def post_vote_stories(id: int):
+    """Records the voter's vote on a story; see post_vote_stories in api.py"""
+    data = await request.get_json()
+    direction = data.get("direction")
+
+    if direction not in {"up", "down"}:
+        return jsonify({
+            "error": True, "message": "'direction' only takes 'up', 'down' as values"
+        }), 400
+
+    try:
+        voter_id = get_voter_id()
+    except ValueError as error:
+        return jsonify({"error": True, "message": str(error)}), 400
+
+    wait = take_vote_tokens(vote_limits(voter_id, id))
+    if wait:
+        return too_many_votes(wait)
+
+    conn = await get_conn()
+    story = await create_new_votes_record(conn, id, direction, voter_id)
+    if story is None:
+        refund_vote_tokens(vote_limits(voter_id, id))
+    else:
+        hot_ranking.update(story)
+        story_cache.invalidate_story(id, VOTE_COLUMNS)
+
+    return await write_response(conn, story, 200)
+
+
+if __name__ == "__main__":
+    app.run(debug=True, host="0.0.0.0", port=5000)
@@ -0,0 +1,422 @@
+"""
+Module Name: benchmark.py
+
+Description:
+A load-testing harness for the social news API.
+• Starts a throwaway Postgres cluster (when initdb and pg_ctl are on the
+  PATH, or in PG_BIN), or uses the database configured by DATABASE_*
+  with --use-env-database. Either way the stories and votes tables are
+  emptied and reseeded, so never point it at real data.
+• Seeds N stories and M votes generated from the stories in stories.json,
+  with votes skewed towards a few popular stories.
+• Drives a mixed list / search / vote / edit workload through the Flask
+  app in-process (or against a running server with --url) and reports
+  p50/p95/p99 latency, throughput and, on a separate sequential pass under
+  tracemalloc, allocations per endpoint. Every vote is cast by a different
+  X-Voter-Id, and any response other than 2xx counts as an error. As all
+  requests come from one address, the in-process app's per-address vote
+  limit is lifted; start a server benchmarked with --url with a high
+  ADDRESS_RATE_LIMIT and ADDRESS_RATE_BURST.
+• Saves reports as baselines and compares later runs against them,
+  exiting with status 1 on regressions.
+
+    python benchmark.py --stories 10000 --votes 100000 --save-baseline baseline.json
+    python benchmark.py --stories 10000 --votes 100000 --compare baseline.json
+"""
+
+
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Callable, Iterator
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import click
+from dotenv import load_dotenv
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+import api
+from bulk_stories import copy_stories, parse_timestamp
+from rate_limit import RateLimiter
+from story_stats import fold_domain_stats
+
+
+# Share of each kind of request in the workload
+WORKLOAD = {"list": 0.5, "search": 0.2, "vote": 0.25, "edit": 0.05}
+LIST_SORTS = ["id", "title", "score", "created_at", "updated_at", "hot"]
+PAGE_SIZE = 20
+# Words of Postgres' english stop list long enough to be picked as searches, which
+# would find nothing and be answered with a 400
+STOP_WORDS = {"about", "above", "after", "again", "against", "because", "before", "being",
+              "below", "between", "doing", "during", "further", "having", "herself", "himself",
+              "itself", "myself", "other", "ourselves", "should", "their", "theirs",
+              "themselves", "there", "these", "those", "through", "under", "until", "where",
+              "which", "while", "yours", "yourself", "yourselves"}
+SEED_BATCH_SIZE = 10000
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Report fields compared against a baseline, and whether higher is worse
+COMPARED_FIELDS = {"p95_ms": True, "p99_ms": True, "throughput": False, "alloc_kib": True}
+
+Send = Callable[[str, str, dict, dict], int]
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Returns the nearest-rank q-th percentile of some values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+@contextmanager
+def throwaway_postgres() -> Iterator[dict[str, str]]:
+    """
+    Runs a temporary Postgres cluster listening only on a unix socket,
+    yielding the DATABASE_* settings that connect to it. The cluster and
+    its files are removed afterwards
+    """
+    bin_dir = os.environ.get("PG_BIN")
+    initdb = shutil.which("initdb", path=bin_dir)
+    pg_ctl = shutil.which("pg_ctl", path=bin_dir)
+    if initdb is None or pg_ctl is None:
+        raise click.ClickException("initdb and pg_ctl were not found; install Postgres, "
+                                   "set PG_BIN, or pass --use-env-database")
+
+    with tempfile.TemporaryDirectory(prefix="social_news_bench_") as directory:
+        data_dir = os.path.join(directory, "data")
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        subprocess.run([initdb, "-D", data_dir, "-U", "postgres", "-A", "trust", "-E", "UTF8",
+                        "--no-sync"], check=True, capture_output=True)
+        subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(directory, "postgres.log"),
+                        "-o", f"-F -p {port} -k {directory} -c listen_addresses=''",
+                        "-w", "start"], check=True, capture_output=True)
+        try:
+            yield {"DATABASE_USERNAME": "postgres", "DATABASE_IP": directory,
+                   "DATABASE_PORT": str(port), "DATABASE_NAME": "postgres"}
+        finally:
+            subprocess.run([pg_ctl, "-D", data_dir, "-m", "immediate", "stop"],
+                           capture_output=True)
+
+
+def load_templates(path: str = os.path.join(HERE, "stories.json")) -> list[dict[str, any]]:
+    """Loads the stories the generated ones are based on"""
+    with open(path, encoding="utf_8") as file:
+        return json.load(file)
+
+
+def generate_stories(templates: list[dict[str, any]], n: int,
+                     seed: int = 0) -> Iterator[tuple]:
+    """
+    Yields n (title, url, created_at, updated_at) rows cycling through the
+    templates, each with a unique url and a creation time in the last 30 days
+    """
+    rng = random.Random(seed)
+    now = parse_timestamp(templates[0]["created_at"]) if templates else datetime(2022, 6, 24)
+    for i in range(n):
+        template = templates[i % len(templates)]
+        created_at = now - timedelta(seconds=rng.randrange(30 * 24 * 3600))
+        yield (f"{template['title']} ({i // len(templates) + 1})",
+               f"{template['url']}#{i}", created_at, created_at)
+
+
+def pick_story(rng: random.Random, n_stories: int) -> int:
+    """Picks a story id, favouring low ids so a few stories get most of the traffic"""
+    return int(n_stories * rng.random() ** 3) + 1
+
+
+def generate_votes(n_stories: int, m: int, seed: int = 0) -> Iterator[tuple]:
+    """Yields m (direction, created_at, updated_at, story_id) rows, four in five of them up"""
+    rng = random.Random(seed)
+    now = datetime(2022, 6, 24)
+    for _ in range(m):
+        created_at = now - timedelta(seconds=rng.randrange(30 * 24 * 3600))
+        yield ("up" if rng.random() < 0.8 else "down", created_at, created_at,
+               pick_story(rng, n_stories))
+
+
+def copy_votes(conn: connection, rows: list[tuple]) -> None:
+    """Loads vote rows with one COPY"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cur = conn.cursor()
+    cur.copy_expert(sql.SQL("""COPY votes (direction, created_at, updated_at, story_id)
+                            FROM STDIN WITH (FORMAT csv)"""), buffer)
+    cur.close()
+
+
+def in_batches(rows: Iterator[tuple], size: int) -> Iterator[list[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed_database(conn: connection, templates: list[dict[str, any]], n_stories: int,
+                  m_votes: int, seed: int = 0) -> None:
+    """
+    Creates the schema and replaces every story and vote with generated
+    ones, then rebuilds the maintained scores and the planner statistics
+    """
+    cur = conn.cursor()
+    with open(os.path.join(HERE, "schema.sql"), encoding="utf_8") as file:
+        cur.execute(file.read())
+    cur.execute(sql.SQL("""TRUNCATE votes, stories, domain_stats, domain_stat_changes,
+                        vote_buckets RESTART IDENTITY"""))
+    conn.commit()
+
+    for batch in in_batches(generate_stories(templates, n_stories, seed), SEED_BATCH_SIZE):
+        copy_stories(conn, batch)
+    for batch in in_batches(generate_votes(n_stories, m_votes, seed), SEED_BATCH_SIZE):
+        copy_votes(conn, batch)
+    conn.commit()
+
+    api.reconcile_scores(conn)
+    fold_domain_stats(conn)
+    conn.autocommit = True
+    cur.execute(sql.SQL("""VACUUM ANALYZE"""))
+    conn.autocommit = False
+    cur.close()
+
+
+def plan_requests(templates: list[dict[str, any]], n_stories: int, n: int,
+                  seed: int = 0) -> list[tuple[str, str, str, dict, dict]]:
+    """
+    Builds a reproducible mix of n (endpoint, method, path, body, headers)
+    requests, giving each vote its own voter so none is rate limited
+    """
+    rng = random.Random(seed)
+    words = sorted({word.strip(".,:!?'\"()").lower()
+                    for template in templates for word in template["title"].split()
+                    if len(word) > 4} - STOP_WORDS)
+    kinds = rng.choices(list(WORKLOAD), weights=list(WORKLOAD.values()), k=n)
+
+    requests = []
+    for kind in kinds:
+        if kind == "list":
+            sort_by = rng.choice(LIST_SORTS)
+            order_by = rng.choice(["ASC", "DESC"])
+            requests.append((f"list:{sort_by}", "GET",
+                             f"/stories?sort_by={sort_by}&order_by={order_by}&limit={PAGE_SIZE}",
+                             None, None))
+        elif kind == "search":
+            requests.append(("search", "GET",
+                             f"/stories?search={rng.choice(words)}&limit={PAGE_SIZE}", None, None))
+        elif kind == "vote":
+            requests.append(("vote", "POST",
+                             f"/stories/{pick_story(rng, n_stories)}/votes?return=row",
+                             {"direction": "up" if rng.random() < 0.8 else "down"},
+                             {"X-Voter-Id": f"bench-{len(requests)}"}))
+        else:
+            template = rng.choice(templates)
+            requests.append(("edit", "PATCH",
+                             f"/stories/{rng.randrange(n_stories) + 1}?return=row",
+                             {"title": template["title"], "url": template["url"]}, None))
+    return requests
+
+
+def in_process_sender() -> Send:
+    """
+    Sends requests straight to the Flask app, without a network hop. Lifts
+    the per-address vote limit, which every request would otherwise share
+    """
+    api.address_rate_limiter = RateLimiter(rate=1e9, burst=10 ** 9)
+
+    def send(method: str, path: str, body: dict, headers: dict) -> int:
+        return api.app.test_client().open(path, method=method, json=body,
+                                          headers=headers).status_code
+    return send
+
+
+def http_sender(base_url: str) -> Send:
+    """Sends requests to a running server"""
+    def send(method: str, path: str, body: dict, headers: dict) -> int:
+        data = None if body is None else json.dumps(body).encode()
+        request = Request(base_url.rstrip("/") + path, data=data, method=method,
+                          headers={"Content-Type": "application/json", **(headers or {})})
+        try:
+            with urlopen(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+    return send
+
+
+def run_workload(send: Send, requests: list[tuple[str, str, str, dict, dict]],
+                 threads: int = 1) -> tuple[dict[str, dict[str, list]], float]:
+    """
+    Sends every request, `threads` at a time, returning the latencies and
+    error count (responses other than 2xx) of each endpoint and the wall
+    time of the whole run
+    """
+    def timed(request: tuple) -> tuple[str, float, bool]:
+        endpoint, method, path, body, headers = request
+        start = perf_counter()
+        status = send(method, path, body, headers)
+        return endpoint, perf_counter() - start, not 200 <= status < 300
+
+    samples = {}
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for endpoint, latency, failed in executor.map(timed, requests):
+            sample = samples.setdefault(endpoint, {"latencies": [], "errors": 0})
+            sample["latencies"].append(latency)
+            sample["errors"] += failed
+    return samples, perf_counter() - start
+
+
+def measure_allocations(send: Send,
+                        requests: list[tuple[str, str, str, dict, dict]]) -> dict[str, float]:
+    """
+    Sends requests one at a time under tracemalloc, returning the mean peak
+    memory allocated per request of each endpoint, in KiB. Kept apart from
+    run_workload because tracing slows every allocation down
+    """
+    peaks = {}
+    tracemalloc.start()
+    try:
+        for endpoint, method, path, body, headers in requests:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            send(method, path, body, headers)
+            peaks.setdefault(endpoint, []).append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return {endpoint: sum(values) / len(values) / 1024 for endpoint, values in peaks.items()}
+
+
+def summarise(samples: dict[str, dict[str, list]], wall_time: float,
+              allocations: dict[str, float] = None) -> dict[str, dict[str, any]]:
+    """Builds the per-endpoint report, plus an "all" row for the whole workload"""
+    allocations = allocations or {}
+    every = {"latencies": [latency for sample in samples.values()
+                           for latency in sample["latencies"]],
+             "errors": sum(sample["errors"] for sample in samples.values())}
+
+    report = {}
+    for endpoint, sample in sorted(samples.items()) + [("all", every)]:
+        latencies = sample["latencies"]
+        alloc = allocations.get(endpoint)
+        if endpoint == "all" and allocations:
+            alloc = sum(allocations.values()) / len(allocations)
+        report[endpoint] = {
+            "requests": len(latencies),
+            "errors": sample["errors"],
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "throughput": round(len(latencies) / wall_time, 1),
+            "alloc_kib": None if alloc is None else round(alloc, 1)
+        }
+    return report
+
+
+def compare(report: dict[str, dict[str, any]], baseline: dict[str, dict[str, any]],
+            tolerance: float = 0.2) -> list[str]:
+    """Lists the fields of each endpoint that got more than `tolerance` worse than the baseline"""
+    regressions = []
+    for endpoint, row in report.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        for field, higher_is_worse in COMPARED_FIELDS.items():
+            now, before = row.get(field), base.get(field)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            if (change if higher_is_worse else -change) > tolerance:
+                regressions.append(f"{endpoint} {field}: {before} -> {now} ({change:+.0%})")
+    return regressions
+
+
+def print_report(report: dict[str, dict[str, any]]) -> None:
+    columns = ["requests", "errors", "p50_ms", "p95_ms", "p99_ms", "throughput", "alloc_kib"]
+    print(f"{'endpoint':<18}" + "".join(f"{column:>12}" for column in columns))
+    for endpoint, row in report.items():
+        print(f"{endpoint:<18}" + "".join(f"{str(row[column]):>12}" for column in columns))
+
+
+@click.command()
+@click.option("--stories", default=10000, show_default=True, help="Stories to seed")
+@click.option("--votes", default=100000, show_default=True, help="Votes to seed")
+@click.option("--requests", "n_requests", default=5000, show_default=True,
+              help="Requests in the timed workload")
+@click.option("--threads", default=8, show_default=True, help="Concurrent requests")
+@click.option("--alloc-requests", default=500, show_default=True,
+              help="Requests in the allocation pass (0 to skip it)")
+@click.option("--seed", default=0, show_default=True, help="Seed of the data and workload")
+@click.option("--use-env-database", is_flag=True,
+              help="Seed the DATABASE_* database instead of a throwaway one")
+@click.option("--url", default=None, help="Benchmark a running server instead of the app in-process")
+@click.option("--save-baseline", type=click.Path(dir_okay=False), default=None)
+@click.option("--compare", "baseline_path", type=click.Path(exists=True, dir_okay=False),
+              default=None)
+@click.option("--tolerance", default=0.2, show_default=True,
+              help="Allowed relative regression against the baseline")
+def main(stories, votes, n_requests, threads, alloc_requests, seed, use_env_database, url,
+         save_baseline, baseline_path, tolerance):
+    """Seeds a database, runs the workload and reports per-endpoint performance"""
+    load_dotenv()
+    templates = load_templates()
+
+    with nullcontext({}) if use_env_database else throwaway_postgres() as settings:
+        os.environ.update(settings)
+        api.pool = None
+
+        conn = api.get_db_connection()
+        try:
+            seed_database(conn, templates, stories, votes, seed)
+        finally:
+            conn.close()
+
+        send = http_sender(url) if url else in_process_sender()
+        requests = plan_requests(templates, stories, n_requests, seed)
+        samples, wall_time = run_workload(send, requests, threads)
+
+        allocations = None
+        if alloc_requests and url is None:
+            allocations = measure_allocations(
+                send, plan_requests(templates, stories, alloc_requests, seed + 1))
+
+    report = summarise(samples, wall_time, allocations)
+    print_report(report)
+
+    if save_baseline:
+        with open(save_baseline, "w", encoding="utf_8") as file:
+            json.dump(report, file, indent=4)
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf_8") as file:
+            regressions = compare(report, json.load(file), tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
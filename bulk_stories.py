@@ -0,0 +1,221 @@
+"""
+Module Name: bulk_stories.py
+
+Description:
+Bulk import and export of stories, for seeding and migrating data
+without replaying one POST /stories per story.
+• Imports stream NDJSON or a JSON array, validate each batch of records,
+  and load the valid ones with COPY. Invalid records and failed batches
+  are collected into a report instead of aborting the import.
+• Exports stream NDJSON rows from a server-side cursor, so the table is
+  never held in memory.
+
+Both are exposed as HTTP endpoints in api.py and as flask CLI commands:
+    flask --app api import-stories stories.json
+    flask --app api export-stories stories.ndjson
+"""
+
+
+import codecs
+import csv
+import io
+import json
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Iterator
+
+from psycopg2 import Error as DatabaseError
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+from streaming import encode_ndjson, stream_query
+
+
+BATCH_SIZE = 5000
+MAX_REPORTED_ERRORS = 100
+# Values other than strings that are cut short fail to decode within this many characters
+# of the end, the longest being "-Infinity" and "\\uXXXX" escapes
+TRUNCATED_TAIL = 16
+EXPORT_COLUMNS = ("id", "title", "url", "score", "upvotes", "downvotes", "created_at", "updated_at")
+
+
+def iter_json_records(stream: BinaryIO, chunk_size: int = 65536) -> Iterator[any]:
+    """
+    Yields the records of a JSON array, or of NDJSON (one record per
+    line), from a byte stream that is read a chunk at a time
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf_8")()
+    chunks = iter(lambda: stream.read(chunk_size), b"")
+    buffer = ""
+
+    def read_more() -> bool:
+        nonlocal buffer
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        buffer += utf8.decode(chunk)
+        return True
+
+    while not buffer.strip() and read_more():
+        pass
+    buffer = buffer.lstrip()
+
+    if not buffer.startswith("["):
+        while True:
+            *lines, buffer = buffer.split("\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            if not read_more():
+                break
+        if buffer.strip():
+            yield json.loads(buffer)
+        return
+
+    buffer = buffer[1:]
+    previous = "["  # The last token read: "[", "," or a record
+    while True:
+        buffer = buffer.lstrip()
+        if not buffer:
+            if not read_more():
+                raise ValueError("Unterminated JSON array")
+            continue
+        if previous != "," and buffer.startswith("]"):
+            return
+        if previous == "record":
+            if not buffer.startswith(","):
+                raise ValueError("Expected ',' or ']' between the records of the JSON array")
+            buffer = buffer[1:]
+            previous = ","
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError as error:
+            if not truncated(error) or not read_more():
+                raise
+            continue
+        # A number may go on in the next chunk
+        if end == len(buffer) and isinstance(record, (int, float)) and read_more():
+            continue
+        yield record
+        buffer = buffer[end:]
+        previous = "record"
+
+
+def truncated(error: json.JSONDecodeError) -> bool:
+    """
+    Tells whether decoding may have failed only because the document was
+    cut short: strings can be of any length, and any other value errs
+    within a few characters of the end, so more is only read then
+    """
+    return (error.msg.startswith("Unterminated string")
+            or len(error.doc) - error.pos < TRUNCATED_TAIL)
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parses an ISO 8601 timestamp or an HTTP date like those in stories.json,
+    returning it as a naive UTC datetime
+    """
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid timestamp {value!r}")
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        try:
+            parsed = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid timestamp {value!r}")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def validate_story(record: any) -> tuple:
+    """Checks an imported record, returning its (title, url, created_at, updated_at) row"""
+    if not isinstance(record, dict):
+        raise ValueError("Record is not an object")
+
+    title = record.get("title")
+    url = record.get("url")
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError("'title' must be a non-empty string")
+    if not isinstance(url, str) or not url.strip():
+        raise ValueError("'url' must be a non-empty string")
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    created_at = now if record.get("created_at") in (None, "") \
+        else parse_timestamp(record["created_at"])
+    updated_at = created_at if record.get("updated_at") in (None, "") \
+        else parse_timestamp(record["updated_at"])
+    return title.strip(), url.strip(), created_at, updated_at
+
+
+def copy_stories(conn: connection, rows: list[tuple]) -> None:
+    """Loads validated story rows with one COPY"""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cur = conn.cursor()
+    cur.copy_expert(sql.SQL("""COPY stories (title, url, created_at, updated_at)
+                            FROM STDIN WITH (FORMAT csv)"""), buffer)
+    cur.close()
+
+
+def import_stories(conn: connection, records: Iterator[any],
+                   batch_size: int = BATCH_SIZE) -> dict[str, any]:
+    """
+    Imports records in batches, committing each batch. Returns a report
+    of how many stories were inserted and which records were rejected.
+    Malformed JSON stops the import after the records before it
+    """
+    report = {"inserted": 0, "rejected": 0, "batches": 0, "errors": []}
+
+    def report_error(error: dict[str, any]) -> None:
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append(error)
+
+    def load_batch(batch: list[tuple[int, any]]) -> None:
+        report["batches"] += 1
+        rows = []
+        for index, record in batch:
+            try:
+                rows.append(validate_story(record))
+            except ValueError as error:
+                report["rejected"] += 1
+                report_error({"index": index, "error": str(error)})
+        if not rows:
+            return
+
+        try:
+            copy_stories(conn, rows)
+            conn.commit()
+        except DatabaseError as error:
+            conn.rollback()
+            report["rejected"] += len(rows)
+            report_error({"batch": report["batches"], "error": str(error).strip()})
+            return
+        report["inserted"] += len(rows)
+
+    batch = []
+    try:
+        for index, record in enumerate(records):
+            batch.append((index, record))
+            if len(batch) == batch_size:
+                load_batch(batch)
+                batch = []
+    except ValueError as error:
+        report_error({"error": f"Malformed JSON: {error}"})
+    if batch:
+        load_batch(batch)
+
+    return report
+
+
+def export_stories(conn: connection, batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """Yields every story as NDJSON, read through a server-side cursor"""
+    query = sql.SQL("""SELECT {} FROM stories ORDER BY id""") \
+        .format(sql.SQL(", ").join(map(sql.Identifier, EXPORT_COLUMNS)))
+    return encode_ndjson(stream_query(conn, query, itersize=batch_size, name="export_stories"))
@@ -1,7 +1,13 @@
 """This file contains fixtures/stuff used by lots of different tests."""
+from os import environ
+from subprocess import CalledProcessError
+from unittest.mock import patch
+
 import pytest
+from click import ClickException
 
 from api import app, get_db_connection
+from benchmark import throwaway_postgres
 
 
 @pytest.fixture
@@ -9,26 +15,33 @@ def test_client():
     return app.test_client()
 
 
+@pytest.fixture(scope="session")
+def throwaway_database():
+    """DATABASE_* settings of a throwaway Postgres cluster, shared by the session"""
+    try:
+        with throwaway_postgres() as settings:
+            yield settings
+    except (ClickException, CalledProcessError) as error:
+        pytest.skip(f"No throwaway Postgres available: {error}")
+
+
 @pytest.fixture
-def test_database_connection():
-    """Return a connection to our Test Database"""
+def test_database_connection(throwaway_database):
+    """Return a connection to an empty test database"""
 
     # Run before the test
-    test_config = {
-        "DB_HOST": "localhost",
-        "DB_PORT": 5000,
-        "DB_USER": "howardman",
-        "DB_NAME": "social_news"
-    }
-
-    conn = get_db_connection(test_config)
+    with patch.dict(environ, throwaway_database):
+        conn = get_db_connection()
+    with conn.cursor() as cur, open("schema.sql", encoding="utf_8") as file:
+        cur.execute(file.read())
+    conn.commit()
 
     # Passed to the test
     yield conn
 
     # Run after the test
     with conn.cursor() as cur:
-        cur.execute("TRUNCATE message RESTART IDENTITY;")
+        cur.execute("TRUNCATE votes, stories, domain_stats, domain_stat_changes, vote_buckets RESTART IDENTITY;")
 
     conn.commit()
     conn.close()
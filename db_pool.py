@@ -0,0 +1,173 @@
+"""
+Module Name: db_pool.py
+
+Description:
+A small thread-safe pool of psycopg2 connections for the social news API.
+Connections are checked out once per request and handed back when the
+request is torn down, so the API can be served by a threaded or
+multi-worker server without every request sharing one connection.
+
+The pool
+• keeps between `min_size` and `max_size` connections open,
+• blocks (up to `timeout` seconds) when every connection is checked out,
+• health checks connections that have sat idle, and reconnects broken ones,
+• records checkout counts and wait times for the /metrics endpoint.
+"""
+
+
+import threading
+from time import monotonic, perf_counter
+from typing import Callable
+
+from psycopg2 import Error as DatabaseError
+from psycopg2.extensions import connection, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+class ConnectionPool:
+    """A bounded, blocking pool of database connections"""
+
+    def __init__(self, connect: Callable[[], connection], min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, health_check_after: float = 30.0) -> None:
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Pool sizes must satisfy 0 <= min_size <= max_size and max_size >= 1")
+
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, time it was returned) pairs, most recent last
+        self._size = 0
+        self._closed = False
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), monotonic()))
+            self._size += 1
+
+    def getconn(self) -> connection:
+        """Checks a healthy connection out of the pool, waiting if none are free"""
+        start = perf_counter()
+        deadline = monotonic() + self.timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s")
+                self._cond.wait(remaining)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, returned_at):
+                self._close_quietly(conn)
+                conn = self._connect()
+                with self._cond:
+                    self._reconnects += 1
+        except Exception:
+            self._release_slot()
+            raise
+
+        waited = perf_counter() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return conn
+
+    def putconn(self, conn: connection, discard: bool = False) -> None:
+        """Returns a connection to the pool, rolling back any open transaction"""
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except DatabaseError:
+                    discard = True
+
+        if discard or conn.closed or self._closed:
+            self._close_quietly(conn)
+            self._release_slot()
+            return
+
+        with self._cond:
+            self._idle.append((conn, monotonic()))
+            self._cond.notify()
+
+    def closeall(self) -> None:
+        """Closes every idle connection and refuses further checkouts"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def stats(self) -> dict[str, any]:
+        """Returns a snapshot of the pool metrics"""
+        with self._cond:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "wait_seconds_total": round(self._wait_total, 6),
+                "wait_seconds_max": round(self._wait_max, 6)
+            }
+
+    def _is_healthy(self, conn: connection, returned_at: float) -> bool:
+        """Checks a connection is usable, pinging it if it has been idle a while"""
+        if conn.closed:
+            return False
+        if monotonic() - returned_at < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+        except DatabaseError:
+            return False
+        return True
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn: connection) -> None:
+        try:
+            conn.close()
+        except DatabaseError:
+            pass
@@ -0,0 +1,103 @@
+"""
+Module Name: hot_ranking.py
+
+Description:
+Keeps the front page "hot" ranking of stories in memory. A story's hot
+value combines its score with its age:
+
+    hot = sign(score) * log10(max(|score|, 1)) + created_at / HOT_DECAY_SECONDS
+
+so every order of magnitude of score is worth HOT_DECAY_SECONDS of
+recency. Unlike formulas that divide by the current age, the value does
+not drift with the clock, so one vote only moves one story and the
+ranking can be updated incrementally instead of recomputed per request.
+
+The ranking holds at most `capacity` stories, evicting the coldest, and
+is rebuilt from the database every `refresh_interval` seconds to pick up
+writes made by other workers.
+"""
+
+
+import bisect
+import math
+import threading
+from datetime import datetime, timezone
+from time import monotonic
+
+
+HOT_DECAY_SECONDS = 45000
+
+
+def hot_score(score: int, created_at: datetime) -> float:
+    """Returns the hot value of a story; matches HOT_SCORE_SQL in api.py"""
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    magnitude = math.log10(max(abs(score), 1))
+    sign = (score > 0) - (score < 0)
+    return sign * magnitude + created_at.timestamp() / HOT_DECAY_SECONDS
+
+
+class HotRanking:
+    """A bounded, sorted, in-memory ranking of the hottest stories"""
+
+    def __init__(self, capacity: int = 500, refresh_interval: float = 60.0) -> None:
+        self.capacity = capacity
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._keys = []  # (-hot, -id), hottest first
+        self._stories = {}  # id -> (key, story)
+        self._refreshed_at = None
+
+    def is_stale(self) -> bool:
+        """Whether the ranking is due to be rebuilt from the database"""
+        with self._lock:
+            return (self._refreshed_at is None
+                    or monotonic() - self._refreshed_at >= self.refresh_interval)
+
+    def refresh(self, stories: list[dict[str, any]]) -> None:
+        """Rebuilds the ranking from the hottest stories in the database"""
+        with self._lock:
+            self._keys = []
+            self._stories = {}
+            for story in stories:
+                self._insert(story)
+            self._refreshed_at = monotonic()
+
+    def expire(self) -> None:
+        """Marks the ranking for a rebuild, for writes too large to apply one by one"""
+        with self._lock:
+            self._refreshed_at = None
+
+    def update(self, story: dict[str, any]) -> None:
+        """Re-ranks a story after it was created, edited or voted on"""
+        with self._lock:
+            self._remove(story["id"])
+            self._insert(story)
+
+    def remove(self, id: int) -> None:
+        """Drops a deleted story from the ranking"""
+        with self._lock:
+            self._remove(id)
+
+    def top(self, limit: int) -> list[dict[str, any]]:
+        """Returns the `limit` hottest stories, hottest first"""
+        with self._lock:
+            return [self._stories[-key[1]][1] for key in self._keys[:limit]]
+
+    def _insert(self, story: dict[str, any]) -> None:
+        key = (-hot_score(story["score"], story["created_at"]), -story["id"])
+        if len(self._keys) >= self.capacity and key >= self._keys[-1]:
+            return  # Colder than everything kept
+
+        bisect.insort(self._keys, key)
+        self._stories[story["id"]] = (key, story)
+
+        if len(self._keys) > self.capacity:
+            evicted = self._keys.pop()
+            del self._stories[-evicted[1]]
+
+    def _remove(self, id: int) -> None:
+        entry = self._stories.pop(id, None)
+        if entry is not None:
+            del self._keys[bisect.bisect_left(self._keys, entry[0])]
@@ -1,23 +1,274 @@
-from urllib.request import urlopen
-from datetime import datetime
-from bs4 import BeautifulSoup
+"""
+Module Name: news_scraper.py
 
+Description:
+Scrapes headlines from news sites into the stories table.
+• Sources are crawled concurrently on a thread pool, with a minimum
+  interval between requests to the same host and a timeout per request.
+• Pages are fetched with conditional GETs (ETag / Last-Modified), so an
+  unchanged page costs a 304 and is not parsed again. Redirects are only
+  followed to the hosts of the sources being scraped.
+• Headlines are deduplicated by a hash of their normalised url, both
+  within a crawl and against stories already in the database, and new
+  ones are inserted with one multi-row statement that skips urls
+  already stored, relying on the unique md5(url) index.
 
-def get_html(url):
-    page = urlopen(url)
-    html_bytes = page.read()
-    html = html_bytes.decode("utf_8")
-    return html_doc
+Run `python news_scraper.py` to scrape DEFAULT_SOURCES into the database
+configured in .env.
+"""
 
 
-def parse_stories_bs(domain_url, html):
-    stories = []
-    soup = BeautifulSoup(html, "html.parser")
-    # TO DO
+import codecs
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, sleep
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+import psycopg2.extras
+from bs4 import BeautifulSoup, FeatureNotFound
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOURCES = [
+    {"url": "https://www.bbc.co.uk/news", "selector": "a.gs-c-promo-heading, a[data-testid='internal-link']"},
+    {"url": "https://www.theguardian.com/uk", "selector": "a[data-link-name='article']"},
+    {"url": "https://news.ycombinator.com", "selector": "span.titleline > a"}
+]
+USER_AGENT = "social-news-scraper/1.0"
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host by at least `min_interval` seconds"""
+
+    def __init__(self, min_interval: float = 1.0) -> None:
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_slot = {}  # host -> earliest time of its next request
+
+    def wait(self, host: str) -> None:
+        """Blocks until a request to `host` may be made"""
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.min_interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class SourceRedirectHandler(HTTPRedirectHandler):
+    """Follows redirects only to http(s) pages on the hosts (and ports) of `sources`"""
+
+    def __init__(self, sources: list[dict[str, str]]) -> None:
+        self.netlocs = {urlsplit(source["url"]).netloc.lower() for source in sources}
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        parts = urlsplit(newurl)
+        if parts.scheme not in {"http", "https"} or parts.netloc.lower() not in self.netlocs:
+            raise HTTPError(newurl, code, f"Redirect to {newurl} leaves the source hosts",
+                            headers, fp)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def allowed_source(url: str, sources: list[dict[str, str]]) -> dict[str, str]:
+    """
+    Returns `url` as a source to scrape if it is an http(s) page on the
+    host of one of `sources`, with that source's selector, or else None.
+    Keeps user-submitted urls away from internal hosts and other sites
+    """
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError:
+        return None
+    if parts.scheme not in {"http", "https"} or port is not None or not parts.hostname:
+        return None
+    for source in sources:
+        if urlsplit(source["url"]).hostname == parts.hostname:
+            return {**source, "url": url}
+    return None
+
+
+def normalise_url(url: str) -> str:
+    """Normalises a url so that trivially different links compare equal"""
+    parts = urlsplit(url.strip())
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, parts.query, ""))
+
+
+def url_hash(url: str) -> str:
+    """Hashes a normalised url; matches md5(url) of the stored url in the database"""
+    return hashlib.md5(normalise_url(url).encode()).hexdigest()
+
+
+def get_html(url: str, validators: dict[str, str] = None, timeout: float = 10.0,
+             sources: list[dict[str, str]] = None) -> dict[str, any]:
+    """
+    Fetches a page, sending the ETag and Last-Modified of the previous
+    fetch if given. Returns the page's html (None if it has not changed)
+    and the validators to send next time. Redirects are followed only to
+    the hosts of `sources`, by default the host of `url`; an unknown
+    charset is decoded as utf-8
+    """
+    validators = validators or {}
+    headers = {"User-Agent": USER_AGENT}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        opener = build_opener(SourceRedirectHandler(sources or [{"url": url}]))
+        with opener.open(Request(url, headers=headers), timeout=timeout) as page:
+            charset = page.headers.get_content_charset() or "utf_8"
+            try:
+                codecs.lookup(charset)
+            except LookupError:
+                charset = "utf_8"
+            return {
+                "html": page.read().decode(charset, errors="replace"),
+                "etag": page.headers.get("ETag"),
+                "last_modified": page.headers.get("Last-Modified")
+            }
+    except HTTPError as error:
+        if error.code == 304:
+            return {"html": None, "etag": validators.get("etag"),
+                    "last_modified": validators.get("last_modified")}
+        raise
+
+
+def parse_stories_bs(domain_url: str, html: str, selector: str = None) -> list[dict[str, str]]:
+    """
+    Parses headlines out of a page. Links are picked by a CSS selector, or
+    by default any link inside a heading, and resolved against the page url
+    """
+    try:
+        soup = BeautifulSoup(html, "lxml")
+    except FeatureNotFound:
+        soup = BeautifulSoup(html, "html.parser")
 
+    links = soup.select(selector or "h1 a[href], h2 a[href], h3 a[href]")
+
+    stories = []
+    for link in links:
+        title = " ".join(link.get_text(" ", strip=True).split())
+        url = urljoin(domain_url, link.get("href", ""))
+        if title and urlsplit(url).scheme in {"http", "https"}:
+            stories.append({"title": title, "url": normalise_url(url)})
     return stories
 
 
+def scrape_source(source: dict[str, str], limiter: HostRateLimiter, state: dict[str, dict],
+                  timeout: float, sources: list[dict[str, str]]) -> list[dict[str, str]]:
+    """
+    Scrapes one source, returning no stories if its page is unchanged.
+    Redirects may only lead to the hosts of `sources`
+    """
+    url = source["url"]
+    limiter.wait(urlsplit(url).netloc)
+
+    page = get_html(url, state.get(url), timeout, sources)
+    state[url] = {"etag": page.get("etag"), "last_modified": page.get("last_modified")}
+    if page["html"] is None:
+        return []
+    return parse_stories_bs(url, page["html"], source.get("selector"))
+
+
+def scrape_sources(sources: list[dict[str, str]], state: dict[str, dict] = None,
+                   max_workers: int = 8, timeout: float = 10.0,
+                   min_interval: float = 1.0,
+                   limiter: HostRateLimiter = None) -> list[dict[str, str]]:
+    """
+    Scrapes every source concurrently, returning their stories without
+    duplicate urls. `state` holds each source's validators between crawls
+    and is updated in place; failing sources, including those redirecting
+    off the hosts of `sources`, are logged and skipped.
+    Pass a shared `limiter` to space out requests across calls
+    """
+    state = {} if state is None else state
+    limiter = HostRateLimiter(min_interval) if limiter is None else limiter
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {source["url"]: executor.submit(scrape_source, source, limiter, state,
+                                                  timeout, sources)
+                   for source in sources}
+
+    stories = {}
+    for url, future in futures.items():
+        try:
+            found = future.result()
+        except (URLError, OSError, ValueError) as error:
+            logger.warning("Could not scrape %s: %s", url, error)
+            continue
+        for story in found:
+            stories.setdefault(url_hash(story["url"]), story)
+    return list(stories.values())
+
+
+def insert_stories(conn: connection, stories: list[dict[str, str]]) -> list[dict[str, any]]:
+    """
+    Inserts stories in one statement, skipping urls already in the
+    stories table, and returns the inserted stories. The conflict on the
+    unique md5(url) index also skips urls a concurrent scrape inserts
+    """
+    if not stories:
+        return []
+
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    rows = psycopg2.extras.execute_values(
+        cur, sql.SQL("""INSERT INTO stories (title, url, created_at, updated_at)
+                     SELECT new.title, new.url, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+                     FROM (VALUES %s) AS new (title, url)
+                     ON CONFLICT (md5(url)) DO NOTHING
+                     RETURNING *"""),
+        [(story["title"], story["url"]) for story in stories],
+        page_size=len(stories), fetch=True)
+
+    conn.commit()
+    cur.close()
+    return rows
+
+
+def load_state(path: str) -> dict[str, dict]:
+    """Loads the validators saved by the previous crawl"""
+    try:
+        with open(path, encoding="utf_8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path: str, state: dict[str, dict]) -> None:
+    """Saves the validators for the next crawl"""
+    with open(path, "w", encoding="utf_8") as file:
+        json.dump(state, file, indent=4)
+
+
 if __name__ == "__main__":
-    bbc_url = "http://bbc.co.uk"
-    bbc_html_doc = get_html(bbc_url)
+    from dotenv import load_dotenv
+
+    from api import get_db_connection
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+
+    state_path = "scraper_state.json"
+    state = load_state(state_path)
+    scraped = scrape_sources(DEFAULT_SOURCES, state)
+
+    conn = get_db_connection()
+    try:
+        inserted = insert_stories(conn, scraped)
+    finally:
+        conn.close()
+    save_state(state_path, state)
+
+    print(f"Scraped {len(scraped)} stories, {len(inserted)} of them new.")
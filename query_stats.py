@@ -0,0 +1,277 @@
+"""
+Module Name: query_stats.py
+
+Description:
+Instruments the API's database access.
+• InstrumentedConnection is a psycopg2 connection whose cursors, whatever
+  their cursor_factory, time every statement and count the rows fetched.
+  A named (server-side) cursor also times each fetch, including the
+  FETCH FORWARD issued while it is iterated, as a round-trip.
+• Each request's statements are tallied into a RequestStats (database
+  time, round-trips, rows), kept in a context variable between
+  begin_request and end_request, so the API can split a request's time
+  between the database and everything else.
+• QueryStats aggregates statement and request timings into histograms
+  for the /metrics endpoint.
+• Statements slower than `slow_query_ms` are logged with their EXPLAIN
+  plan (without ANALYZE, so the statement is not run again).
+"""
+
+
+import bisect
+import logging
+import threading
+from contextvars import ContextVar
+from time import perf_counter
+
+from psycopg2 import Error as DatabaseError
+from psycopg2.extensions import connection, cursor
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in milliseconds
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+EXPLAINABLE = ("select", "insert", "update", "delete", "with")
+
+
+class Histogram:
+    """A thread-safe histogram of durations in fixed millisecond buckets"""
+
+    def __init__(self, buckets: tuple[float] = BUCKETS_MS) -> None:
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)  # The last bucket is unbounded
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+    def observe(self, value_ms: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value_ms)] += 1
+            self._count += 1
+            self._sum += value_ms
+            self._max = max(self._max, value_ms)
+
+    def snapshot(self) -> dict[str, any]:
+        with self._lock:
+            labels = [f"le_{bound}" for bound in self.buckets] + ["inf"]
+            return {
+                "count": self._count,
+                "sum_ms": round(self._sum, 3),
+                "mean_ms": round(self._sum / self._count, 3) if self._count else None,
+                "max_ms": round(self._max, 3),
+                "buckets": dict(zip(labels, self._counts))
+            }
+
+
+class RequestStats:
+    """The database work of one request"""
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.db_seconds = 0.0
+        self.round_trips = 0
+        self.rows = 0
+
+    def elapsed(self) -> float:
+        return perf_counter() - self.started
+
+
+current_request = ContextVar("current_request", default=None)
+
+
+class QueryStats:
+    """Aggregates statement timings, and per-endpoint request timings"""
+
+    def __init__(self, slow_query_ms: float = 500.0, explain_slow_queries: bool = True) -> None:
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow_queries = explain_slow_queries
+        self.statements = Histogram()
+        self._lock = threading.Lock()
+        self._endpoints = {}  # endpoint -> {"total": Histogram, "db": Histogram, counters}
+        self._slow_queries = 0
+
+    def record_statement(self, seconds: float) -> None:
+        """Records one round-trip to the database"""
+        self.statements.observe(seconds * 1000)
+        stats = current_request.get()
+        if stats is not None:
+            stats.db_seconds += seconds
+            stats.round_trips += 1
+
+    def record_rows(self, rows: int) -> None:
+        """Records rows fetched by the current request"""
+        stats = current_request.get()
+        if stats is not None:
+            stats.rows += rows
+
+    def record_slow_query(self, query: bytes, seconds: float, plan: str = None) -> None:
+        with self._lock:
+            self._slow_queries += 1
+        logger.warning("Slow query (%.1f ms): %s\n%s", seconds * 1000,
+                       query.decode(errors="replace") if isinstance(query, bytes) else query,
+                       plan or "(no plan)")
+
+    def begin_request(self) -> RequestStats:
+        """Starts tallying the statements run by the current request"""
+        stats = RequestStats()
+        current_request.set(stats)
+        return stats
+
+    def end_request(self, endpoint: str) -> RequestStats:
+        """Stops tallying the current request and records it under its endpoint"""
+        stats = current_request.get()
+        current_request.set(None)
+        if stats is None:
+            return None
+
+        with self._lock:
+            entry = self._endpoints.get(endpoint)
+            if entry is None:
+                entry = self._endpoints[endpoint] = {
+                    "total": Histogram(), "db": Histogram(), "round_trips": 0, "rows": 0}
+            entry["round_trips"] += stats.round_trips
+            entry["rows"] += stats.rows
+        entry["total"].observe(stats.elapsed() * 1000)
+        entry["db"].observe(stats.db_seconds * 1000)
+        return stats
+
+    def snapshot(self) -> dict[str, any]:
+        """Returns the histograms and counters for /metrics"""
+        with self._lock:
+            endpoints = {endpoint: dict(entry) for endpoint, entry in self._endpoints.items()}
+            slow_queries = self._slow_queries
+
+        report = {}
+        for endpoint, entry in sorted(endpoints.items()):
+            total = entry["total"].snapshot()
+            requests = total["count"]
+            report[endpoint] = {
+                "total": total,
+                "db": entry["db"].snapshot(),
+                "round_trips_per_request": round(entry["round_trips"] / requests, 2),
+                "rows_per_request": round(entry["rows"] / requests, 2)
+            }
+        return {"statements": self.statements.snapshot(), "slow_queries": slow_queries,
+                "endpoints": report}
+
+
+query_stats = QueryStats()
+
+
+class TimedCursorMixin:
+    """
+    Times the statements of a cursor class and counts the rows it fetches.
+    Fetches from a named cursor go to the server, so they are timed too
+    """
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size, explain=False)
+
+    def fetchone(self):
+        row = self._fetched(super().fetchone)
+        query_stats.record_rows(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            rows = self._fetched(super().fetchmany)
+        else:
+            rows = self._fetched(super().fetchmany, size)
+        query_stats.record_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._fetched(super().fetchall)
+        query_stats.record_rows(len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # A named cursor fetches its next `itersize` rows once it has handed out the last ones
+        if self.name is not None and self.rownumber >= self.rowcount:
+            row = self._timed(super().__next__, explain=False)
+        else:
+            row = super().__next__()
+        query_stats.record_rows(1)
+        return row
+
+    def _fetched(self, fetch, *args):
+        """Runs a fetch, timing it as a round-trip when the cursor is named"""
+        if self.name is None:
+            return fetch(*args)
+        return self._timed(fetch, *args, explain=False)
+
+    def _timed(self, run, *args, explain: bool = True):
+        start = perf_counter()
+        try:
+            result = run(*args)
+        except Exception:
+            query_stats.record_statement(perf_counter() - start)
+            raise
+        seconds = perf_counter() - start
+        query_stats.record_statement(seconds)
+
+        if seconds * 1000 >= query_stats.slow_query_ms:
+            self._log_slow_query(seconds, explain)
+        return result
+
+    def _log_slow_query(self, seconds: float, explain: bool) -> None:
+        plan = None
+        if explain and query_stats.explain_slow_queries and hasattr(self.connection, "explain"):
+            plan = self.connection.explain(self.query)
+        query_stats.record_slow_query(self.query, seconds, plan)
+
+
+_timed_classes = {}
+_timed_classes_lock = threading.Lock()
+
+
+def timed_cursor_class(factory: type) -> type:
+    """Returns the timed subclass of a cursor class, creating it once"""
+    with _timed_classes_lock:
+        timed = _timed_classes.get(factory)
+        if timed is None:
+            timed = _timed_classes[factory] = type(f"Timed{factory.__name__}",
+                                                   (TimedCursorMixin, factory), {})
+        return timed
+
+
+class InstrumentedConnection(connection):
+    """A psycopg2 connection whose cursors are timed; pass it as connection_factory"""
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get("cursor_factory") or self.cursor_factory or cursor
+        kwargs["cursor_factory"] = timed_cursor_class(factory)
+        return super().cursor(*args, **kwargs)
+
+    def explain(self, query: bytes) -> str:
+        """Returns the plan of an already-bound statement, or None if it cannot be explained"""
+        if not query or not query.lstrip().lower().startswith(
+                tuple(word.encode() for word in EXPLAINABLE)):
+            return None
+
+        # Inside a transaction, a failed EXPLAIN must not abort the caller's work
+        guarded = not self.autocommit
+        with super().cursor() as cur:
+            try:
+                if guarded:
+                    cur.execute("SAVEPOINT explain_slow_query")
+                cur.execute(b"EXPLAIN " + query)
+                plan = "\n".join(line for line, in cur.fetchall())
+            except DatabaseError as error:
+                plan = f"(EXPLAIN failed: {str(error).strip()})"
+                if guarded:
+                    cur.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            if guarded:
+                cur.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
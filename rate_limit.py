@@ -0,0 +1,81 @@
+"""
+Module Name: rate_limit.py
+
+Description:
+In-memory token-bucket rate limiting. Each key (a voter, a story) has a
+bucket of `burst` tokens that refills at `rate` tokens per second, and
+every request takes one token, given back if the request turns out to do
+nothing. Requests finding the bucket empty are refused along with how
+long until a token is available.
+
+Buckets are kept for at most `max_keys` keys, dropping the least
+recently used, so the limiter's memory stays bounded. A dropped key
+simply starts again with a full bucket. Limits are per process: with
+several workers, each enforces them separately.
+"""
+
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class RateLimiter:
+    """A token bucket per key"""
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000) -> None:
+        if rate <= 0 or burst < 1:
+            raise ValueError("Rate limits need rate > 0 and burst >= 1")
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # key -> (tokens, time they were counted)
+        self._allowed = 0
+        self._limited = 0
+        self._refunded = 0
+
+    def acquire(self, key: any) -> float:
+        """
+        Takes a token from a key's bucket. Returns 0 if one was available,
+        otherwise the seconds until one will be (and takes nothing)
+        """
+        now = monotonic()
+        with self._lock:
+            tokens, counted_at = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - counted_at) * self.rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+                self._allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self._limited += 1
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, key: any) -> None:
+        """Gives back a token taken by acquire, for a request that did nothing"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                tokens, counted_at = bucket
+                self._buckets[key] = (min(self.burst, tokens + 1), counted_at)
+                self._refunded += 1
+
+    def stats(self) -> dict[str, any]:
+        """Returns a snapshot of the limiter metrics"""
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "keys": len(self._buckets),
+                "allowed": self._allowed,
+                "limited": self._limited,
+                "refunded": self._refunded
+            }
@@ -0,0 +1,240 @@
+"""
+Module Name: response_cache.py
+
+Description:
+A read-through cache for GET /stories responses. Each cached page is
+stored as its serialized JSON body together with an ETag, and is tagged
+with what it depends on:
+• the ids of the stories it contains,
+• the column it is sorted by,
+• whether it is a search result.
+
+Writes then invalidate only the pages they can affect. Because pages are
+keyset paginated, a page's contents depend only on the stories within
+its own range, so editing or deleting a story only invalidates the pages
+containing it, plus the pages ordered by a column the write changed.
+New stories can land on any page, so they invalidate everything.
+
+Storage is pluggable: MemoryBackend is an in-process TTL + LRU store,
+bounded by entry count and optionally by bytes, and any object with the
+same get/set/delete/clear methods (for example one backed by a shared
+cache server) may be used instead. The tag index always lives
+in-process, so with a shared backend other workers only see a write once
+their entries expire. Backends need not report evictions: the tags of a
+page the backend has lost are dropped when its key next misses, and
+every page's tags are dropped once its TTL has passed.
+"""
+
+
+import hashlib
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable
+
+
+class MemoryBackend:
+    """
+    An in-process key-value store with per-entry TTL and LRU eviction. With
+    max_bytes, entries are also evicted once the sizes given by `sizeof`
+    add up to more than max_bytes, and a value larger than that is not kept
+    """
+
+    def __init__(self, max_entries: int = 1000,
+                 on_evict: Callable[[any], None] = None, max_bytes: int = None,
+                 sizeof: Callable[[any], int] = len) -> None:
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key: any) -> any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+            self._pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key)
+        return None
+
+    def set(self, key: any, value: any, ttl: float) -> None:
+        evicted = []
+        size = 0 if self.max_bytes is None else self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                evicted.append(key)
+                self.evictions += 1
+            else:
+                self._entries[key] = (monotonic() + ttl, value, size)
+                self.bytes += size
+            while len(self._entries) > self.max_entries or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes):
+                evicted.append(self._pop(next(iter(self._entries))))
+                self.evictions += 1
+        if self.on_evict is not None:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+
+    def delete(self, key: any) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def _pop(self, key: any) -> any:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return key
+
+
+class CachedPage:
+    """A serialized page of stories with its ETag"""
+
+    def __init__(self, body: bytes, next_cursor: str) -> None:
+        self.body = body
+        self.next_cursor = next_cursor
+        self.etag = hashlib.md5(body).hexdigest()
+
+
+class ResponseCache:
+    """Caches story pages and invalidates them by the stories they contain"""
+
+    def __init__(self, backend: any = None, ttl: float = 10.0, max_entries: int = 1000) -> None:
+        if backend is None:
+            backend = MemoryBackend(max_entries, on_evict=self._forget)
+        self.backend = backend
+        self.ttl = ttl
+
+        self._lock = threading.RLock()  # Re-entered when the backend evicts during put
+        self._by_story = {}  # story id -> keys of pages containing it
+        self._by_column = {}  # sort column -> keys of pages sorted by it
+        self._searches = set()
+        self._tags = {}  # key -> (story ids, sort column, is search, expires at), oldest first
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._invalidated_entries = 0
+
+    def get(self, key: tuple) -> CachedPage:
+        """Returns the cached page for a key, or None"""
+        page = self.backend.get(key)
+        with self._lock:
+            if page is None:
+                self._misses += 1
+                self._untag(key)  # In case the backend dropped it without reporting it
+            else:
+                self._hits += 1
+        return page
+
+    def generation(self) -> int:
+        """
+        Returns a counter that moves on every invalidation. Take it before
+        reading from the database and pass it to put, so a page read before
+        a concurrent write is not cached after that write invalidated it
+        """
+        with self._lock:
+            return self._invalidations
+
+    def put(self, key: tuple, body: bytes, next_cursor: str, story_ids: list[int],
+            sort_by: str, is_search: bool, generation: int = None) -> CachedPage:
+        """Caches a serialized page under a key, tagged with its dependencies"""
+        page = CachedPage(body, next_cursor)
+        with self._lock:
+            if generation is not None and generation != self._invalidations:
+                return page
+            self._prune_expired()
+            self._untag(key)
+            self._tags[key] = (set(story_ids), sort_by, is_search, monotonic() + self.ttl)
+            for story_id in story_ids:
+                self._by_story.setdefault(story_id, set()).add(key)
+            self._by_column.setdefault(sort_by, set()).add(key)
+            if is_search:
+                self._searches.add(key)
+            self.backend.set(key, page, self.ttl)
+        return page
+
+    def invalidate_story(self, story_id: int, changed_columns: set[str] = frozenset(),
+                         affects_search: bool = False) -> None:
+        """
+        Drops the pages containing a story, the pages sorted by any of the
+        columns it changed and, if its searchable text changed, all searches
+        """
+        with self._lock:
+            keys = set(self._by_story.get(story_id, ()))
+            for column in changed_columns:
+                keys |= self._by_column.get(column, set())
+            if affects_search:
+                keys |= self._searches
+            for key in keys:
+                self._untag(key)
+            self._invalidations += 1
+            self._invalidated_entries += len(keys)
+
+        for key in keys:
+            self.backend.delete(key)
+
+    def invalidate_all(self) -> None:
+        """Drops every cached page"""
+        with self._lock:
+            self._invalidated_entries += len(self._tags)
+            self._invalidations += 1
+            self._tags = {}
+            self._by_story = {}
+            self._by_column = {}
+            self._searches = set()
+        self.backend.clear()
+
+    def stats(self) -> dict[str, any]:
+        """Returns a snapshot of the cache metrics"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._tags),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": round(self._hits / lookups, 4) if lookups else None,
+                "invalidations": self._invalidations,
+                "invalidated_entries": self._invalidated_entries,
+                "evictions": getattr(self.backend, "evictions", None)
+            }
+
+    def _prune_expired(self) -> None:
+        """Untags the pages whose TTL has passed; as every page has the same TTL they come first"""
+        now = monotonic()
+        while self._tags:
+            key, tags = next(iter(self._tags.items()))
+            if tags[3] > now:
+                return
+            self._untag(key)
+
+    def _forget(self, key: tuple) -> None:
+        with self._lock:
+            self._untag(key)
+
+    def _untag(self, key: tuple) -> None:
+        tags = self._tags.pop(key, None)
+        if tags is None:
+            return
+        story_ids, sort_by, _, _ = tags
+        for story_id in story_ids:
+            keys = self._by_story.get(story_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_story[story_id]
+        self._by_column.get(sort_by, set()).discard(key)
+        self._searches.discard(key)
@@ -0,0 +1,88 @@
+"""
+Module Name: sampling_profiler.py
+
+Description:
+A low-overhead sampling profiler for individual requests. While running,
+a background thread looks at the profiled thread's stack every
+`interval` seconds and counts each distinct stack. The result is written
+in the "folded" format read by flamegraph tools:
+
+    api.py:get_stories;api.py:loads_stories;query_stats.py:execute 12
+
+Unlike cProfile the profiled code is not traced, so it runs at full
+speed and profiles taken under production load stay representative.
+"""
+
+
+import sys
+import threading
+from collections import Counter, OrderedDict
+from itertools import count
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread until stopped"""
+
+    def __init__(self, thread_id: int = None, interval: float = 0.005) -> None:
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "SamplingProfiler":
+        self._sampler.start()
+        return self
+
+    def stop(self) -> Counter:
+        """Stops sampling, returning the count of each folded stack"""
+        self._stopped.set()
+        self._sampler.join()
+        return self.samples
+
+    def sample(self) -> None:
+        """Takes one sample of the profiled thread's stack"""
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        """Returns the samples in folded format, most frequent stack first"""
+        return "".join(f"{stack} {n}\n" for stack, n in self.samples.most_common())
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+class ProfileStore:
+    """Keeps the folded output of the most recent profiles, by id"""
+
+    def __init__(self, max_profiles: int = 50) -> None:
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        self._profiles = OrderedDict()  # id -> (label, folded stacks)
+
+    def add(self, label: str, folded: str) -> int:
+        with self._lock:
+            profile_id = next(self._ids)
+            self._profiles[profile_id] = (label, folded)
+            while len(self._profiles) > self.max_profiles:
+                self._profiles.popitem(last=False)
+            return profile_id
+
+    def get(self, profile_id: int) -> tuple[str, str]:
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def list(self) -> list[dict[str, any]]:
+        with self._lock:
+            return [{"id": profile_id, "request": label}
+                    for profile_id, (label, _) in reversed(self._profiles.items())]
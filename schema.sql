@@ -0,0 +1,218 @@
+-- Schema for the social_news database.
+-- Every statement is safe to re-run against an existing database.
+
+CREATE TABLE IF NOT EXISTS stories (
+    id SERIAL PRIMARY KEY,
+    title TEXT NOT NULL,
+    url TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS votes (
+    id SERIAL PRIMARY KEY,
+    direction TEXT NOT NULL CHECK (direction IN ('up', 'down')),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    story_id INT NOT NULL REFERENCES stories (id) ON DELETE CASCADE
+);
+
+-- Keyset pagination indexes, one per sortable column of GET /stories
+CREATE INDEX IF NOT EXISTS stories_title_id_idx ON stories (title, id);
+CREATE INDEX IF NOT EXISTS stories_created_at_id_idx ON stories (created_at, id);
+CREATE INDEX IF NOT EXISTS stories_updated_at_id_idx ON stories (updated_at, id);
+
+-- Scores are maintained on each vote instead of aggregated from votes on read.
+-- `flask --app api reconcile-scores` rebuilds them from the votes table.
+ALTER TABLE stories ADD COLUMN IF NOT EXISTS score INT NOT NULL DEFAULT 0;
+ALTER TABLE stories ADD COLUMN IF NOT EXISTS upvotes INT NOT NULL DEFAULT 0;
+ALTER TABLE stories ADD COLUMN IF NOT EXISTS downvotes INT NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS stories_score_id_idx ON stories (score, id);
+
+-- Full-text search over titles (weight A) and the words of urls (weight B).
+-- The expression must match SEARCH_VECTOR in api.py for the index to be used.
+CREATE INDEX IF NOT EXISTS stories_search_idx ON stories USING GIN (
+    (setweight(to_tsvector('english', title), 'A') ||
+     setweight(to_tsvector('english', regexp_replace(url, '[^[:alnum:]]+', ' ', 'g')), 'B'))
+);
+
+-- Backs the hot ranking of GET /stories/hot.
+-- The expression must match HOT_SCORE_SQL in api.py for the index to be used.
+CREATE INDEX IF NOT EXISTS stories_hot_idx ON stories (
+    (SIGN(score) * LOG(GREATEST(ABS(score), 1)) + EXTRACT(EPOCH FROM created_at) / 45000) DESC,
+    id DESC
+);
+
+-- Keeps one story per url, so concurrent scrapes cannot both insert the same story:
+-- the scraper's ON CONFLICT (md5(url)) relies on it. Replaces the non-unique
+-- stories_url_md5_idx; duplicate urls already stored must be deleted before it builds.
+DROP INDEX IF EXISTS stories_url_md5_idx;
+CREATE UNIQUE INDEX IF NOT EXISTS stories_url_md5_key ON stories (md5(url));
+
+-- Each voter has one vote per story: voting again replaces the direction.
+-- Votes cast before voters were recorded keep a NULL voter_id.
+ALTER TABLE votes ADD COLUMN IF NOT EXISTS voter_id TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS votes_voter_id_story_id_idx ON votes (voter_id, story_id);
+
+-- Rollups backing the /stats endpoints, so dashboards never aggregate stories or votes.
+-- The statement-level triggers below keep them current on every write, whether from
+-- the API, the bulk import or the scraper, with one write per statement.
+-- Reads of domain_stats first fold in the logged score changes, and
+-- `flask --app api fold-stats`, run from cron, keeps the log short between reads;
+-- `flask --app api compact-stats` folds old hourly vote buckets into daily ones, and
+-- `flask --app api rebuild-stats` rebuilds everything from the stories and votes tables.
+CREATE OR REPLACE FUNCTION story_domain(url TEXT) RETURNS TEXT
+LANGUAGE SQL IMMUTABLE PARALLEL SAFE AS $$
+    SELECT COALESCE(lower(regexp_replace(
+        substring(url FROM '^(?:[[:alpha:]][[:alnum:]+.-]*://)?([^/?#]*)'),
+        '^www\.|:[0-9]*$', '', 'g')), '')
+$$;
+
+CREATE TABLE IF NOT EXISTS domain_stats (
+    domain TEXT PRIMARY KEY,
+    stories INT NOT NULL DEFAULT 0,
+    score INT NOT NULL DEFAULT 0,
+    upvotes INT NOT NULL DEFAULT 0,
+    downvotes INT NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS domain_stats_stories_idx ON domain_stats (stories DESC, domain);
+CREATE INDEX IF NOT EXISTS domain_stats_score_idx ON domain_stats (score DESC, domain);
+
+-- Score changes of stories not yet added to their domain's totals. Votes append here
+-- rather than update a domain_stats row that every vote on the domain would wait on.
+CREATE TABLE IF NOT EXISTS domain_stat_changes (
+    domain TEXT NOT NULL,
+    score INT NOT NULL,
+    upvotes INT NOT NULL,
+    downvotes INT NOT NULL
+);
+
+-- Net votes per story and hour, or per day once compacted. A new vote adds one to its
+-- direction, and a changed vote takes one from its old direction and adds one to the new,
+-- so upvotes - downvotes is the change in score. Counts can be negative.
+-- Buckets outlive their story, so activity totals do not change when stories are deleted.
+CREATE TABLE IF NOT EXISTS vote_buckets (
+    granularity TEXT NOT NULL CHECK (granularity IN ('hour', 'day')),
+    bucket TIMESTAMP NOT NULL,
+    story_id INT NOT NULL,
+    upvotes INT NOT NULL DEFAULT 0,
+    downvotes INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (granularity, bucket, story_id)
+);
+
+-- Adds each statement's new story rows to their domain's totals and takes its old rows
+-- away, so an edit moving a story to another domain moves its counts too. Updates that
+-- keep the domain, as votes do, only log their score changes to domain_stat_changes.
+CREATE OR REPLACE FUNCTION roll_up_story_changes() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO domain_stats AS stats (domain, stories, score, upvotes, downvotes)
+        SELECT story_domain(url), COUNT(*), SUM(score), SUM(upvotes), SUM(downvotes)
+        FROM new_rows
+        GROUP BY 1
+        ON CONFLICT (domain) DO UPDATE
+        SET stories = stats.stories + EXCLUDED.stories,
+        score = stats.score + EXCLUDED.score,
+        upvotes = stats.upvotes + EXCLUDED.upvotes,
+        downvotes = stats.downvotes + EXCLUDED.downvotes;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE domain_stats AS stats
+        SET stories = stats.stories - removed.stories,
+        score = stats.score - removed.score,
+        upvotes = stats.upvotes - removed.upvotes,
+        downvotes = stats.downvotes - removed.downvotes
+        FROM (SELECT story_domain(url) AS domain, COUNT(*) AS stories, SUM(score) AS score,
+              SUM(upvotes) AS upvotes, SUM(downvotes) AS downvotes
+              FROM old_rows
+              GROUP BY 1) AS removed
+        WHERE stats.domain = removed.domain;
+    ELSE
+        WITH changes AS (
+            SELECT story_domain(old_rows.url) AS old_domain, story_domain(new_rows.url) AS domain,
+            old_rows.score AS old_score, old_rows.upvotes AS old_upvotes,
+            old_rows.downvotes AS old_downvotes,
+            new_rows.score, new_rows.upvotes, new_rows.downvotes
+            FROM new_rows
+            JOIN old_rows ON (old_rows.id = new_rows.id)
+        ),
+        moved AS (
+            INSERT INTO domain_stats AS stats (domain, stories, score, upvotes, downvotes)
+            SELECT domain, SUM(stories), SUM(score), SUM(upvotes), SUM(downvotes)
+            FROM (SELECT domain, 1 AS stories, score, upvotes, downvotes
+                  FROM changes
+                  WHERE domain <> old_domain
+                  UNION ALL
+                  SELECT old_domain, -1, -old_score, -old_upvotes, -old_downvotes
+                  FROM changes
+                  WHERE domain <> old_domain) AS moves
+            GROUP BY domain
+            ON CONFLICT (domain) DO UPDATE
+            SET stories = stats.stories + EXCLUDED.stories,
+            score = stats.score + EXCLUDED.score,
+            upvotes = stats.upvotes + EXCLUDED.upvotes,
+            downvotes = stats.downvotes + EXCLUDED.downvotes
+        )
+        INSERT INTO domain_stat_changes (domain, score, upvotes, downvotes)
+        SELECT domain, SUM(score - old_score), SUM(upvotes - old_upvotes),
+        SUM(downvotes - old_downvotes)
+        FROM changes
+        WHERE domain = old_domain
+        GROUP BY domain
+        HAVING (SUM(score - old_score), SUM(upvotes - old_upvotes),
+                SUM(downvotes - old_downvotes)) <> (0, 0, 0);
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+-- Counts each statement's new votes, and votes changing direction, into hourly buckets
+CREATE OR REPLACE FUNCTION roll_up_vote_changes() RETURNS TRIGGER
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO vote_buckets AS buckets (granularity, bucket, story_id, upvotes, downvotes)
+        SELECT 'hour', date_trunc('hour', updated_at), story_id,
+        COUNT(*) FILTER (WHERE direction = 'up'), COUNT(*) FILTER (WHERE direction = 'down')
+        FROM new_rows
+        GROUP BY 2, 3
+        ON CONFLICT (granularity, bucket, story_id) DO UPDATE
+        SET upvotes = buckets.upvotes + EXCLUDED.upvotes,
+        downvotes = buckets.downvotes + EXCLUDED.downvotes;
+    ELSE
+        INSERT INTO vote_buckets AS buckets (granularity, bucket, story_id, upvotes, downvotes)
+        SELECT 'hour', date_trunc('hour', new_rows.updated_at), new_rows.story_id,
+        SUM(CASE new_rows.direction WHEN 'up' THEN 1 ELSE -1 END),
+        SUM(CASE new_rows.direction WHEN 'down' THEN 1 ELSE -1 END)
+        FROM new_rows
+        JOIN old_rows ON (old_rows.id = new_rows.id)
+        WHERE new_rows.direction <> old_rows.direction
+        GROUP BY 2, 3
+        ON CONFLICT (granularity, bucket, story_id) DO UPDATE
+        SET upvotes = buckets.upvotes + EXCLUDED.upvotes,
+        downvotes = buckets.downvotes + EXCLUDED.downvotes;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS stories_insert_roll_up ON stories;
+CREATE TRIGGER stories_insert_roll_up AFTER INSERT ON stories
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_story_changes();
+DROP TRIGGER IF EXISTS stories_update_roll_up ON stories;
+CREATE TRIGGER stories_update_roll_up AFTER UPDATE ON stories
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_story_changes();
+DROP TRIGGER IF EXISTS stories_delete_roll_up ON stories;
+CREATE TRIGGER stories_delete_roll_up AFTER DELETE ON stories
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_story_changes();
+DROP TRIGGER IF EXISTS votes_insert_roll_up ON votes;
+CREATE TRIGGER votes_insert_roll_up AFTER INSERT ON votes
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_vote_changes();
+DROP TRIGGER IF EXISTS votes_update_roll_up ON votes;
+CREATE TRIGGER votes_update_roll_up AFTER UPDATE ON votes
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION roll_up_vote_changes();
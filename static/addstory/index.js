@@ -13,7 +13,7 @@ window.onload = async function load() {
     const url = urlComponent.value
     const title = titleComponent.value
 
-    const response = await fetch('/stories', {
+    const response = await fetch('/stories?return=row', {
       method: 'POST',
       body: JSON.stringify({ url, title }),
       headers: {
@@ -2,6 +2,22 @@ function getUrl() {
   return window.location.href
 }
 
+// crypto.randomUUID only exists on HTTPS and localhost pages, while
+// crypto.getRandomValues works over plain HTTP too
+function randomId() {
+  const bytes = crypto.getRandomValues(new Uint8Array(16))
+  return Array.from(bytes, (byte) => byte.toString(16).padStart(2, '0')).join('')
+}
+
+function getVoterId() {
+  let voterId = localStorage.getItem('voterId')
+  if (!voterId) {
+    voterId = randomId()
+    localStorage.setItem('voterId', voterId)
+  }
+  return voterId
+}
+
 function resetStories() {
   const stories = document.getElementById('stories')
   stories.innerHTML = ''
@@ -43,34 +59,120 @@ async function handleEdit(id, url, title) {
   const newUrl = prompt('Enter new URL', url)
   const newTitle = prompt('Enter new Title', title)
 
-  const res = await fetch(`${getUrl()}/stories/${id}`, {
-    method: 'PATCH',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ url: newUrl, title: newTitle }),
-    credentials: 'include'
-  })
+  if (newUrl === null || newTitle === null) {
+    return
+  }
+
+  queueAction({ op: 'edit', id: Number(id), url: newUrl, title: newTitle })
+}
+
+// Actions are coalesced into one POST /stories/batch, sent once no new
+// action has arrived for BATCH_DELAY_MS, the batch is full or the page is
+// left. A send failing with a network or server error is retried with the
+// same Idempotency-Key, so a batch that was applied is not applied twice
+const BATCH_DELAY_MS = 300
+const MAX_BATCH_ACTIONS = 100
+const MAX_SEND_ATTEMPTS = 3
+const RETRY_DELAY_MS = 1000
+let pendingActions = []
+let batchTimer = null
+
+function queueAction(action) {
+  if (action.op === 'vote') {
+    // Only the last vote on a story counts, so earlier ones need not be sent
+    pendingActions = pendingActions.filter(
+      (pending) => !(pending.op === 'vote' && pending.id === action.id)
+    )
+  }
+  pendingActions.push(action)
+
+  clearTimeout(batchTimer)
+  if (pendingActions.length >= MAX_BATCH_ACTIONS) {
+    sendActions()
+  } else {
+    batchTimer = setTimeout(sendActions, BATCH_DELAY_MS)
+  }
+}
+
+async function postActions(actions, keepalive) {
+  const key = randomId()
+
+  for (let attempt = 1; ; attempt++) {
+    try {
+      const res = await fetch(`${getUrl()}/stories/batch`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Voter-Id': getVoterId(),
+          'Idempotency-Key': key
+        },
+        body: JSON.stringify(actions),
+        credentials: 'include',
+        keepalive
+      })
+      if (res.status < 500 || attempt >= MAX_SEND_ATTEMPTS) {
+        return res
+      }
+    } catch (error) {
+      if (attempt >= MAX_SEND_ATTEMPTS) {
+        throw error
+      }
+    }
+    await new Promise((resolve) => setTimeout(resolve, RETRY_DELAY_MS * attempt))
+  }
+}
+
+async function sendActions(keepalive = false) {
+  const actions = pendingActions
+  pendingActions = []
+  clearTimeout(batchTimer)
+  batchTimer = null
+
+  if (!actions.length) {
+    return
+  }
+
+  let res
+  try {
+    res = await postActions(actions, keepalive)
+  } catch (error) {
+    alert(`Your changes could not be sent: ${error.message}`)
+    return
+  }
+
+  if (keepalive) {
+    return
+  }
 
   if (res.status >= 300) {
     onError(res)
+    return
   }
 
-  const data = await res.json()
+  const results = await res.json()
+  const failures = results.filter((result) => result.status !== 200)
 
-  if (data.error || data.message) {
-    alert(data.message)
+  if (failures.length) {
+    alert(failures.map((result) => `Story ${result.id}: ${result.message}`).join('\n'))
   }
 
   getStories()
 }
 
-async function getStories() {
+let nextCursor = null
+
+async function getStories(cursor = null) {
   const searchTerm = document.getElementById('search_input').value
   const sort = document.getElementById('sort').value
   const order = document.getElementById('order').value
-  let url = `${getUrl()}/stories?sort=${sort}&order=${order}`
+  let url = `${getUrl()}/stories?sort_by=${sort}&order_by=${order}`
 
   if (searchTerm) {
-    url += `&search=${searchTerm}`
+    url += `&search=${encodeURIComponent(searchTerm)}`
+  }
+
+  if (cursor) {
+    url += `&cursor=${cursor}`
   }
 
   console.log(`Stories Requested From: ${url}`)
@@ -93,7 +195,12 @@ async function getStories() {
     alert(data.message)
   }
 
-  resetStories()
+  nextCursor = res.headers.get('X-Next-Cursor')
+  document.getElementById('more_stories').hidden = !nextCursor
+
+  if (!cursor) {
+    resetStories()
+  }
   displayStories(data)
 }
 
@@ -103,57 +210,21 @@ function onError(response) {
   )
 }
 
-async function handleVote(e) {
+function handleVote(e) {
   const elemID = e.target.id.split('-')
   const id = elemID[0]
   const direction = elemID[1]
 
-  const rawRes = await fetch(`${getUrl()}/stories/${id}/votes`, {
-    method: 'POST',
-    headers: { 'Content-Type': 'application/json' },
-    body: JSON.stringify({ direction }),
-    credentials: 'include'
-  })
-
-  if (rawRes.status >= 300) {
-    onError(rawRes)
-  }
-
-  const data = await rawRes.json()
-
-  if (data.error || data.message) {
-    alert(data.message)
-  }
-
-  getStories()
+  queueAction({ op: 'vote', id: Number(id), direction })
 }
 
-async function handleDelete(e) {
+function handleDelete(e) {
   const elemID = e.target.id.split('-')
   const id = elemID[0]
-  const direction = elemID[1]
 
-  console.log(`'${direction}' Delete Button Clicked`)
+  console.log(`Delete Button Clicked for Story ${id}`)
 
-  const rawRes = await fetch(`${getUrl()}/stories/${id}`, {
-    method: 'DELETE',
-    headers: { 'Content-Type': 'application/json' },
-    credentials: 'include'
-  })
-
-  if (rawRes.status >= 300) {
-    onError(rawRes)
-  }
-
-  const data = await rawRes.json()
-
-  console.log('Delete Response Received: ')
-
-  if (data.error || data.message) {
-    alert(data.message)
-  }
-
-  getStories()
+  queueAction({ op: 'delete', id: Number(id) })
 }
 
 function getContentComponent(story) {
@@ -215,6 +286,14 @@ function setupSelects() {
   }
 }
 
+function setupMore() {
+  const more = document.getElementById('more_stories')
+
+  more.onclick = () => {
+    getStories(nextCursor)
+  }
+}
+
 function setupSearch() {
   const search = document.getElementById('search')
 
@@ -223,8 +302,14 @@ function setupSearch() {
   }
 }
 
+// Queued actions would be lost with the page, so they are sent as it goes
+window.addEventListener('pagehide', () => {
+  sendActions(true)
+})
+
 window.onload = async function load() {
   getStories()
   setupSelects()
   setupSearch()
+  setupMore()
 }
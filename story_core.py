@@ -0,0 +1,294 @@
+"""
+Module Name: story_core.py
+
+Description:
+The parts of the social news API that do not depend on a web framework,
+shared by the Flask app in api.py and the Quart app in asgi_api.py so
+both serve identical responses:
+• the SQL statements of the story and vote routes,
+• building keyset-paginated story listings and their cursors,
+• ETags, voter identities and the bookkeeping of vote rate limits,
+• the bodies of the error responses both apps send.
+Statements are psycopg2 composables; asgi_api.py rebuilds them for
+psycopg 3. Nothing here reads a request or holds a connection.
+"""
+
+
+import base64
+import hashlib
+import json
+import math
+from datetime import datetime
+
+from psycopg2 import sql
+
+from hot_ranking import HOT_DECAY_SECONDS
+from rate_limit import RateLimiter
+
+
+# Columns /stories may be sorted by; each has a (column, id) index in schema.sql
+SORT_COLUMNS = {"id", "title", "score", "created_at", "updated_at"}
+STORY_FIELDS = {"id", "title", "url", "score", "upvotes", "downvotes", "created_at", "updated_at"}
+# Must match the expression of stories_search_idx in schema.sql for the index to be used
+SEARCH_VECTOR = sql.SQL("""(setweight(to_tsvector('english', title), 'A') ||
+                         setweight(to_tsvector('english',
+                                               regexp_replace(url, '[^[:alnum:]]+', ' ', 'g')), 'B'))""")
+# Must match hot_score() in hot_ranking.py and stories_hot_idx in schema.sql
+HOT_SCORE_SQL = sql.SQL("""(SIGN(score) * LOG(GREATEST(ABS(score), 1))
+                         + EXTRACT(EPOCH FROM created_at) / {})""").format(sql.Literal(HOT_DECAY_SECONDS))
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+# Columns changed by each kind of story write, for invalidating cached pages sorted by them
+EDIT_COLUMNS = {"title", "url", "updated_at"}
+VOTE_COLUMNS = {"score", "upvotes", "downvotes", "updated_at"}
+# Longest X-Voter-Id header accepted
+MAX_VOTER_ID_LENGTH = 128
+# The unique index keeping one story per url, in schema.sql
+STORY_URL_CONSTRAINT = "stories_url_md5_key"
+
+# Statements run by both apps; asgi_api.py converts them for psycopg 3
+SELECT_ALL_STORIES = sql.SQL("""SELECT * FROM stories ORDER BY id""")
+SELECT_HOT_STORIES = sql.SQL("""SELECT * FROM stories ORDER BY {} DESC, id DESC LIMIT %s""") \
+    .format(HOT_SCORE_SQL)
+SELECT_STORIES_FINGERPRINT = sql.SQL("""SELECT COUNT(*), MAX(id), MAX(updated_at) FROM stories""")
+INSERT_STORY = sql.SQL("""INSERT INTO stories (title, url, created_at, updated_at)
+                       VALUES (%s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                       RETURNING *""")
+UPDATE_STORY = sql.SQL("""UPDATE stories
+                       SET url = %s,
+                       title = %s,
+                       updated_at = CURRENT_TIMESTAMP
+                       WHERE id = %s
+                       RETURNING *""")
+DELETE_STORY = sql.SQL("""DELETE FROM stories
+                       WHERE id = %s
+                       RETURNING *""")
+# Upserts new_votes, at most one per voter and story, into votes and applies the change
+# to each story's score: a new vote moves it by 1, a vote changing direction by 2, and a
+# repeated vote not at all. A changed vote is an update of an existing row, so its xmax is
+# set. Votes for missing stories are dropped, and `story` holds the updated stories
+UPSERT_VOTES = sql.SQL("""WITH new_votes (voter_id, story_id, direction) AS (
+                           VALUES {}
+                       ),
+                       vote AS (
+                           INSERT INTO votes (direction, created_at, updated_at, story_id, voter_id)
+                           SELECT new_votes.direction, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP,
+                           new_votes.story_id, new_votes.voter_id
+                           FROM new_votes
+                           JOIN stories ON (stories.id = new_votes.story_id)
+                           ON CONFLICT (voter_id, story_id) DO UPDATE
+                           SET direction = EXCLUDED.direction,
+                           updated_at = EXCLUDED.updated_at
+                           WHERE votes.direction <> EXCLUDED.direction
+                           RETURNING story_id, direction, xmax = 0 AS inserted
+                       ),
+                       deltas AS (
+                           SELECT story_id,
+                           SUM(CASE WHEN direction = 'up' THEN 1 ELSE -1 END
+                               * CASE WHEN inserted THEN 1 ELSE 2 END) AS score,
+                           COUNT(*) FILTER (WHERE direction = 'up')
+                           - COUNT(*) FILTER (WHERE direction = 'down' AND NOT inserted) AS upvotes,
+                           COUNT(*) FILTER (WHERE direction = 'down')
+                           - COUNT(*) FILTER (WHERE direction = 'up' AND NOT inserted) AS downvotes
+                           FROM vote
+                           GROUP BY story_id
+                       ),
+                       story AS (
+                           UPDATE stories
+                           SET score = stories.score + deltas.score,
+                           upvotes = stories.upvotes + deltas.upvotes,
+                           downvotes = stories.downvotes + deltas.downvotes,
+                           updated_at = CURRENT_TIMESTAMP
+                           FROM deltas
+                           WHERE stories.id = deltas.story_id
+                           RETURNING stories.*
+                       )
+                       """)
+# Returns the story even when a repeated vote left it unchanged
+INSERT_VOTE = UPSERT_VOTES.format(sql.SQL("(%s, %s, %s)")) + sql.SQL("""SELECT * FROM story
+                       UNION ALL
+                       SELECT stories.* FROM stories
+                       JOIN new_votes ON (stories.id = new_votes.story_id)
+                       WHERE NOT EXISTS (SELECT 1 FROM story)""")
+
+
+def encode_cursor(row: dict[str, any], sort_by: str) -> str:
+    """Encodes the position just after a row as an opaque pagination cursor"""
+    position = json.dumps([row[sort_by], row["id"]], default=str)
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def valid_sort_value(value: any, sort_by: str) -> bool:
+    """Checks that a cursor's sort value has the type of the column it is compared with"""
+    if sort_by in {"id", "score"}:
+        return isinstance(value, int) and not isinstance(value, bool)
+    if sort_by == "relevance":
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if sort_by in {"created_at", "updated_at"}:
+        try:
+            datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return False
+        return True
+    return isinstance(value, str)
+
+
+def decode_cursor(cursor: str, sort_by: str) -> list:
+    """
+    Decodes a pagination cursor into its [sort value, id] pair, checking
+    it was made for the given sort
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid 'cursor'")
+    if (not isinstance(position, list) or len(position) != 2
+            or not isinstance(position[1], int) or isinstance(position[1], bool)
+            or not valid_sort_value(position[0], sort_by)):
+        raise ValueError("Invalid 'cursor'")
+    return position
+
+
+def build_stories_query(sort_by: str, order_by: str, search: str, cursor: str = None,
+                        fields: list[str] = None, limit: int = None) -> tuple[sql.Composed, dict]:
+    """
+    Builds the query listing stories with a given sort, order, search,
+    starting cursor and fields, returning it with its parameters.
+    With a limit, the columns needed to build the next cursor are always
+    selected. Raises ValueError for arguments outside the allowlists
+    """
+    if sort_by not in SORT_COLUMNS | {"relevance"}:
+        raise ValueError("'sort_by' only takes "
+                         f"{', '.join(sorted(SORT_COLUMNS | {'relevance'}))} as values")
+    if sort_by == "relevance" and search is None:
+        raise ValueError("'sort_by' can only be 'relevance' with a 'search'")
+    if order_by not in {"ASC", "DESC"}:
+        raise ValueError("'order_by' only takes 'ASC', 'DESC' as values")
+    if fields is not None and not set(fields) <= STORY_FIELDS:
+        raise ValueError(f"'fields' only takes {', '.join(sorted(STORY_FIELDS))} as values")
+
+    conditions = []
+    params = {}
+
+    if fields is None:
+        columns = sql.SQL("*")
+    else:
+        selected = list(fields)
+        if limit is not None:
+            selected = list(dict.fromkeys([*selected, "id"]))
+        if limit is not None and sort_by != "relevance":
+            selected = list(dict.fromkeys([*selected, sort_by]))
+        columns = sql.SQL(", ").join(map(sql.Identifier, selected))
+
+    sort_key = sql.Identifier(sort_by)
+    after_value = sql.SQL("%(after_value)s")
+
+    if search is not None:
+        conditions.append(sql.SQL("{} @@ websearch_to_tsquery('english', %(search)s)")
+                          .format(SEARCH_VECTOR))
+        params["search"] = search
+
+    if sort_by == "relevance":
+        sort_key = sql.SQL("ts_rank({}, websearch_to_tsquery('english', %(search)s))") \
+            .format(SEARCH_VECTOR)
+        columns = sql.SQL("{}, {} AS relevance").format(columns, sort_key)
+        # ts_rank returns a real, so compare cursors at the same precision
+        after_value = sql.SQL("CAST(%(after_value)s AS real)")
+
+    if cursor is not None:
+        conditions.append(sql.SQL("({}, id) {} ({}, %(after_id)s)").format(
+            sort_key, sql.SQL(">" if order_by == "ASC" else "<"), after_value))
+        params["after_value"], params["after_id"] = decode_cursor(cursor, sort_by)
+
+    where = sql.SQL("")
+    if conditions:
+        where = sql.SQL("WHERE ") + sql.SQL(" AND ").join(conditions)
+
+    limit_clause = sql.SQL("")
+    if limit is not None:
+        limit_clause = sql.SQL("LIMIT %(limit)s")
+        params["limit"] = limit
+
+    query = sql.SQL("""SELECT {} FROM stories {}
+                    ORDER BY {} {}, id {}
+                    {}""").format(columns, where, sort_key, sql.SQL(order_by), sql.SQL(order_by),
+                                  limit_clause)
+    return query, params
+
+
+def paginate(rows: list[dict[str, any]], sort_by: str, limit: int,
+             fields: list[str] = None) -> tuple[list[dict[str, any]], str]:
+    """
+    Cuts the `limit` + 1 rows read for a page down to the page and the
+    cursor of the next page, keeping only the requested fields
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1], sort_by)
+
+    if fields is not None:
+        rows = [{field: row[field] for field in fields} for row in rows]
+
+    return rows, next_cursor
+
+
+def vote_params(voter_id: str, id: int, direction: str) -> tuple:
+    """Returns the parameters of INSERT_VOTE for one vote"""
+    return voter_id, id, direction
+
+
+def fingerprint_etag(fingerprint: tuple) -> str:
+    """Hashes a (count, highest id, latest updated_at) fingerprint into an ETag"""
+    return hashlib.md5(repr(tuple(fingerprint)).encode()).hexdigest()
+
+
+def identify_voter(address: str, header: str = None) -> str:
+    """
+    Identifies who is voting: the client's address, qualified by the
+    X-Voter-Id header set by the frontend when there is one. The header
+    alone never names a voter, as clients choose it freely. Raises
+    ValueError for an oversized header
+    """
+    address = address or "unknown"
+    if header and len(header) > MAX_VOTER_ID_LENGTH:
+        raise ValueError(f"'X-Voter-Id' must be at most {MAX_VOTER_ID_LENGTH} characters")
+    return f"{address} {header}" if header else address
+
+
+def take_vote_tokens(limits: list[tuple[RateLimiter, any]]) -> float:
+    """
+    Takes a vote's token from each (limiter, key) bucket in turn. Returns
+    0, or the seconds to wait when one of them is empty, in which case
+    the tokens already taken are given back
+    """
+    for taken, (limiter, key) in enumerate(limits):
+        wait = limiter.acquire(key)
+        if wait:
+            for limiter, key in limits[:taken]:
+                limiter.refund(key)
+            return wait
+    return 0
+
+
+def refund_vote_tokens(limits: list[tuple[RateLimiter, any]]) -> None:
+    """Gives back the tokens take_vote_tokens took, for a vote that was not cast"""
+    for limiter, key in limits:
+        limiter.refund(key)
+
+
+def too_many_votes(wait: float) -> tuple[dict[str, any], int, dict[str, str]]:
+    """Answers a vote refused by a rate limit or a full vote buffer"""
+    return {"error": True, "message": "Too many votes right now, please try again."}, \
+        429, {"Retry-After": str(max(1, math.ceil(wait)))}
+
+
+def duplicate_url(error: Exception) -> tuple[dict[str, any], int]:
+    """
+    Answers 409 when a new or edited story would repeat a stored story's
+    url. Takes the unique violation raised by psycopg2 or psycopg 3, and
+    raises any other one again
+    """
+    if error.diag.constraint_name != STORY_URL_CONSTRAINT:
+        raise error
+    return {"error": True, "message": "A story with this 'url' already exists"}, 409
@@ -0,0 +1,240 @@
+"""
+Module Name: story_stats.py
+
+Description:
+Reads the precomputed aggregates behind the /stats endpoints, and keeps
+them compact. Two rollup tables are maintained by triggers in schema.sql
+on every write to stories and votes:
+• domain_stats holds the story count, score and votes of each domain,
+• vote_buckets holds the net votes per story and hour, a changed vote
+  counting -1 in its old direction and +1 in its new one.
+Queries only ever read the rollups, so their cost depends on the number
+of domains and buckets asked for, not on the number of stories or votes.
+
+Votes do not update domain_stats, whose rows every vote on a popular
+domain would queue on. Their score changes are appended to
+domain_stat_changes instead, and folded into domain_stats before each
+read of the domains, so reads always include every vote. The log only
+grows between reads; schedule a fold (e.g. every minute from cron) to
+keep it short when the domains are rarely read:
+    flask --app api fold-stats
+Hourly buckets older than a retention period are folded into daily ones
+by compaction, which also drops daily buckets past their own retention:
+    flask --app api compact-stats --keep-hours 48 --keep-days 365
+Hourly activity is only served for the STATS_HOURLY_RETENTION hours that
+compaction keeps, so compacted hours are never reported as empty.
+After a restore, or when installing the rollups on an existing database,
+they can be rebuilt from the stories and votes tables:
+    flask --app api rebuild-stats
+"""
+
+
+from datetime import timedelta
+from os import environ
+
+import psycopg2.extras
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+
+DOMAIN_SORTS = {"stories", "score"}
+GRANULARITIES = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+# Hours kept in hourly buckets by compaction, and so the most hours /stats/votes serves
+HOURLY_RETENTION = int(environ.get("STATS_HOURLY_RETENTION", 48))
+DEFAULT_PERIODS = {"hour": min(24, HOURLY_RETENTION), "day": 30}
+MAX_PERIODS = {"hour": HOURLY_RETENTION, "day": 366}
+MAX_MOVER_HOURS = 24 * 30
+VOTE_BUCKET_COUNTS = sql.SQL("""SUM(upvotes) AS upvotes, SUM(downvotes) AS downvotes""")
+
+SELECT_DOMAIN_STATS = sql.SQL("""SELECT domain, stories, score, upvotes, downvotes
+                              FROM domain_stats
+                              WHERE stories > 0
+                              ORDER BY {} DESC, domain
+                              LIMIT %s""")
+# One row per hour or day of the period, including those without votes. Days also
+# count the hourly buckets not yet compacted
+SELECT_VOTE_ACTIVITY = sql.SQL("""SELECT periods.bucket,
+                               COALESCE(SUM(upvotes), 0) AS upvotes,
+                               COALESCE(SUM(downvotes), 0) AS downvotes
+                               FROM generate_series(
+                                   date_trunc(%(granularity)s, LOCALTIMESTAMP) - %(span)s,
+                                   date_trunc(%(granularity)s, LOCALTIMESTAMP),
+                                   %(step)s
+                               ) AS periods (bucket)
+                               LEFT JOIN vote_buckets
+                               ON (vote_buckets.granularity = ANY(%(granularities)s)
+                                   AND vote_buckets.bucket >= periods.bucket
+                                   AND vote_buckets.bucket < periods.bucket + %(step)s)
+                               GROUP BY periods.bucket
+                               ORDER BY periods.bucket""")
+# Windows reaching back past the compacted hours are counted in whole days
+SELECT_TOP_MOVERS = sql.SQL("""SELECT stories.id, stories.title, stories.url, stories.score,
+                            movers.upvotes, movers.downvotes,
+                            movers.upvotes - movers.downvotes AS change
+                            FROM (SELECT story_id, {}
+                                  FROM vote_buckets
+                                  WHERE granularity IN ('hour', 'day')
+                                  AND bucket >= date_trunc('hour', LOCALTIMESTAMP) - %(span)s
+                                  GROUP BY story_id) AS movers
+                            JOIN stories ON (stories.id = movers.story_id)
+                            ORDER BY change {}, stories.id
+                            LIMIT %(limit)s""")
+# Adds the logged score changes to their domains' totals and removes them from the log
+FOLD_DOMAIN_CHANGES = sql.SQL("""WITH changes AS (
+                                  DELETE FROM domain_stat_changes
+                                  RETURNING domain, score, upvotes, downvotes
+                              ),
+                              folded AS (
+                                  INSERT INTO domain_stats AS stats (domain, score, upvotes, downvotes)
+                                  SELECT domain, SUM(score), SUM(upvotes), SUM(downvotes)
+                                  FROM changes
+                                  GROUP BY domain
+                                  ON CONFLICT (domain) DO UPDATE
+                                  SET score = stats.score + EXCLUDED.score,
+                                  upvotes = stats.upvotes + EXCLUDED.upvotes,
+                                  downvotes = stats.downvotes + EXCLUDED.downvotes
+                                  RETURNING 1
+                              )
+                              SELECT (SELECT COUNT(*) FROM changes) AS changes,
+                              (SELECT COUNT(*) FROM folded) AS domains""")
+# Compacts whole days, and expires nothing when keep_days is NULL. The statement's parts
+# share a snapshot, so daily buckets written by a run are only expired by the next one
+COMPACT_VOTE_BUCKETS = sql.SQL("""WITH hourly AS (
+                                   DELETE FROM vote_buckets
+                                   WHERE granularity = 'hour'
+                                   AND bucket < date_trunc('day', LOCALTIMESTAMP - %(keep_hours)s)
+                                   RETURNING bucket, story_id, upvotes, downvotes
+                               ),
+                               daily AS (
+                                   INSERT INTO vote_buckets AS buckets
+                                   (granularity, bucket, story_id, upvotes, downvotes)
+                                   SELECT 'day', date_trunc('day', bucket), story_id, {}
+                                   FROM hourly
+                                   GROUP BY 2, 3
+                                   ON CONFLICT (granularity, bucket, story_id) DO UPDATE
+                                   SET upvotes = buckets.upvotes + EXCLUDED.upvotes,
+                                   downvotes = buckets.downvotes + EXCLUDED.downvotes
+                                   RETURNING 1
+                               ),
+                               expired AS (
+                                   DELETE FROM vote_buckets
+                                   WHERE granularity = 'day'
+                                   AND bucket < date_trunc('day', LOCALTIMESTAMP) - %(keep_days)s::interval
+                                   RETURNING 1
+                               )
+                               SELECT (SELECT COUNT(*) FROM hourly) AS compacted,
+                               (SELECT COUNT(*) FROM daily) AS daily,
+                               (SELECT COUNT(*) FROM expired) AS expired""") \
+    .format(VOTE_BUCKET_COUNTS)
+
+
+def load_domain_stats(conn: connection, sort_by: str, limit: int) -> list[dict[str, any]]:
+    """
+    Loads the domains with the most stories or the highest total score,
+    first folding in the score changes logged since the last read
+    """
+    if sort_by not in DOMAIN_SORTS:
+        raise ValueError(f"Domains are sorted by one of {sorted(DOMAIN_SORTS)}")
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(FOLD_DOMAIN_CHANGES)
+    cur.execute(SELECT_DOMAIN_STATS.format(sql.Identifier(sort_by)), (limit, ))
+
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return rows
+
+
+def load_vote_activity(conn: connection, granularity: str,
+                       periods: int) -> list[dict[str, any]]:
+    """Loads the votes of each of the last `periods` hours or days, oldest first"""
+    step = GRANULARITIES[granularity]
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(SELECT_VOTE_ACTIVITY, {
+        "granularity": granularity, "span": step * (periods - 1), "step": step,
+        "granularities": ["hour"] if granularity == "hour" else ["hour", "day"]})
+
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return rows
+
+
+def load_top_movers(conn: connection, hours: int, limit: int,
+                    rising: bool = True) -> list[dict[str, any]]:
+    """
+    Loads the stories whose scores rose (or fell) the most from votes in
+    the last `hours` hours, largest change first
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    order = sql.SQL("DESC" if rising else "ASC")
+    cur.execute(SELECT_TOP_MOVERS.format(VOTE_BUCKET_COUNTS, order),
+                {"span": timedelta(hours=hours - 1), "limit": limit})
+
+    rows = cur.fetchall()
+    conn.commit()
+    cur.close()
+    return rows
+
+
+def fold_domain_stats(conn: connection) -> dict[str, int]:
+    """
+    Adds the score changes logged by votes to domain_stats. Returns how
+    many changes were folded into how many domains
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(FOLD_DOMAIN_CHANGES)
+
+    report = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return report
+
+
+def compact_vote_buckets(conn: connection, keep_hours: int,
+                         keep_days: int = None) -> dict[str, int]:
+    """
+    Folds the hourly vote buckets of days older than `keep_hours` into
+    daily buckets, and deletes daily buckets older than `keep_days` (kept
+    forever when None). Returns how many buckets were compacted, written
+    and expired
+    """
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    cur.execute(COMPACT_VOTE_BUCKETS, {
+        "keep_hours": timedelta(hours=keep_hours),
+        "keep_days": None if keep_days is None else timedelta(days=keep_days)})
+
+    report = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return report
+
+
+def rebuild_stats(conn: connection) -> None:
+    """
+    Rebuilds the rollups from the stories and votes tables, blocking writes
+    to them meanwhile. Votes are bucketed by when they were last cast, as
+    earlier changes of direction are not kept
+    """
+    cur = conn.cursor()
+
+    cur.execute(sql.SQL("""LOCK TABLE stories, votes IN SHARE MODE"""))
+    cur.execute(sql.SQL("""TRUNCATE domain_stats, domain_stat_changes, vote_buckets"""))
+    cur.execute(sql.SQL("""INSERT INTO domain_stats (domain, stories, score, upvotes, downvotes)
+                        SELECT story_domain(url), COUNT(*), SUM(score), SUM(upvotes), SUM(downvotes)
+                        FROM stories
+                        GROUP BY 1"""))
+    cur.execute(sql.SQL("""INSERT INTO vote_buckets (granularity, bucket, story_id, upvotes, downvotes)
+                        SELECT 'hour', date_trunc('hour', updated_at), story_id,
+                        COUNT(*) FILTER (WHERE direction = 'up'),
+                        COUNT(*) FILTER (WHERE direction = 'down')
+                        FROM votes
+                        GROUP BY 2, 3"""))
+
+    conn.commit()
+    cur.close()
@@ -1,53 +1,1083 @@
 """Tests for the social news API"""
 import pytest
 
-from psycopg2.extensions import connection
+from datetime import datetime
 
 from unittest.mock import patch, MagicMock
 
+import api
+from api import app, apply_story_batch, create_new_votes_record, loads_stories, stream_stories
+from db_pool import PoolTimeout
+from hot_ranking import HotRanking
+from query_stats import QueryStats
+from rate_limit import RateLimiter
+from response_cache import MemoryBackend, ResponseCache
+from story_core import build_stories_query, decode_cursor, encode_cursor
+
+
+@pytest.fixture(autouse=True)
+def fake_hot_ranking():
+    """Keeps route tests from touching the module-level hot ranking"""
+    with patch("api.hot_ranking") as hot_ranking:
+        hot_ranking.capacity = 500
+        yield hot_ranking
+
+
+@pytest.fixture(autouse=True)
+def fresh_story_cache():
+    """Gives every route test an empty story cache"""
+    with patch("api.story_cache", ResponseCache()) as story_cache:
+        yield story_cache
+
+
+@pytest.fixture(autouse=True)
+def fresh_vote_limits():
+    """Gives every route test empty rate limiters and idempotency keys"""
+    with patch("api.address_rate_limiter", RateLimiter(rate=5, burst=50)), \
+            patch("api.voter_rate_limiter", RateLimiter(rate=1, burst=10)), \
+            patch("api.story_rate_limiter", RateLimiter(rate=100, burst=200)), \
+            patch("api.idempotent_responses", MemoryBackend()):
+        yield
+
 
 # Testing the GET request for "/stories" endpoint
-@patch("api.get_database_connection")
 @patch("api.loads_stories")
-def test_stories_load_successfully(fake_loads_stories,
-                                   test_database_connection, mock_stories, test_client):
+@patch("api.get_pool")
+def test_stories_load_successfully(fake_get_pool, fake_loads_stories, mock_stories, test_client):
 
-    conn = test_database_connection
-    fake_loads_stories.fetchall().return_value = mock_stories
+    fake_loads_stories.return_value = (mock_stories, None)
 
     response = test_client.get("/stories")
 
-    assert isinstance(response, list)
+    assert isinstance(response.json, list)
     assert response.status_code == 200
 
 
-@patch("api.get_database_connection")
 @patch("api.loads_stories")
-def test_load_empty_stories_unsuccessful(fake_loads_stories, fake_database_connection,
-                                         test_database_connection, mock_empty_stories, test_client):
+@patch("api.get_pool")
+def test_load_empty_stories_unsuccessful(fake_get_pool, fake_loads_stories, mock_empty_stories,
+                                         test_client):
 
-    fake_database_connection = test_database_connection
-    fake_loads_stories.fetchall().return_value = mock_empty_stories
+    fake_loads_stories.return_value = (mock_empty_stories, None)
 
     response = test_client.get("/stories")
 
-    assert response.status_code == 200
+    assert response.status_code == 400
 
 
 # Testing POST request for "/stories" endpoint
+@patch("api.load_all_stories")
+@patch("api.get_stories_etag")
 @patch("api.post_new_story")
-def post_new_story_successfully(fake_post_new_story, fake_database_connection,
-                                test_database_connection, mock_stories, test_client):
+@patch("api.get_pool")
+def test_post_new_story_successfully(fake_get_pool, fake_post_new_story, fake_get_stories_etag,
+                                     fake_load_all_stories, mock_stories, test_client):
 
     n = len(mock_stories)
-
-    fake_database_connection = test_database_connection
+    new_story = {**mock_stories[0], "id": n + 1, "title": "HI", "url": "www.hi.com"}
+    fake_post_new_story.return_value = new_story
+    fake_get_stories_etag.return_value = "fingerprint"
+    fake_load_all_stories.return_value = [*mock_stories, new_story]
 
     response = test_client.post(
         "/stories", json={"url": "www.hi.com", "title": "HI"})
 
     data = response.json
 
-    assert response.status_code == 200
+    assert response.status_code == 201
     assert isinstance(data, list)
     assert len(data) == n + 1
+
+
+# Testing per-request pooled connections
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_request_returns_connection_to_pool(fake_get_pool, fake_loads_stories,
+                                            mock_stories, test_client):
+
+    fake_loads_stories.return_value = (mock_stories, None)
+    fake_pool = fake_get_pool.return_value
+
+    response = test_client.get("/stories")
+
+    assert response.status_code == 200
+    fake_pool.getconn.assert_called_once()
+    fake_pool.putconn.assert_called_once_with(fake_pool.getconn.return_value)
+
+
+@patch("api.get_pool")
+def test_exhausted_pool_returns_503(fake_get_pool, test_client):
+
+    fake_get_pool.return_value.getconn.side_effect = PoolTimeout
+
+    response = test_client.get("/stories")
+
+    assert response.status_code == 503
+    assert response.json["error"] is True
+
+
+# Testing the responses of write endpoints
+@patch("api.post_new_story")
+@patch("api.get_pool")
+def test_post_story_returns_only_new_row(fake_get_pool, fake_post_new_story,
+                                         mock_stories, test_client):
+
+    fake_post_new_story.return_value = mock_stories[0]
+
+    response = test_client.post(
+        "/stories?return=row", json={"url": "www.hi.com", "title": "HI"})
+
+    assert response.status_code == 201
+    assert response.json == mock_stories[0]
+
+
+@patch("api.get_conn")
+def test_stories_repeating_a_url_answer_409(fake_get_conn, test_database_connection, test_client):
+    fake_get_conn.return_value = test_database_connection
+    story = {"url": "https://a.example.com/", "title": "A"}
+
+    created = test_client.post("/stories?return=row", json=story)
+    repeated = test_client.post("/stories?return=row", json={**story, "title": "B"})
+    test_database_connection.rollback()
+
+    assert created.status_code == 201
+    assert repeated.status_code == 409
+    assert repeated.json["error"] is True
+
+
+@patch("api.load_all_stories")
+@patch("api.get_stories_etag")
+@patch("api.post_new_story")
+@patch("api.get_pool")
+def test_post_story_returns_all_stories_with_etag(fake_get_pool, fake_post_new_story,
+                                                  fake_get_stories_etag, fake_load_all_stories,
+                                                  mock_stories, test_client):
+
+    fake_post_new_story.return_value = mock_stories[1]
+    fake_get_stories_etag.return_value = "abc"
+    fake_load_all_stories.return_value = mock_stories
+
+    response = test_client.post(
+        "/stories", json={"url": "www.hi.com", "title": "HI"})
+
+    assert response.status_code == 201
+    assert response.json == mock_stories
+    assert response.headers["ETag"] == '"abc"'
+
+
+@patch("api.load_all_stories")
+@patch("api.get_stories_etag")
+@patch("api.delete_existing_story")
+@patch("api.get_pool")
+def test_delete_story_not_modified_for_matching_etag(fake_get_pool, fake_delete_existing_story,
+                                                     fake_get_stories_etag,
+                                                     fake_load_all_stories,
+                                                     mock_stories, test_client):
+
+    fake_delete_existing_story.return_value = mock_stories[0]
+    fake_get_stories_etag.return_value = "abc"
+
+    response = test_client.delete("/stories/1", headers={"If-None-Match": '"abc"'})
+
+    assert response.status_code == 304
+    fake_load_all_stories.assert_not_called()
+
+
+@patch("api.delete_existing_story")
+@patch("api.get_pool")
+def test_delete_missing_story_returns_404(fake_get_pool, fake_delete_existing_story, test_client):
+
+    fake_delete_existing_story.return_value = None
+
+    response = test_client.delete("/stories/7?return=row")
+
+    assert response.status_code == 404
+
+
+# Testing pagination and projection of GET "/stories"
+def test_cursor_round_trips():
+    cursor = encode_cursor({"id": 4, "title": "Me and my friends"}, "title")
+
+    assert decode_cursor(cursor, "title") == ["Me and my friends", 4]
+
+
+@pytest.mark.parametrize("position, sort_by", [
+    ("not-a-cursor", "id"), (["abc", 1], "id"), (["abc", "1"], "title"), ([True, 1], "score"),
+    (["Me and my friends", 4], "created_at"), ([1, 4], "title"), (["0.5", 1], "relevance")])
+def test_invalid_cursor_is_rejected(position, sort_by):
+    cursor = position if isinstance(position, str) else encode_cursor(
+        {"id": position[1], sort_by: position[0]}, sort_by)
+
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, sort_by)
+
+
+@patch("api.get_pool")
+def test_cursor_of_another_sort_returns_400(fake_get_pool, test_client):
+    cursor = encode_cursor({"id": 4, "title": "Me and my friends"}, "title")
+
+    response = test_client.get(f"/stories?sort_by=id&cursor={cursor}")
+
+    assert response.status_code == 400
+    fake_get_pool.return_value.getconn.return_value.cursor.assert_not_called()
+
+
+def test_loads_stories_returns_next_cursor(mock_stories):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = list(mock_stories)
+
+    rows, next_cursor = loads_stories(conn, "id", "ASC", None, limit=1)
+
+    assert rows == mock_stories[:1]
+    assert decode_cursor(next_cursor, "id") == [1, 1]
+    _, params = conn.cursor.return_value.execute.call_args.args
+    assert params == {"limit": 2}
+
+
+def test_loads_stories_filters_after_cursor_and_projects_fields(mock_stories):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = mock_stories[1:]
+    cursor = encode_cursor(mock_stories[0], "id")
+
+    rows, next_cursor = loads_stories(conn, "id", "DESC", "food", limit=5,
+                                      cursor=cursor, fields=["title"])
+
+    assert rows == [{"title": mock_stories[1]["title"]}]
+    assert next_cursor is None
+    _, params = conn.cursor.return_value.execute.call_args.args
+    assert params == {"search": "food", "after_value": 1, "after_id": 1, "limit": 6}
+
+
+@pytest.mark.parametrize("sort_by, order_by, fields", [
+    ("url", "ASC", None),
+    ("relevance", "DESC", None),
+    ("id", "ASC; DROP TABLE stories", None),
+    ("id", "ASC", ["password"]),
+])
+def test_loads_stories_rejects_unlisted_arguments(sort_by, order_by, fields):
+    with pytest.raises(ValueError):
+        loads_stories(MagicMock(), sort_by, order_by, None, fields=fields)
+
+
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_get_stories_sends_next_cursor_header(fake_get_pool, fake_loads_stories,
+                                              mock_stories, test_client):
+
+    fake_loads_stories.return_value = (mock_stories, "abc")
+
+    response = test_client.get("/stories?limit=2")
+
+    assert response.status_code == 200
+    assert response.headers["X-Next-Cursor"] == "abc"
+
+
+@patch("api.get_pool")
+def test_get_stories_rejects_oversized_limit(fake_get_pool, test_client):
+
+    response = test_client.get("/stories?limit=100000")
+
+    assert response.status_code == 400
+
+
+# Testing maintained story scores
+@pytest.mark.parametrize("direction", ["up", "down"])
+def test_vote_upserts_voters_vote_in_one_statement(direction, mock_stories):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchone.return_value = mock_stories[0]
+
+    story = create_new_votes_record(conn, 1, direction, "alice")
+
+    conn.cursor.return_value.execute.assert_called_once()
+    query, params = conn.cursor.return_value.execute.call_args.args
+    assert "ON CONFLICT (voter_id, story_id) DO UPDATE" in repr(query)
+    assert params == ("alice", 1, direction)
+    assert story == mock_stories[0]
+    conn.commit.assert_called_once()
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_vote_returns_story_with_new_score(fake_get_pool, fake_create_new_votes_record,
+                                           mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+
+    response = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                headers={"X-Voter-Id": "alice"})
+
+    assert response.status_code == 200
+    assert response.json["score"] == 42
+    fake_create_new_votes_record.assert_called_once_with(
+        fake_get_pool.return_value.getconn.return_value, 1, "up", "127.0.0.1 alice")
+
+
+# Testing vote rate limits and idempotency keys
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_votes_over_the_voter_limit_return_429(fake_get_pool, fake_create_new_votes_record,
+                                               mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=0.5, burst=2)):
+        statuses = [test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                     headers={"X-Voter-Id": "alice"}) for _ in range(3)]
+        other_voter = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                       headers={"X-Voter-Id": "bob"})
+
+    assert [response.status_code for response in statuses] == [200, 200, 429]
+    assert statuses[2].headers["Retry-After"] == "2"
+    assert other_voter.status_code == 200
+    assert fake_create_new_votes_record.call_count == 3
+    fake_get_pool.return_value.getconn.assert_called()
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_story_limited_votes_leave_the_voter_bucket_intact(fake_get_pool, fake_create_new_votes_record,
+                                                          mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=0.5, burst=2)), \
+            patch("api.story_rate_limiter", RateLimiter(rate=0.5, burst=1)):
+        hot = [test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                headers={"X-Voter-Id": "alice"}).status_code for _ in range(4)]
+        other = test_client.post("/stories/2/votes?return=row", json={"direction": "up"},
+                                 headers={"X-Voter-Id": "alice"})
+
+    assert hot == [200, 429, 429, 429]
+    assert other.status_code == 200
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_rotating_voter_ids_hit_the_address_limit(fake_get_pool, fake_create_new_votes_record,
+                                                   mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+
+    with patch("api.address_rate_limiter", RateLimiter(rate=1, burst=2)):
+        statuses = [test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                     headers={"X-Voter-Id": f"voter-{number}"}).status_code
+                    for number in range(3)]
+
+    assert statuses == [200, 200, 429]
+    assert [call.args[3] for call in fake_create_new_votes_record.call_args_list] == [
+        "127.0.0.1 voter-0", "127.0.0.1 voter-1"]
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_votes_on_missing_stories_give_their_tokens_back(fake_get_pool, fake_create_new_votes_record,
+                                                        mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = None
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=0.5, burst=1)):
+        missing = [test_client.post("/stories/9/votes", json={"direction": "up"},
+                                    headers={"X-Voter-Id": "alice"}).status_code for _ in range(2)]
+        fake_create_new_votes_record.return_value = mock_stories[0]
+        cast = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                headers={"X-Voter-Id": "alice"})
+
+    assert missing == [404, 404]
+    assert cast.status_code == 200
+
+
+@patch("api.get_pool")
+def test_oversized_voter_id_is_rejected(fake_get_pool, test_client):
+
+    response = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                                headers={"X-Voter-Id": "x" * 129})
+
+    assert response.status_code == 400
+    fake_get_pool.assert_not_called()
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_retried_vote_replays_the_first_response(fake_get_pool, fake_create_new_votes_record,
+                                                 mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    headers = {"X-Voter-Id": "alice", "Idempotency-Key": "click-1"}
+
+    first = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                             headers=headers)
+    retry = test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                             headers=headers)
+
+    assert retry.status_code == first.status_code == 200
+    assert retry.json == first.json
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    fake_create_new_votes_record.assert_called_once()
+
+
+@patch("api.patch_existing_story")
+@patch("api.get_pool")
+def test_retried_edit_replays_the_first_response(fake_get_pool, fake_patch_existing_story,
+                                                 mock_stories, test_client):
+
+    fake_patch_existing_story.return_value = mock_stories[0]
+    headers = {"Idempotency-Key": "edit-1"}
+    edit = {"url": "www.hi.com", "title": "HI"}
+
+    first = test_client.patch("/stories/1?return=row", json=edit, headers=headers)
+    retry = test_client.patch("/stories/1?return=row", json=edit, headers=headers)
+
+    assert retry.json == first.json
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    fake_patch_existing_story.assert_called_once()
+
+
+@patch("api.load_all_stories")
+@patch("api.get_stories_etag")
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_responses_over_the_byte_budget_are_not_stored(fake_get_pool, fake_create_new_votes_record,
+                                                       fake_get_stories_etag, fake_load_all_stories,
+                                                       mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    fake_get_stories_etag.return_value = "abc"
+    fake_load_all_stories.return_value = mock_stories * 10
+    headers = {"X-Voter-Id": "alice", "Idempotency-Key": "click-1"}
+    budget = MemoryBackend(max_bytes=1024, sizeof=api.stored_response_size)
+
+    with patch("api.idempotent_responses", budget):
+        first = test_client.post("/stories/1/votes", json={"direction": "up"}, headers=headers)
+        retry = test_client.post("/stories/1/votes", json={"direction": "up"}, headers=headers)
+
+    assert len(first.get_data()) > 1024
+    assert "Idempotent-Replayed" not in retry.headers
+    assert budget.bytes == 0
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_idempotency_key_reused_for_another_request_returns_422(
+        fake_get_pool, fake_create_new_votes_record, mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    headers = {"X-Voter-Id": "alice", "Idempotency-Key": "click-1"}
+
+    test_client.post("/stories/1/votes?return=row", json={"direction": "up"}, headers=headers)
+    response = test_client.post("/stories/1/votes?return=row", json={"direction": "down"}, headers=headers)
+
+    assert response.status_code == 422
+    fake_create_new_votes_record.assert_called_once()
+
+
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_rate_limited_votes_are_not_replayed(fake_get_pool, fake_create_new_votes_record,
+                                             mock_stories, test_client):
+
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    headers = {"X-Voter-Id": "alice", "Idempotency-Key": "click-1"}
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=1, burst=1)):
+        test_client.post("/stories/1/votes?return=row", json={"direction": "up"},
+                         headers={"X-Voter-Id": "alice"})
+        limited = test_client.post("/stories/1/votes?return=row", json={"direction": "up"}, headers=headers)
+    retry = test_client.post("/stories/1/votes?return=row", json={"direction": "up"}, headers=headers)
+
+    assert limited.status_code == 429
+    assert retry.status_code == 200
+    assert "Idempotent-Replayed" not in retry.headers
+
+
+@patch("api.reconcile_scores")
+@patch("api.get_db_connection")
+def test_reconcile_scores_command(fake_get_db_connection, fake_reconcile_scores):
+
+    fake_reconcile_scores.return_value = 3
+
+    result = app.test_cli_runner().invoke(args=["reconcile-scores"])
+
+    assert "Reconciled scores of 3 stories." in result.output
+    fake_get_db_connection.return_value.close.assert_called_once()
+
+
+# Testing buffered votes
+@patch("api.get_vote_buffer")
+@patch("api.story_exists")
+@patch("api.get_pool")
+def test_buffered_vote_is_accepted(fake_get_pool, fake_story_exists, fake_get_vote_buffer,
+                                   test_client):
+
+    fake_story_exists.return_value = True
+    fake_get_vote_buffer.return_value.submit.return_value = True
+
+    response = test_client.post("/stories/1/votes", json={"direction": "down"})
+
+    assert response.status_code == 202
+    fake_get_vote_buffer.return_value.submit.assert_called_once_with("127.0.0.1", 1, "down")
+
+
+@patch("api.get_vote_buffer")
+@patch("api.story_exists")
+@patch("api.get_pool")
+def test_full_vote_buffer_applies_backpressure(fake_get_pool, fake_story_exists,
+                                               fake_get_vote_buffer, test_client):
+
+    fake_story_exists.return_value = True
+    fake_get_vote_buffer.return_value.submit.return_value = False
+
+    response = test_client.post("/stories/1/votes", json={"direction": "up"})
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+
+
+@patch("api.get_vote_buffer")
+@patch("api.story_exists")
+@patch("api.get_pool")
+def test_buffered_vote_for_missing_story_returns_404(fake_get_pool, fake_story_exists,
+                                                     fake_get_vote_buffer, test_client):
+
+    fake_story_exists.return_value = False
+
+    response = test_client.post("/stories/3/votes", json={"direction": "up"})
+
+    assert response.status_code == 404
+    fake_get_vote_buffer.return_value.submit.assert_not_called()
+
+
+# Testing story id validation
+@patch("api.create_new_votes_record")
+@patch("api.get_pool")
+def test_vote_for_missing_story_returns_404(fake_get_pool, fake_create_new_votes_record,
+                                            test_client):
+
+    fake_create_new_votes_record.return_value = None
+
+    response = test_client.post("/stories/3/votes", json={"direction": "up"})
+
+    assert response.status_code == 404
+    assert response.json["message"] == "No stories with this id"
+
+
+# Testing full-text search
+def test_search_is_parameterised_not_spliced(mock_stories):
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = mock_stories
+    search = "'; DROP TABLE stories; --"
+
+    loads_stories(conn, "id", "ASC", search)
+
+    query, params = conn.cursor.return_value.execute.call_args.args
+    assert search not in repr(query)
+    assert params["search"] == search
+
+
+def test_relevance_sort_pages_on_rank(mock_stories):
+    conn = MagicMock()
+    ranked = [dict(story, relevance=0.5) for story in mock_stories]
+    conn.cursor.return_value.fetchall.return_value = ranked
+
+    rows, next_cursor = loads_stories(conn, "relevance", "DESC", "food", limit=1)
+
+    assert rows == ranked[:1]
+    assert decode_cursor(next_cursor, "relevance") == [0.5, 1]
+
+
+# Testing the hot ranking feed
+@patch("api.load_hot_stories")
+@patch("api.hot_ranking", HotRanking(capacity=10))
+@patch("api.get_pool")
+def test_hot_feed_is_served_from_memory_after_refresh(fake_get_pool, fake_load_hot_stories,
+                                                     test_client):
+
+    fake_load_hot_stories.return_value = [
+        {"id": 1, "score": 1, "title": "Old", "created_at": datetime(2022, 6, 24)},
+        {"id": 2, "score": 1, "title": "New", "created_at": datetime(2022, 6, 25)}]
+
+    first = test_client.get("/stories/hot")
+    second = test_client.get("/stories?sort_by=hot&limit=1")
+
+    assert [story["id"] for story in first.json] == [2, 1]
+    assert [story["id"] for story in second.json] == [2]
+    fake_load_hot_stories.assert_called_once()
+
+
+@patch("api.get_pool")
+def test_hot_feed_rejects_oversized_limit(fake_get_pool, test_client):
+
+    response = test_client.get("/stories/hot?limit=100000")
+
+    assert response.status_code == 400
+
+
+# Testing the story cache
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_repeated_listing_is_served_from_cache(fake_get_pool, fake_loads_stories,
+                                               mock_stories, test_client):
+
+    fake_loads_stories.return_value = (mock_stories, "abc")
+
+    first = test_client.get("/stories?sort_by=title")
+    second = test_client.get("/stories?sort_by=title")
+
+    assert first.json == second.json == mock_stories
+    assert second.headers["X-Next-Cursor"] == "abc"
+    fake_loads_stories.assert_called_once()
+    fake_get_pool.return_value.getconn.assert_called_once()
+
+
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_listing_not_modified_for_matching_etag(fake_get_pool, fake_loads_stories,
+                                                mock_stories, test_client):
+
+    fake_loads_stories.return_value = (mock_stories, None)
+    etag = test_client.get("/stories").headers["ETag"]
+
+    response = test_client.get("/stories", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+
+
+@patch("api.create_new_votes_record")
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_vote_invalidates_cached_pages_containing_story(fake_get_pool, fake_loads_stories,
+                                                        fake_create_new_votes_record,
+                                                        mock_stories, test_client):
+
+    fake_loads_stories.return_value = (mock_stories, None)
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    test_client.get("/stories")
+
+    test_client.post("/stories/1/votes?return=row", json={"direction": "up"})
+    test_client.get("/stories")
+
+    assert fake_loads_stories.call_count == 2
+
+
+@patch("api.create_new_votes_record")
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_pages_without_ids_are_still_tagged_with_their_stories(fake_get_pool, fake_loads_stories,
+                                                               fake_create_new_votes_record,
+                                                               mock_stories, test_client):
+
+    fake_loads_stories.return_value = ([{"title": story["title"], "id": story["id"]}
+                                        for story in mock_stories], None)
+    fake_create_new_votes_record.return_value = mock_stories[0]
+    response = test_client.get("/stories?sort_by=title&fields=title")
+
+    test_client.post("/stories/1/votes?return=row", json={"direction": "up"})
+    test_client.get("/stories?sort_by=title&fields=title")
+
+    assert response.json == [{"title": story["title"]} for story in mock_stories]
+    assert fake_loads_stories.call_args.args[6] == ["title", "id"]
+    assert fake_loads_stories.call_count == 2
+
+
+# Testing POST request for "/scrape" endpoint
+@patch("api.insert_stories")
+@patch("api.scrape_sources")
+@patch("api.get_pool")
+def test_scrape_inserts_new_stories(fake_get_pool, fake_scrape_sources, fake_insert_stories,
+                                    fake_hot_ranking, mock_stories, test_client):
+
+    fake_insert_stories.return_value = mock_stories[:1]
+
+    response = test_client.post("/scrape", json={"url": "https://news.ycombinator.com/newest"})
+
+    assert response.status_code == 200
+    assert response.json == mock_stories[:1]
+    fake_scrape_sources.assert_called_once_with(
+        [{"url": "https://news.ycombinator.com/newest", "selector": "span.titleline > a"}],
+        limiter=api.scrape_limiter)
+    fake_hot_ranking.update.assert_called_once_with(mock_stories[0])
+
+
+@pytest.mark.parametrize("url", ["file:///etc/passwd", "http://169.254.169.254/latest/meta-data",
+                                 "http://localhost:5432/", "https://news.ycombinator.com:8080/",
+                                 "https://news.ycombinator.com.evil.example/"])
+@patch("api.scrape_sources")
+@patch("api.get_pool")
+def test_scrape_only_fetches_allowed_sources(fake_get_pool, fake_scrape_sources, url,
+                                             test_client):
+
+    response = test_client.post("/scrape", json={"url": url})
+
+    assert response.status_code == 400
+    fake_scrape_sources.assert_not_called()
+
+
+# Testing bulk import and export
+@patch("api.import_stories")
+@patch("api.get_pool")
+def test_bulk_import_returns_report(fake_get_pool, fake_import_stories, fake_hot_ranking,
+                                    test_client):
+
+    fake_import_stories.return_value = {"inserted": 2, "rejected": 0, "batches": 1, "errors": []}
+
+    response = test_client.post("/stories/bulk", data=b'{"title": "A", "url": "a.com"}\n',
+                                content_type="application/x-ndjson")
+
+    assert response.status_code == 200
+    assert response.json["inserted"] == 2
+    fake_hot_ranking.expire.assert_called_once()
+
+
+@patch("api.export_stories")
+@patch("api.get_pool")
+def test_bulk_export_streams_ndjson(fake_get_pool, fake_export_stories, test_client):
+
+    fake_export_stories.return_value = iter([b'{"id":1}\n', b'{"id":2}\n'])
+
+    response = test_client.get("/stories/export")
+
+    assert response.mimetype == "application/x-ndjson"
+    assert response.data == b'{"id":1}\n{"id":2}\n'
+    fake_get_pool.return_value.putconn.assert_called_once()
+
+
+# Testing streamed story listings
+@pytest.mark.parametrize("stream, mimetype, body", [
+    ("ndjson", "application/x-ndjson", b'{"id":1}\n{"id":2}\n'),
+    ("json", "application/json", b'[{"id":1},{"id":2}]'),
+])
+@patch("api.stream_stories")
+@patch("api.get_pool")
+def test_get_stories_streams_whole_listing(fake_get_pool, fake_stream_stories, stream, mimetype,
+                                           body, test_client):
+
+    fake_stream_stories.return_value = iter([{"id": 1}, {"id": 2}])
+
+    response = test_client.get(f"/stories?stream={stream}&limit=1&sort_by=title")
+
+    assert response.mimetype == mimetype
+    assert response.data == body
+    fake_stream_stories.assert_called_once_with(
+        fake_get_pool.return_value.getconn.return_value, "title", "ASC", None, None, None, False)
+    fake_get_pool.return_value.putconn.assert_called_once()
+
+
+@patch("api.stream_stories")
+@patch("api.get_pool")
+def test_get_stories_streams_rows_as_arrays(fake_get_pool, fake_stream_stories, test_client):
+
+    fake_stream_stories.return_value = iter([["id", "title"], (1, "HI"), (2, "BYE")])
+
+    response = test_client.get("/stories?stream=ndjson&rows=arrays&fields=id,title")
+
+    assert response.data == b'["id","title"]\n[1,"HI"]\n[2,"BYE"]\n'
+    assert fake_stream_stories.call_args.args[-1] is True
+
+
+@pytest.mark.parametrize("query", ["stream=xml", "stream=json&sort_by=url",
+                                   "stream=json&rows=tuples"])
+@patch("api.get_pool")
+def test_get_stories_rejects_invalid_stream(fake_get_pool, query, test_client):
+
+    response = test_client.get(f"/stories?{query}")
+
+    assert response.status_code == 400
+
+
+def test_stories_query_without_limit_selects_only_fields():
+    query, params = build_stories_query("title", "ASC", None, fields=["url"])
+
+    assert params == {}
+    assert "LIMIT" not in repr(query)
+    assert "'id'" not in repr(query.seq[1])
+
+
+def test_stream_stories_checks_arguments_before_streaming():
+    conn = MagicMock()
+
+    with pytest.raises(ValueError):
+        stream_stories(conn, "url", "ASC", None)
+    conn.cursor.assert_not_called()
+
+
+# Testing query instrumentation and profiling
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_responses_report_server_timing(fake_get_pool, fake_loads_stories, mock_stories,
+                                        test_client):
+
+    fake_loads_stories.return_value = (mock_stories, None)
+
+    response = test_client.get("/stories")
+
+    assert response.headers["Server-Timing"].startswith('db;dur=')
+    assert "X-Profile-Id" not in response.headers
+
+
+@patch("api.stream_stories")
+@patch("api.get_pool")
+def test_streamed_fetches_count_towards_their_request(fake_get_pool, fake_stream_stories,
+                                                      test_client):
+    stats = QueryStats()
+
+    def rows():
+        for id in (1, 2):
+            stats.record_statement(0.001)
+            stats.record_rows(1)
+            yield {"id": id}
+
+    fake_stream_stories.return_value = rows()
+
+    with patch("api.query_stats", stats):
+        response = test_client.get("/stories?stream=ndjson")
+        response.get_data()
+        response.close()
+
+    assert "Server-Timing" not in response.headers
+    endpoint = stats.snapshot()["endpoints"]["get_stories"]
+    assert endpoint["round_trips_per_request"] == 2
+    assert endpoint["rows_per_request"] == 2
+
+
+@patch("api.PROFILING_ENABLED", True)
+@patch("api.loads_stories")
+@patch("api.get_pool")
+def test_requested_profile_is_stored(fake_get_pool, fake_loads_stories, mock_stories,
+                                     test_client):
+
+    fake_loads_stories.return_value = (mock_stories, None)
+
+    response = test_client.get("/stories?profile=1")
+    profile = test_client.get(f"/metrics/profiles/{response.headers['X-Profile-Id']}")
+
+    assert profile.status_code == 200
+    assert profile.mimetype == "text/plain"
+    assert test_client.get("/metrics/profiles/0").status_code == 404
+
+
+@patch("api.get_pool")
+def test_metrics_report_query_histograms(fake_get_pool, test_client):
+
+    fake_get_pool.return_value.stats.return_value = {}
+
+    response = test_client.get("/metrics")
+
+    assert "statements" in response.json["queries"]
+    assert "endpoints" in response.json["queries"]
+
+
+# Testing the /stats rollups
+@patch("api.load_domain_stats")
+@patch("api.get_pool")
+def test_domain_stats_are_sorted_by_score(fake_get_pool, fake_load_domain_stats, test_client):
+
+    fake_load_domain_stats.return_value = [{"domain": "example.com", "stories": 2, "score": 9}]
+
+    response = test_client.get("/stats/domains?sort_by=score&limit=5")
+
+    assert response.status_code == 200
+    assert response.json[0]["domain"] == "example.com"
+    fake_load_domain_stats.assert_called_once_with(
+        fake_get_pool.return_value.getconn.return_value, "score", 5)
+
+
+@pytest.mark.parametrize("path", ["/stats/domains?sort_by=url", "/stats/domains?limit=0",
+                                  "/stats/votes?granularity=week", "/stats/votes?periods=49",
+                                  "/stats/movers?hours=0", "/stats/movers?direction=sideways"])
+@patch("api.get_pool")
+def test_stats_reject_invalid_arguments(fake_get_pool, path, test_client):
+
+    response = test_client.get(path)
+
+    assert response.status_code == 400
+    fake_get_pool.assert_not_called()
+
+
+@patch("api.load_vote_activity")
+@patch("api.get_pool")
+def test_daily_vote_stats_default_to_thirty_days(fake_get_pool, fake_load_vote_activity,
+                                                 test_client):
+
+    fake_load_vote_activity.return_value = []
+
+    response = test_client.get("/stats/votes?granularity=day")
+
+    assert response.status_code == 200
+    assert fake_load_vote_activity.call_args.args[1:] == ("day", 30)
+
+
+@patch("api.load_top_movers")
+@patch("api.get_pool")
+def test_falling_movers(fake_get_pool, fake_load_top_movers, test_client):
+
+    fake_load_top_movers.return_value = [{"id": 1, "change": -3}]
+
+    response = test_client.get("/stats/movers?direction=down&hours=6")
+
+    assert response.json == [{"id": 1, "change": -3}]
+    fake_load_top_movers.assert_called_once_with(
+        fake_get_pool.return_value.getconn.return_value, 6, 10, rising=False)
+
+
+@patch("api.compact_vote_buckets")
+@patch("api.get_db_connection")
+def test_compact_stats_command(fake_get_db_connection, fake_compact_vote_buckets):
+
+    fake_compact_vote_buckets.return_value = {"compacted": 24, "daily": 1, "expired": 0}
+
+    result = app.test_cli_runner().invoke(args=["compact-stats", "--keep-hours", "72"])
+
+    assert "Compacted 24 hourly buckets into 1 daily buckets" in result.output
+    fake_compact_vote_buckets.assert_called_once_with(fake_get_db_connection.return_value, 72, None)
+
+
+@patch("api.compact_vote_buckets")
+@patch("api.get_db_connection")
+def test_compaction_keeps_the_hours_served_by_vote_stats(fake_get_db_connection,
+                                                         fake_compact_vote_buckets):
+
+    result = app.test_cli_runner().invoke(args=["compact-stats", "--keep-hours", "24"])
+
+    assert result.exit_code == 2
+    fake_compact_vote_buckets.assert_not_called()
+
+
+@patch("api.fold_domain_stats")
+@patch("api.get_db_connection")
+def test_fold_stats_command(fake_get_db_connection, fake_fold_domain_stats):
+
+    fake_fold_domain_stats.return_value = {"changes": 12, "domains": 3}
+
+    result = app.test_cli_runner().invoke(args=["fold-stats"])
+
+    assert "Folded 12 score changes into 3 domains" in result.output
+    fake_fold_domain_stats.assert_called_once_with(fake_get_db_connection.return_value)
+    fake_get_db_connection.return_value.close.assert_called_once()
+
+
+# Testing batch mutations
+@patch("api.psycopg2.extras.execute_values")
+def test_batch_applies_actions_in_order_in_one_transaction(fake_execute_values, mock_stories):
+    conn = MagicMock()
+    cur = conn.cursor.return_value
+    cur.fetchall.side_effect = [[{"id": 1}, {"id": 2}], [{"id": 1}]]
+    fake_execute_values.side_effect = [[{**mock_stories[0], "id": 1}],
+                                       [{**mock_stories[1], "id": 2}]]
+    actions = [{"op": "edit", "id": 1, "title": "New", "url": "new.com"},
+               {"op": "vote", "id": 2, "direction": "up"},
+               {"op": "delete", "id": 1},
+               {"op": "vote", "id": 1, "direction": "up"},
+               {"op": "vote", "id": 3, "direction": "down"}]
+
+    results, stories = apply_story_batch(conn, list(enumerate(actions)), "alice")
+
+    assert [results[position]["status"] for position in range(5)] == [200, 200, 200, 404, 404]
+    assert cur.execute.call_args_list[0].args[1] == ([1, 2, 3], )
+    assert fake_execute_values.call_args_list[0].args[2] == [(1, "new.com", "New")]
+    assert fake_execute_values.call_args_list[1].args[2] == [("alice", 2, "up")]
+    assert cur.execute.call_args_list[1].args[1] == ([1], )
+    assert [story["id"] for story in stories] == [2]
+    conn.commit.assert_called_once()
+
+
+@patch("api.apply_story_batch")
+@patch("api.get_pool")
+def test_batch_reports_each_action(fake_get_pool, fake_apply_story_batch, mock_stories,
+                                   fake_hot_ranking, fresh_story_cache, test_client):
+
+    fake_apply_story_batch.return_value = ({0: {"id": 1, "status": 200},
+                                            2: {"id": 2, "status": 200}}, [mock_stories[0]])
+
+    with patch.object(fresh_story_cache, "invalidate_story") as invalidate_story:
+        response = test_client.post("/stories/batch", json=[
+            {"op": "vote", "id": 1, "direction": "up"},
+            {"op": "vote", "id": 1, "direction": "sideways"},
+            {"op": "delete", "id": 2}], headers={"X-Voter-Id": "alice"})
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json] == [200, 400, 200]
+    assert "direction" in response.json[1]["message"]
+    valid = fake_apply_story_batch.call_args.args[1]
+    assert [position for position, _ in valid] == [0, 2]
+    assert fake_apply_story_batch.call_args.args[2] == "127.0.0.1 alice"
+    fake_hot_ranking.update.assert_called_once_with(mock_stories[0])
+    fake_hot_ranking.remove.assert_called_once_with(2)
+    assert invalidate_story.call_count == 2
+
+
+@pytest.mark.parametrize("body", [{"op": "delete", "id": 1}, [],
+                                  [{"op": "delete", "id": 1}] * 101])
+@patch("api.get_pool")
+def test_batch_must_be_a_list_of_actions(fake_get_pool, body, test_client):
+
+    response = test_client.post("/stories/batch", json=body)
+
+    assert response.status_code == 400
+    fake_get_pool.assert_not_called()
+
+
+@patch("api.apply_story_batch")
+@patch("api.get_pool")
+def test_batch_votes_are_rate_limited_per_action(fake_get_pool, fake_apply_story_batch,
+                                                 test_client):
+
+    fake_apply_story_batch.return_value = ({0: {"id": 1, "status": 200}}, [])
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=0.5, burst=1)):
+        response = test_client.post("/stories/batch", json=[
+            {"op": "vote", "id": 1, "direction": "up"},
+            {"op": "vote", "id": 2, "direction": "up"}], headers={"X-Voter-Id": "alice"})
+
+    assert response.json[1] == {"id": 2, "status": 429, "retry_after": 2,
+                                "message": "Too many votes right now, please try again."}
+    assert [position for position, _ in fake_apply_story_batch.call_args.args[1]] == [0]
+
+
+@pytest.mark.parametrize("id", [0, -1, 2 ** 31, 2 ** 63])
+@patch("api.apply_story_batch")
+@patch("api.get_pool")
+def test_batch_ids_outside_the_id_column_are_rejected(fake_get_pool, fake_apply_story_batch,
+                                                       id, test_client):
+
+    response = test_client.post("/stories/batch", json=[{"op": "delete", "id": id}])
+
+    assert response.status_code == 200
+    assert response.json[0]["status"] == 400
+    assert "between 1 and 2147483647" in response.json[0]["message"]
+    fake_apply_story_batch.assert_not_called()
+
+
+@patch("api.apply_story_batch")
+@patch("api.get_pool")
+def test_batch_votes_on_missing_stories_give_their_tokens_back(fake_get_pool, fake_apply_story_batch,
+                                                              test_client):
+
+    fake_apply_story_batch.return_value = ({0: {"id": 9, "status": 404}}, [])
+    vote = [{"op": "vote", "id": 9, "direction": "up"}]
+
+    with patch("api.voter_rate_limiter", RateLimiter(rate=0.5, burst=1)):
+        missing = test_client.post("/stories/batch", json=vote, headers={"X-Voter-Id": "alice"})
+        fake_apply_story_batch.return_value = ({0: {"id": 9, "status": 200}}, [])
+        cast = test_client.post("/stories/batch", json=vote, headers={"X-Voter-Id": "alice"})
+
+    assert missing.json[0]["status"] == 404
+    assert cast.json[0]["status"] == 200
+
+
+def test_batch_against_the_database(test_database_connection):
+    conn = test_database_connection
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO stories (title, url) VALUES ('A', 'a.com'), ('B', 'b.com')")
+    conn.commit()
+
+    results, stories = apply_story_batch(conn, list(enumerate([
+        {"op": "vote", "id": 1, "direction": "up"},
+        {"op": "edit", "id": 1, "title": "A2", "url": "a2.com"},
+        {"op": "delete", "id": 2},
+        {"op": "vote", "id": 2, "direction": "up"}])), "alice")
+
+    assert [results[position]["status"] for position in range(4)] == [200, 200, 200, 404]
+    with conn.cursor() as cur:
+        cur.execute("SELECT id, title, url, score FROM stories ORDER BY id")
+        assert cur.fetchall() == [(1, "A2", "a2.com", 1)]
+    assert [(story["id"], story["score"]) for story in stories] == [(1, 1)]
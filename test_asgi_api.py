@@ -0,0 +1,226 @@
+"""Route-level tests run against both the Flask API and its async variant, proving parity"""
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock
+
+pytest.importorskip("quart")
+pytest.importorskip("psycopg_pool")
+
+import api
+import asgi_api
+from db_pool import PoolTimeout
+from hot_ranking import HotRanking
+from psycopg_pool import PoolTimeout as AsyncPoolTimeout
+from rate_limit import RateLimiter
+from response_cache import ResponseCache
+
+
+class FlaskApp:
+    """Drives api.py, whose database functions are patched with MagicMocks"""
+    module = api
+    mock = MagicMock
+    pool_timeout = PoolTimeout
+
+    def fake_pool(self):
+        return MagicMock(return_value=MagicMock())
+
+    def request(self, method, path, json=None, headers=None):
+        response = api.app.test_client().open(path, method=method, json=json, headers=headers)
+        return response.status_code, response.get_data(), response.headers
+
+
+class QuartApp:
+    """Drives asgi_api.py, whose database functions are patched with AsyncMocks"""
+    module = asgi_api
+    mock = AsyncMock
+    pool_timeout = AsyncPoolTimeout
+
+    def fake_pool(self):
+        return AsyncMock(return_value=AsyncMock())
+
+    def request(self, method, path, json=None, headers=None):
+        async def send():
+            response = await asgi_api.app.test_client().open(path, method=method, json=json,
+                                                             headers=headers)
+            return response.status_code, await response.get_data(), response.headers
+        return asyncio.run(send())
+
+
+@pytest.fixture(params=[FlaskApp, QuartApp], ids=["flask", "asgi"])
+def served(request, monkeypatch):
+    """One of the two apps, with a fake pool and a fresh cache, hot ranking and rate limits"""
+    served = request.param()
+    monkeypatch.setattr(served.module, "get_pool", served.fake_pool())
+    monkeypatch.setattr(served.module, "hot_ranking", HotRanking(capacity=3))
+    monkeypatch.setattr(served.module, "story_cache", ResponseCache())
+    monkeypatch.setattr(served.module, "address_rate_limiter", RateLimiter(rate=5, burst=50))
+    monkeypatch.setattr(served.module, "voter_rate_limiter", RateLimiter(rate=1, burst=10))
+    monkeypatch.setattr(served.module, "story_rate_limiter", RateLimiter(rate=100, burst=200))
+
+    def fake(name, **kwargs):
+        mock = served.mock(**kwargs)
+        monkeypatch.setattr(served.module, name, mock)
+        return mock
+
+    served.fake = fake
+    return served
+
+
+@pytest.fixture
+def new_story(mock_stories):
+    """A story as read from the database, with a datetime the hot ranking can use"""
+    return {**mock_stories[0], "created_at": datetime(2022, 6, 24, 17, 25, 16)}
+
+
+@pytest.mark.parametrize("path", ["/", "/add", "/scrape"])
+def test_static_pages(served, path):
+    status, body, headers = served.request("GET", path)
+
+    assert status == 200
+    assert b"<html" in body.lower()
+
+
+def test_get_stories_pages_and_revalidates(served, mock_stories):
+    served.fake("loads_stories", return_value=(mock_stories, "abc"))
+
+    status, body, headers = served.request("GET", "/stories?limit=2")
+    assert status == 200
+    assert json.loads(body) == mock_stories
+    assert headers["X-Next-Cursor"] == "abc"
+
+    status, body, _ = served.request("GET", "/stories?limit=2",
+                                     headers={"If-None-Match": headers["ETag"]})
+    assert status == 304
+    assert body == b""
+
+
+@pytest.mark.parametrize("query", ["sort_by=url", "order_by=sideways", "limit=100000",
+                                   "cursor=not-a-cursor"])
+def test_get_stories_rejects_invalid_arguments(served, query):
+    status, body, _ = served.request("GET", f"/stories?{query}")
+
+    assert status == 400
+    assert json.loads(body)["error"] is True
+
+
+def test_get_stories_with_no_results(served):
+    served.fake("loads_stories", return_value=([], None))
+
+    status, body, _ = served.request("GET", "/stories?search=nothing")
+
+    assert status == 400
+    assert json.loads(body)["message"] == "No results found for your search."
+
+
+def test_post_story_returns_only_new_row(served, new_story):
+    served.fake("post_new_story", return_value=new_story)
+
+    status, body, _ = served.request("POST", "/stories?return=row",
+                                     json={"title": "Me and my friends",
+                                           "url": "www.justchilling.com"})
+
+    assert status == 201
+    assert json.loads(body) == {**new_story, "created_at": "Fri, 24 Jun 2022 17:25:16 GMT"}
+
+
+def test_post_story_returns_all_stories_with_etag(served, mock_stories, new_story):
+    served.fake("post_new_story", return_value=new_story)
+    served.fake("load_all_stories", return_value=mock_stories)
+    served.fake("get_stories_etag", return_value="fingerprint")
+
+    status, body, headers = served.request("POST", "/stories",
+                                           json={"title": "Me and my friends",
+                                                 "url": "www.justchilling.com"})
+
+    assert status == 201
+    assert json.loads(body) == mock_stories
+    assert headers["ETag"] == '"fingerprint"'
+
+
+def test_post_story_requires_title_and_url(served):
+    status, _, _ = served.request("POST", "/stories", json={"title": "No url"})
+
+    assert status == 400
+
+
+def test_patch_missing_story_returns_404(served):
+    served.fake("patch_existing_story", return_value=None)
+
+    status, _, _ = served.request("PATCH", "/stories/9", json={"title": "A", "url": "a.com"})
+
+    assert status == 404
+
+
+def test_delete_story_not_modified_for_matching_etag(served, mock_stories):
+    served.fake("delete_existing_story", return_value=mock_stories[0])
+    served.fake("get_stories_etag", return_value="fingerprint")
+    load_all_stories = served.fake("load_all_stories", return_value=mock_stories[1:])
+
+    status, _, _ = served.request("DELETE", "/stories/1",
+                                  headers={"If-None-Match": '"fingerprint"'})
+
+    assert status == 304
+    load_all_stories.assert_not_called()
+
+
+@pytest.mark.parametrize("direction, status", [("up", 200), ("sideways", 400)])
+def test_vote_on_story(served, new_story, direction, status):
+    create_new_votes_record = served.fake("create_new_votes_record",
+                                          return_value={**new_story, "score": 43})
+
+    response_status, body, _ = served.request("POST", "/stories/1/votes?return=row",
+                                              json={"direction": direction},
+                                              headers={"X-Voter-Id": "alice"})
+
+    assert response_status == status
+    if status == 200:
+        assert json.loads(body)["score"] == 43
+        create_new_votes_record.assert_called_once()
+        assert create_new_votes_record.call_args.args[1:3] == (1, "up")
+        assert create_new_votes_record.call_args.args[3].endswith(" alice")
+
+
+def test_votes_over_the_voter_limit_return_429(served, new_story):
+    served.module.voter_rate_limiter = RateLimiter(rate=0.5, burst=1)
+    create_new_votes_record = served.fake("create_new_votes_record", return_value=new_story)
+
+    statuses = [served.request("POST", "/stories/1/votes?return=row", json={"direction": "up"},
+                               headers={"X-Voter-Id": "alice"}) for _ in range(2)]
+
+    assert [status for status, _, _ in statuses] == [200, 429]
+    assert statuses[1][2]["Retry-After"] == "2"
+    create_new_votes_record.assert_called_once()
+
+
+def test_vote_on_missing_story_returns_404(served):
+    served.fake("create_new_votes_record", return_value=None)
+
+    status, _, _ = served.request("POST", "/stories/9/votes", json={"direction": "down"})
+
+    assert status == 404
+    assert served.module.voter_rate_limiter.stats()["refunded"] == 1
+
+
+def test_hot_stories_are_ranked_in_memory(served):
+    stories = [{"id": id, "score": score, "title": f"Story {id}",
+                "created_at": datetime(2022, 6, 24)} for id, score in [(1, 1), (2, 100)]]
+    load_hot_stories = served.fake("load_hot_stories", return_value=stories)
+
+    status, body, _ = served.request("GET", "/stories?sort_by=hot&limit=2")
+
+    assert status == 200
+    assert [story["id"] for story in json.loads(body)] == [2, 1]
+    load_hot_stories.assert_called_once()
+    assert load_hot_stories.call_args.args[1] == 3
+
+
+def test_exhausted_pool_returns_503(served):
+    served.module.get_pool.return_value.getconn.side_effect = served.pool_timeout("busy")
+
+    status, _, _ = served.request("POST", "/stories/1/votes", json={"direction": "up"})
+
+    assert status == 503
@@ -0,0 +1,102 @@
+"""Tests for the benchmark harness"""
+from collections import Counter
+
+import pytest
+
+from benchmark import (WORKLOAD, compare, generate_stories, generate_votes, measure_allocations,
+                       percentile, plan_requests, run_workload, seed_database, summarise)
+
+
+TEMPLATES = [
+    {"created_at": "Fri, 24 Jun 2022 17:25:16 GMT", "id": 1, "score": 42,
+     "title": "Voters Overwhelmingly Back Community Broadband",
+     "updated_at": "Fri, 24 Jun 2022 17:25:16 GMT", "url": "https://www.vice.com/broadband"},
+    {"created_at": "Fri, 24 Jun 2022 17:25:16 GMT", "id": 2, "score": 23,
+     "title": "eBird: A crowdsourced bird sighting database",
+     "updated_at": "Fri, 24 Jun 2022 17:25:16 GMT", "url": "https://ebird.org/home"}
+]
+
+
+@pytest.mark.parametrize("q, expected", [(50, 50), (95, 95), (99, 99), (100, 100)])
+def test_percentile_is_nearest_rank(q, expected):
+    assert percentile(list(range(100, 0, -1)), q) == expected
+
+
+def test_percentile_of_nothing():
+    assert percentile([], 50) is None
+
+
+def test_generated_stories_are_reproducible_with_unique_urls():
+    stories = list(generate_stories(TEMPLATES, 5, seed=1))
+
+    assert stories == list(generate_stories(TEMPLATES, 5, seed=1))
+    assert len({url for _, url, _, _ in stories}) == 5
+    assert stories[2][0] == "Voters Overwhelmingly Back Community Broadband (2)"
+
+
+def test_generated_votes_favour_popular_stories():
+    votes = list(generate_votes(100, 2000, seed=1))
+    by_story = Counter(story_id for *_, story_id in votes)
+
+    assert all(1 <= story_id <= 100 for story_id in by_story)
+    assert by_story[1] > by_story[100]
+    assert 0.75 < sum(vote[0] == "up" for vote in votes) / len(votes) < 0.85
+
+
+def test_planned_workload_follows_the_mix():
+    requests = plan_requests(TEMPLATES, 100, 4000, seed=1)
+    kinds = Counter(endpoint.split(":")[0] for endpoint, *_ in requests)
+
+    assert requests == plan_requests(TEMPLATES, 100, 4000, seed=1)
+    voters = [headers["X-Voter-Id"] for endpoint, *_, headers in requests if endpoint == "vote"]
+    assert len(set(voters)) == len(voters) == kinds["vote"]
+    for kind, share in WORKLOAD.items():
+        assert kinds[kind] / len(requests) == pytest.approx(share, abs=0.03)
+
+
+def test_workload_is_timed_per_endpoint():
+    requests = [("vote", "POST", "/stories/1/votes", {"direction": "up"}, {"X-Voter-Id": "a"}),
+                ("list:id", "GET", "/stories", None, None),
+                ("vote", "POST", "/stories/2/votes", {"direction": "up"}, {"X-Voter-Id": "b"}),
+                ("vote", "POST", "/stories/3/votes", {"direction": "up"}, {"X-Voter-Id": "c"})]
+    statuses = {"1": 201, "2": 503, "3": 429}
+
+    samples, wall_time = run_workload(
+        lambda method, path, body, headers: statuses.get(path[-7], 200), requests, threads=2)
+    report = summarise(samples, wall_time)
+
+    assert report["vote"]["requests"] == 3
+    assert report["vote"]["errors"] == 2
+    assert report["all"]["requests"] == 4
+    assert report["all"]["alloc_kib"] is None
+
+
+def test_allocations_are_measured_per_endpoint():
+    allocations = measure_allocations(
+        lambda method, path, body, headers: bytearray(64 * 1024) and 200,
+        [("list:id", "GET", "/stories", None, None)] * 3)
+
+    assert allocations["list:id"] >= 64
+
+
+def test_regressions_are_reported_beyond_tolerance():
+    baseline = {"vote": {"p95_ms": 10.0, "p99_ms": 20.0, "throughput": 100.0, "alloc_kib": 50.0}}
+    report = {"vote": {"p95_ms": 11.0, "p99_ms": 30.0, "throughput": 70.0, "alloc_kib": 50.0},
+              "edit": {"p95_ms": 99.0}}
+
+    regressions = compare(report, baseline, tolerance=0.2)
+
+    assert regressions == ["vote p99_ms: 20.0 -> 30.0 (+50%)",
+                           "vote throughput: 100.0 -> 70.0 (-30%)"]
+
+
+def test_seeding_reconciles_scores(test_database_connection):
+    conn = test_database_connection
+
+    seed_database(conn, TEMPLATES, 10, 200)
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*), SUM(score), SUM(upvotes + downvotes) FROM stories")
+        stories, score, votes = cur.fetchone()
+    up = sum(vote[0] == "up" for vote in generate_votes(10, 200))
+    assert (stories, score, votes) == (10, up - (200 - up), 200)
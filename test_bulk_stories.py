@@ -0,0 +1,141 @@
+"""Tests for bulk story import and export"""
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from psycopg2 import DataError
+
+from bulk_stories import (EXPORT_COLUMNS, export_stories, import_stories, iter_json_records,
+                          parse_timestamp, validate_story)
+
+
+def records_from(text, chunk_size=4):
+    return list(iter_json_records(io.BytesIO(text.encode()), chunk_size))
+
+
+def test_json_array_is_read_in_chunks(mock_stories):
+    assert records_from(json.dumps(mock_stories, indent=4)) == mock_stories
+
+
+def test_ndjson_is_read_in_chunks(mock_stories):
+    text = "\n".join(json.dumps(story) for story in mock_stories) + "\n\n"
+
+    assert records_from(text) == mock_stories
+
+
+def test_empty_array_has_no_records():
+    assert records_from("  [ ]  ") == []
+
+
+def test_unterminated_array_is_an_error():
+    with pytest.raises(ValueError):
+        records_from('[{"title": "A"},')
+
+
+@pytest.mark.parametrize("text", ["[1 2]", '[{"title": "A"} {"title": "B"}]', "[1,]", "[,1]"])
+def test_records_must_be_separated_by_commas(text):
+    with pytest.raises(ValueError):
+        records_from(text)
+
+
+def test_values_cut_across_chunks_are_read_whole():
+    assert records_from('[-123456, "\\u00e9t\\u00e9", true, {"a": null}]', chunk_size=1) == [
+        -123456, "\u00e9t\u00e9", True, {"a": None}]
+
+
+def test_malformed_record_fails_without_reading_the_rest():
+    stream = io.BytesIO(('[{"title": oops}, ' + '{"title": "A"}, ' * 10000 + "]").encode())
+
+    with pytest.raises(ValueError):
+        list(iter_json_records(stream, chunk_size=64))
+
+    assert stream.tell() <= 128
+
+
+def test_timestamps_from_stories_json_and_iso_are_parsed_as_utc():
+    assert parse_timestamp("Fri, 24 Jun 2022 17:25:16 GMT") == datetime(2022, 6, 24, 17, 25, 16)
+    assert parse_timestamp("2022-06-24T18:25:16+01:00") == datetime(2022, 6, 24, 17, 25, 16)
+
+
+@pytest.mark.parametrize("record", [
+    ["not", "an", "object"],
+    {"url": "www.hi.com"},
+    {"title": "  ", "url": "www.hi.com"},
+    {"title": "HI", "url": "www.hi.com", "created_at": "yesterday"},
+    {"title": "HI", "url": "www.hi.com", "created_at": 5},
+    {"title": "HI", "url": "www.hi.com", "updated_at": []},
+])
+def test_invalid_records_are_rejected(record):
+    with pytest.raises(ValueError):
+        validate_story(record)
+
+
+@patch("bulk_stories.copy_stories")
+def test_import_loads_valid_records_in_batches(fake_copy_stories, mock_stories):
+    conn = MagicMock()
+    records = [*mock_stories, {"title": "No url"}, mock_stories[0]]
+
+    report = import_stories(conn, iter(records), batch_size=2)
+
+    assert report["inserted"] == 3
+    assert report["rejected"] == 1
+    assert report["batches"] == 2
+    assert report["errors"] == [{"index": 2, "error": "'url' must be a non-empty string"}]
+    assert fake_copy_stories.call_count == 2
+    assert conn.commit.call_count == 2
+
+
+@patch("bulk_stories.copy_stories")
+def test_import_reports_non_string_timestamps(fake_copy_stories, mock_stories):
+    records = [{**mock_stories[0], "created_at": 5}, mock_stories[1]]
+
+    report = import_stories(MagicMock(), iter(records))
+
+    assert report["inserted"] == 1
+    assert report["errors"] == [{"index": 0, "error": "Invalid timestamp 5"}]
+
+
+@patch("bulk_stories.copy_stories")
+def test_import_reports_failed_batch_and_continues(fake_copy_stories, mock_stories):
+    conn = MagicMock()
+    fake_copy_stories.side_effect = [DataError("value too long"), None]
+
+    report = import_stories(conn, iter(mock_stories), batch_size=1)
+
+    assert report["inserted"] == 1
+    assert report["rejected"] == 1
+    assert report["errors"] == [{"batch": 1, "error": "value too long"}]
+    conn.rollback.assert_called_once()
+
+
+@patch("bulk_stories.copy_stories")
+def test_import_stops_at_malformed_json_keeping_earlier_records(fake_copy_stories):
+    report = import_stories(MagicMock(), iter_json_records(
+        io.BytesIO(b'{"title": "A", "url": "a.com"}\n{"title": ')))
+
+    assert report["inserted"] == 1
+    assert report["errors"][0]["error"].startswith("Malformed JSON")
+
+
+def test_export_streams_rows_from_server_side_cursor():
+    conn = MagicMock()
+    cur = conn.cursor.return_value
+    cur.__iter__.return_value = iter([
+        (1, "HI", "www.hi.com", 2, 3, 1, datetime(2022, 6, 24), datetime(2022, 6, 25))])
+    cur.description = [MagicMock() for _ in EXPORT_COLUMNS]
+    for column, name in zip(cur.description, EXPORT_COLUMNS):
+        column.name = name
+
+    lines = list(export_stories(conn, batch_size=10))
+
+    conn.cursor.assert_called_once_with(name="export_stories")
+    assert cur.itersize == 10
+    assert json.loads(lines[0]) == {"id": 1, "title": "HI", "url": "www.hi.com", "score": 2,
+                                    "upvotes": 3, "downvotes": 1,
+                                    "created_at": "2022-06-24T00:00:00",
+                                    "updated_at": "2022-06-25T00:00:00"}
+    cur.close.assert_called_once()
@@ -0,0 +1,100 @@
+"""Tests for the database connection pool"""
+import threading
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+
+from db_pool import ConnectionPool, PoolTimeout
+
+
+def fake_connection():
+    """A mock psycopg2 connection that is open and idle"""
+    conn = MagicMock()
+    conn.closed = 0
+    conn.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+    return conn
+
+
+def test_pool_opens_min_size_connections():
+    connect = MagicMock(side_effect=fake_connection)
+
+    pool = ConnectionPool(connect, min_size=2, max_size=4)
+
+    assert connect.call_count == 2
+    assert pool.stats()["idle"] == 2
+
+
+def test_pool_reuses_returned_connections():
+    pool = ConnectionPool(fake_connection, min_size=0, max_size=2)
+
+    conn = pool.getconn()
+    pool.putconn(conn)
+
+    assert pool.getconn() is conn
+    assert pool.stats()["checkouts"] == 2
+
+
+def test_pool_times_out_when_exhausted():
+    pool = ConnectionPool(fake_connection, min_size=0, max_size=1, timeout=0.05)
+    pool.getconn()
+
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_waiting_checkout_receives_returned_connection():
+    pool = ConnectionPool(fake_connection, min_size=1, max_size=1, timeout=2)
+    conn = pool.getconn()
+
+    timer = threading.Timer(0.05, pool.putconn, args=(conn, ))
+    timer.start()
+
+    assert pool.getconn() is conn
+    assert pool.stats()["wait_seconds_max"] > 0
+
+
+def test_pool_rolls_back_open_transactions_on_return():
+    pool = ConnectionPool(fake_connection, min_size=0, max_size=1)
+    conn = pool.getconn()
+    conn.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+
+    pool.putconn(conn)
+
+    conn.rollback.assert_called_once()
+    assert pool.stats()["idle"] == 1
+
+
+def test_pool_reconnects_closed_connections():
+    pool = ConnectionPool(fake_connection, min_size=1, max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.closed = 1
+
+    new_conn = pool.getconn()
+
+    assert new_conn is not conn
+    assert pool.stats()["reconnects"] == 1
+
+
+def test_pool_reconnects_when_health_check_fails():
+    pool = ConnectionPool(fake_connection, min_size=1, max_size=1, health_check_after=0)
+    conn = pool.getconn()
+    conn.cursor.return_value.__enter__.return_value.execute.side_effect = OperationalError
+    pool.putconn(conn)
+
+    assert pool.getconn() is not conn
+
+
+def test_failed_connect_frees_its_slot():
+    pool = ConnectionPool(MagicMock(side_effect=OperationalError), min_size=0, max_size=1)
+
+    with pytest.raises(OperationalError):
+        pool.getconn()
+
+    assert pool.stats()["size"] == 0
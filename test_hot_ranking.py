@@ -0,0 +1,73 @@
+"""Tests for the in-memory hot ranking"""
+from datetime import datetime, timedelta
+
+from hot_ranking import HOT_DECAY_SECONDS, HotRanking, hot_score
+
+
+NOW = datetime(2022, 6, 24, 17, 25, 16)
+
+
+def story(id, score, hours_old=0):
+    return {"id": id, "score": score, "title": f"Story {id}",
+            "created_at": NOW - timedelta(hours=hours_old)}
+
+
+def test_newer_stories_are_hotter_at_equal_score():
+    assert hot_score(10, NOW) > hot_score(10, NOW - timedelta(hours=1))
+
+
+def test_ten_times_the_score_is_worth_the_decay_period():
+    older = NOW - timedelta(seconds=HOT_DECAY_SECONDS)
+
+    assert abs(hot_score(100, older) - hot_score(10, NOW)) < 1e-6
+
+
+def test_negative_scores_rank_below_zero():
+    assert hot_score(-10, NOW) < hot_score(0, NOW)
+
+
+def test_refresh_orders_hottest_first():
+    ranking = HotRanking()
+
+    ranking.refresh([story(1, 5, hours_old=48), story(2, 5), story(3, 50)])
+
+    assert [s["id"] for s in ranking.top(3)] == [3, 2, 1]
+    assert not ranking.is_stale()
+
+
+def test_update_moves_voted_story():
+    ranking = HotRanking()
+    ranking.refresh([story(1, 5), story(2, 4)])
+
+    ranking.update(story(2, 500))
+
+    assert [s["id"] for s in ranking.top(2)] == [2, 1]
+    assert ranking.top(1)[0]["score"] == 500
+
+
+def test_capacity_evicts_coldest_story():
+    ranking = HotRanking(capacity=2)
+    ranking.refresh([story(1, 5), story(2, 4)])
+
+    ranking.update(story(3, 100))
+    ranking.update(story(4, -100))
+
+    assert [s["id"] for s in ranking.top(5)] == [3, 1]
+
+
+def test_remove_drops_story():
+    ranking = HotRanking()
+    ranking.refresh([story(1, 5), story(2, 4)])
+
+    ranking.remove(1)
+    ranking.remove(7)
+
+    assert [s["id"] for s in ranking.top(5)] == [2]
+
+
+def test_ranking_is_stale_before_first_refresh_and_after_interval():
+    ranking = HotRanking(refresh_interval=0)
+
+    assert ranking.is_stale()
+    ranking.refresh([])
+    assert ranking.is_stale()
@@ -0,0 +1,190 @@
+"""Tests for the news scraper, run offline against a saved page and a local stub server"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from news_scraper import (DEFAULT_SOURCES, HostRateLimiter, allowed_source, get_html,
+                          insert_stories, normalise_url, parse_stories_bs, scrape_sources,
+                          url_hash)
+
+
+NEWS_PAGE = (Path(__file__).parent / "fixtures" / "news_page.html").read_text()
+
+
+class StubNewsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the saved news page with an ETag, and a slow page, a missing
+    page, a page in an unknown charset and redirects on and off the host
+    """
+
+    requests = []
+
+    def do_GET(self):
+        StubNewsHandler.requests.append((self.path, self.headers.get("If-None-Match")))
+
+        if self.path == "/slow":
+            time.sleep(0.5)
+
+        if self.path in {"/moved", "/moved-away"}:
+            host = "127.0.0.1" if self.path == "/moved" else "localhost"
+            self.send_response(302)
+            self.send_header("Location", f"http://{host}:{self.server.server_port}/news")
+            self.end_headers()
+            return
+
+        if self.path not in {"/news", "/slow", "/odd-charset"}:
+            self.send_error(404)
+            return
+
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = NEWS_PAGE.encode()
+        self.send_response(200)
+        charset = "x-unknown" if self.path == "/odd-charset" else "utf-8"
+        self.send_header("Content-Type", f"text/html; charset={charset}")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    """A local HTTP server serving the saved news page"""
+    StubNewsHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubNewsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield f"http://127.0.0.1:{server.server_port}"
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_stories_finds_heading_links():
+    stories = parse_stories_bs("https://news.example.com/news", NEWS_PAGE)
+
+    assert stories[1:3] == [
+        {"title": "Voters Overwhelmingly Back Community Broadband",
+         "url": "https://news.example.com/news/articles/voters-back-community-broadband"},
+        {"title": "eBird: A crowdsourced bird sighting database",
+         "url": "https://other.example.org/science/birds"}]
+    assert "Subscribe" not in [story["title"] for story in stories]
+
+
+def test_parse_stories_uses_source_selector():
+    stories = parse_stories_bs("https://news.example.com/", NEWS_PAGE, "a.promo-link")
+
+    assert stories == [{"title": "A promoted story",
+                        "url": "https://news.example.com/news/promoted"}]
+
+
+def test_url_hash_ignores_trivial_differences():
+    assert url_hash("HTTPS://News.Example.com/a/#top") == url_hash("https://news.example.com/a")
+    assert normalise_url("https://news.example.com") == "https://news.example.com/"
+
+
+def test_get_html_sends_validators_and_handles_not_modified(stub_server):
+    first = get_html(f"{stub_server}/news")
+    second = get_html(f"{stub_server}/news", first)
+
+    assert "Example News" in first["html"]
+    assert first["etag"] == '"v1"'
+    assert second == {"html": None, "etag": '"v1"', "last_modified": None}
+    assert StubNewsHandler.requests[-1] == ("/news", '"v1"')
+
+
+def test_scrape_sources_dedups_and_skips_unchanged_pages(stub_server):
+    state = {}
+    sources = [{"url": f"{stub_server}/news"}]
+
+    first = scrape_sources(sources, state, min_interval=0)
+    second = scrape_sources(sources, state, min_interval=0)
+
+    assert len(first) == 3
+    assert second == []
+
+
+def test_scrape_sources_skips_failing_sources(stub_server):
+    sources = [{"url": f"{stub_server}/missing"}, {"url": f"{stub_server}/slow"},
+               {"url": f"{stub_server}/news"}]
+
+    stories = scrape_sources(sources, timeout=0.1, min_interval=0)
+
+    assert len(stories) == 3
+
+
+def test_unknown_charsets_are_decoded_as_utf8(stub_server):
+    page = get_html(f"{stub_server}/odd-charset")
+
+    assert page["html"] == NEWS_PAGE
+
+
+def test_redirects_are_only_followed_on_source_hosts(stub_server):
+    sources = [{"url": f"{stub_server}/moved"}, {"url": f"{stub_server}/moved-away"}]
+
+    assert get_html(f"{stub_server}/moved")["html"] is not None
+    assert len(scrape_sources(sources, min_interval=0)) == 3
+    assert [path for path, _ in StubNewsHandler.requests].count("/news") == 2
+
+
+def test_rate_limiter_spaces_requests_to_same_host():
+    limiter = HostRateLimiter(min_interval=0.05)
+    start = time.monotonic()
+
+    limiter.wait("news.example.com")
+    limiter.wait("other.example.org")
+    limiter.wait("news.example.com")
+
+    assert 0.05 <= time.monotonic() - start < 0.5
+
+
+@patch("news_scraper.psycopg2.extras.execute_values")
+def test_insert_stories_uses_one_statement(fake_execute_values):
+    conn = MagicMock()
+    fake_execute_values.return_value = [{"id": 1}]
+    stories = [{"title": "A", "url": "https://a.example.com/"},
+               {"title": "B", "url": "https://b.example.com/"}]
+
+    assert insert_stories(conn, stories) == [{"id": 1}]
+    assert fake_execute_values.call_args.args[2] == [("A", "https://a.example.com/"),
+                                                     ("B", "https://b.example.com/")]
+    conn.commit.assert_called_once()
+
+
+def test_insert_skips_urls_already_stored(test_database_connection):
+    conn = test_database_connection
+    first = [{"title": "A", "url": "https://a.example.com/"}]
+    second = [{"title": "A again", "url": "https://a.example.com/"},
+              {"title": "B", "url": "https://b.example.com/"},
+              {"title": "B again", "url": "https://b.example.com/"}]
+
+    assert [story["title"] for story in insert_stories(conn, first)] == ["A"]
+    assert [story["title"] for story in insert_stories(conn, second)] == ["B"]
+
+
+def test_insert_no_stories_skips_database():
+    conn = MagicMock()
+
+    assert insert_stories(conn, []) == []
+    conn.cursor.assert_not_called()
+
+
+def test_only_pages_on_source_hosts_are_allowed():
+    source = allowed_source("https://www.bbc.co.uk/news/world", DEFAULT_SOURCES)
+
+    assert source == {**DEFAULT_SOURCES[0], "url": "https://www.bbc.co.uk/news/world"}
+    assert allowed_source("http://127.0.0.1/", DEFAULT_SOURCES) is None
+    assert allowed_source("https://bbc.co.uk.attacker.example/", DEFAULT_SOURCES) is None
@@ -0,0 +1,138 @@
+"""Tests for statement timing and the slow query log"""
+import logging
+
+import pytest
+
+from unittest.mock import MagicMock, patch
+
+from query_stats import Histogram, QueryStats, timed_cursor_class
+
+
+class FakeCursor:
+    """Stands in for a psycopg2 (unnamed) cursor class, returning canned rows"""
+
+    name = None
+
+    def __init__(self, connection, rows=()):
+        self.connection = connection
+        self.rows = list(rows)
+        self.query = None
+
+    def execute(self, query, vars=None):
+        if query == "fail":
+            raise ValueError("bad statement")
+        self.query = query.encode()
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.rows:
+            raise StopIteration
+        return self.rows.pop(0)
+
+
+@pytest.fixture
+def stats():
+    stats = QueryStats(slow_query_ms=float("inf"))
+    with patch("query_stats.query_stats", stats):
+        yield stats
+
+
+def test_histogram_buckets_durations():
+    histogram = Histogram(buckets=(1, 10))
+    for value in [0.5, 1, 5, 50]:
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+
+    assert snapshot["buckets"] == {"le_1": 2, "le_10": 1, "inf": 1}
+    assert snapshot["count"] == 4
+    assert snapshot["max_ms"] == 50
+
+
+def test_timed_cursor_keeps_its_factory():
+    timed = timed_cursor_class(FakeCursor)
+
+    assert issubclass(timed, FakeCursor)
+    assert timed_cursor_class(FakeCursor) is timed
+
+
+def test_request_counts_round_trips_and_rows(stats):
+    stats.begin_request()
+    cur = timed_cursor_class(FakeCursor)(MagicMock(), rows=[(1, ), (2, ), (3, )])
+
+    cur.execute("SELECT id FROM stories")
+    cur.fetchone()
+    rows = list(cur)
+    with pytest.raises(ValueError):
+        cur.execute("fail")
+    request = stats.end_request("get_stories")
+
+    assert rows == [(2, ), (3, )]
+    assert request.round_trips == 2
+    assert request.rows == 3
+    snapshot = stats.snapshot()
+    assert snapshot["statements"]["count"] == 2
+    assert snapshot["endpoints"]["get_stories"]["total"]["count"] == 1
+    assert snapshot["endpoints"]["get_stories"]["rows_per_request"] == 3
+
+
+def test_named_cursor_fetches_are_round_trips(stats, test_database_connection):
+    conn = test_database_connection
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO stories (title, url)
+                    SELECT 'A', 'a.com/' || n FROM generate_series(1, 5) AS n""")
+    conn.commit()
+
+    stats.begin_request()
+    cur = conn.cursor(name="listing")
+    cur.itersize = 2
+    cur.execute("SELECT id FROM stories ORDER BY id")
+    ids = [id for id, in cur]
+    cur.close()
+    request = stats.end_request("get_stories")
+
+    assert ids == [1, 2, 3, 4, 5]
+    # DECLARE, then FETCH FORWARD 2 until one comes back empty
+    assert request.round_trips == 5
+    assert request.rows == 5
+
+
+def test_statements_outside_requests_are_only_aggregated(stats):
+    timed_cursor_class(FakeCursor)(MagicMock()).execute("SELECT 1")
+
+    assert stats.end_request("get_stories") is None
+    assert stats.snapshot()["statements"]["count"] == 1
+    assert stats.snapshot()["endpoints"] == {}
+
+
+def test_slow_queries_are_logged_with_their_plan(stats, caplog):
+    stats.slow_query_ms = 0
+    conn = MagicMock()
+    conn.explain.return_value = "Index Scan using stories_pkey on stories"
+
+    with caplog.at_level(logging.WARNING, logger="query_stats"):
+        timed_cursor_class(FakeCursor)(conn).execute("SELECT * FROM stories WHERE id = 1")
+
+    conn.explain.assert_called_once_with(b"SELECT * FROM stories WHERE id = 1")
+    assert "Index Scan using stories_pkey" in caplog.text
+    assert stats.snapshot()["slow_queries"] == 1
+
+
+def test_slow_query_plans_can_be_turned_off(stats):
+    stats.slow_query_ms = 0
+    stats.explain_slow_queries = False
+    conn = MagicMock()
+
+    timed_cursor_class(FakeCursor)(conn).execute("SELECT 1")
+
+    conn.explain.assert_not_called()
+    assert stats.snapshot()["slow_queries"] == 1
@@ -0,0 +1,63 @@
+"""Tests for the token-bucket rate limiter"""
+import pytest
+
+from unittest.mock import patch
+
+from rate_limit import RateLimiter
+
+
+def test_burst_is_allowed_then_limited():
+    limiter = RateLimiter(rate=1, burst=3)
+    with patch("rate_limit.monotonic", return_value=100.0):
+        waits = [limiter.acquire("alice") for _ in range(4)]
+
+    assert waits[:3] == [0, 0, 0]
+    assert waits[3] == pytest.approx(1.0)
+    assert limiter.stats()["allowed"] == 3
+    assert limiter.stats()["limited"] == 1
+
+
+def test_tokens_refill_over_time():
+    limiter = RateLimiter(rate=2, burst=1)
+    with patch("rate_limit.monotonic", side_effect=[0.0, 0.1, 0.5]):
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("alice") == pytest.approx(0.4)
+        assert limiter.acquire("alice") == 0
+
+
+def test_keys_have_separate_buckets():
+    limiter = RateLimiter(rate=1, burst=1)
+    with patch("rate_limit.monotonic", return_value=0.0):
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("bob") == 0
+        assert limiter.acquire("alice") > 0
+
+
+def test_least_recently_used_keys_are_dropped():
+    limiter = RateLimiter(rate=1, burst=1, max_keys=2)
+    with patch("rate_limit.monotonic", return_value=0.0):
+        for key in ["alice", "bob", "carol"]:
+            limiter.acquire(key)
+
+        assert limiter.stats()["keys"] == 2
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("carol") > 0
+
+
+def test_limits_must_allow_something():
+    with pytest.raises(ValueError):
+        RateLimiter(rate=0, burst=1)
+
+
+def test_refunded_tokens_can_be_taken_again():
+    limiter = RateLimiter(rate=1, burst=1)
+    with patch("rate_limit.monotonic", return_value=0.0):
+        assert limiter.acquire("alice") == 0
+        limiter.refund("alice")
+        limiter.refund("alice")
+        limiter.refund("bob")
+
+        assert limiter.acquire("alice") == 0
+        assert limiter.acquire("alice") > 0
+    assert limiter.stats()["refunded"] == 2
+    assert limiter.stats()["keys"] == 1
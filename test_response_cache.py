@@ -0,0 +1,146 @@
+"""Tests for the story response cache"""
+import time
+
+from response_cache import MemoryBackend, ResponseCache
+
+
+def cache_page(cache, key, story_ids, sort_by="id", is_search=False):
+    return cache.put(key, b"[]", None, story_ids, sort_by, is_search)
+
+
+def test_memory_backend_evicts_least_recently_used():
+    evicted = []
+    backend = MemoryBackend(max_entries=2, on_evict=evicted.append)
+    backend.set("a", 1, 60)
+    backend.set("b", 2, 60)
+    backend.get("a")
+
+    backend.set("c", 3, 60)
+
+    assert backend.get("b") is None
+    assert backend.get("a") == 1
+    assert evicted == ["b"]
+
+
+def test_memory_backend_is_bounded_by_bytes():
+    evicted = []
+    backend = MemoryBackend(on_evict=evicted.append, max_bytes=10)
+    backend.set("a", b"12345", 60)
+    backend.set("b", b"1234", 60)
+
+    backend.set("c", b"123", 60)
+    backend.set("d", b"12345678901", 60)
+
+    assert [backend.get(key) for key in "abcd"] == [None, b"1234", b"123", None]
+    assert backend.bytes == 7
+    assert evicted == ["a", "d"]
+
+
+def test_memory_backend_expires_entries():
+    backend = MemoryBackend()
+    backend.set("a", 1, 0.01)
+
+    time.sleep(0.02)
+
+    assert backend.get("a") is None
+
+
+def test_cache_counts_hits_and_misses():
+    cache = ResponseCache()
+    cache_page(cache, "page", [1, 2])
+
+    assert cache.get("page").etag
+    assert cache.get("other") is None
+    assert cache.stats()["hit_rate"] == 0.5
+
+
+def test_invalidating_story_drops_only_pages_containing_it():
+    cache = ResponseCache()
+    cache_page(cache, "first", [1, 2])
+    cache_page(cache, "second", [3, 4])
+
+    cache.invalidate_story(2)
+
+    assert cache.get("first") is None
+    assert cache.get("second") is not None
+    assert cache.stats()["invalidated_entries"] == 1
+
+
+def test_invalidating_story_drops_pages_sorted_by_changed_columns():
+    cache = ResponseCache()
+    cache_page(cache, "by_score", [3], sort_by="score")
+    cache_page(cache, "by_title", [4], sort_by="title")
+
+    cache.invalidate_story(1, {"score"})
+
+    assert cache.get("by_score") is None
+    assert cache.get("by_title") is not None
+
+
+def test_invalidating_searchable_text_drops_searches():
+    cache = ResponseCache()
+    cache_page(cache, "search", [3], is_search=True)
+
+    cache.invalidate_story(1, affects_search=True)
+
+    assert cache.get("search") is None
+
+
+def test_page_read_before_an_invalidation_is_not_cached():
+    cache = ResponseCache()
+    generation = cache.generation()
+    cache.invalidate_all()
+
+    cache.put("page", b"[]", None, [1], "id", False, generation)
+
+    assert cache.get("page") is None
+
+
+def test_evicted_pages_are_untagged():
+    cache = ResponseCache(max_entries=1)
+    cache_page(cache, "first", [1])
+
+    cache_page(cache, "second", [2])
+
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["evictions"] == 1
+
+
+class ForgetfulBackend:
+    """A backend that drops entries without reporting it, like a shared cache server"""
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, value, ttl):
+        self.entries[key] = value
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def test_pages_lost_by_the_backend_are_untagged_when_they_miss():
+    backend = ForgetfulBackend()
+    cache = ResponseCache(backend)
+    cache_page(cache, "first", [1])
+    backend.entries.clear()
+
+    assert cache.get("first") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_expired_pages_are_untagged_without_lookups():
+    cache = ResponseCache(ForgetfulBackend(), ttl=0.01)
+    cache_page(cache, "first", [1])
+    cache_page(cache, "second", [2])
+
+    time.sleep(0.02)
+    cache_page(cache, "third", [3])
+
+    assert cache.stats()["entries"] == 1
@@ -0,0 +1,44 @@
+"""Tests for the per-request sampling profiler"""
+import threading
+import time
+
+from sampling_profiler import ProfileStore, SamplingProfiler
+
+
+def busy_wait(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_samples_are_folded_stacks_of_the_profiled_thread():
+    profiler = SamplingProfiler(interval=0.001).start()
+    busy_wait(0.05)
+    samples = profiler.stop()
+
+    assert sum(samples.values()) > 0
+    assert all("test_sampling_profiler.py:busy_wait" in stack
+               for stack in samples if stack.endswith("busy_wait"))
+    assert any(stack.endswith("test_sampling_profiler.py:busy_wait") for stack in samples)
+    stack, n = profiler.folded().splitlines()[0].rsplit(" ", 1)
+    assert samples[stack] == int(n)
+
+
+def test_sampling_a_finished_thread_records_nothing():
+    thread = threading.Thread(target=lambda: None)
+    thread.start()
+    thread.join()
+    profiler = SamplingProfiler(thread_id=thread.ident)
+
+    profiler.sample()
+
+    assert not profiler.samples
+
+
+def test_store_keeps_the_most_recent_profiles():
+    store = ProfileStore(max_profiles=2)
+    ids = [store.add(f"GET /stories?page={n}", f"stack {n}\n") for n in range(3)]
+
+    assert store.get(ids[0]) is None
+    assert store.get(ids[2]) == ("GET /stories?page=2", "stack 2\n")
+    assert [profile["id"] for profile in store.list()] == ids[:0:-1]
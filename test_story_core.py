@@ -0,0 +1,49 @@
+"""Tests for the framework-agnostic parts of the story API shared by both apps"""
+import pytest
+
+from unittest.mock import MagicMock
+
+from rate_limit import RateLimiter
+from story_core import (MAX_VOTER_ID_LENGTH, STORY_URL_CONSTRAINT, duplicate_url, identify_voter,
+                        refund_vote_tokens, take_vote_tokens, too_many_votes)
+
+
+def test_voters_are_qualified_by_their_address():
+    assert identify_voter("10.0.0.1", "alice") == "10.0.0.1 alice"
+    assert identify_voter("10.0.0.1") == "10.0.0.1"
+    assert identify_voter(None, "alice") == "unknown alice"
+
+    with pytest.raises(ValueError):
+        identify_voter("10.0.0.1", "x" * (MAX_VOTER_ID_LENGTH + 1))
+
+
+def test_refused_vote_gives_back_the_tokens_already_taken():
+    voter, story = RateLimiter(rate=1, burst=5), RateLimiter(rate=1, burst=1)
+    limits = [(voter, "alice"), (story, 7)]
+
+    assert take_vote_tokens(limits) == 0
+    assert take_vote_tokens(limits) > 0
+    refund_vote_tokens(limits)
+
+    assert voter.stats()["refunded"] == 2
+    assert story.stats()["refunded"] == 1
+
+
+def test_too_many_votes_asks_to_retry_after_whole_seconds():
+    body, status, headers = too_many_votes(0.2)
+
+    assert body["error"] is True
+    assert status == 429
+    assert headers == {"Retry-After": "1"}
+
+
+def test_only_repeated_urls_answer_409():
+    error = MagicMock()
+    error.diag.constraint_name = STORY_URL_CONSTRAINT
+    assert duplicate_url(error)[1] == 409
+
+    other = Exception()
+    other.diag = MagicMock(constraint_name="votes_voter_id_story_id_idx")
+    with pytest.raises(Exception) as raised:
+        duplicate_url(other)
+    assert raised.value is other
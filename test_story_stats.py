@@ -0,0 +1,174 @@
+"""Tests for the domain and vote rollups behind /stats"""
+from datetime import timedelta
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from api import create_new_votes_record
+from story_stats import (HOURLY_RETENTION, MAX_PERIODS, compact_vote_buckets, fold_domain_stats,
+                         load_domain_stats, load_top_movers, load_vote_activity, rebuild_stats)
+
+
+def test_vote_activity_spans_the_requested_periods():
+    conn = MagicMock()
+
+    load_vote_activity(conn, "day", 30)
+
+    _, params = conn.cursor.return_value.execute.call_args.args
+    assert params == {"granularity": "day", "span": timedelta(days=29), "step": timedelta(days=1),
+                      "granularities": ["hour", "day"]}
+
+
+def test_domains_are_only_sorted_by_known_columns():
+    with pytest.raises(ValueError):
+        load_domain_stats(MagicMock(), "url; DROP TABLE stories", 10)
+
+
+def test_compaction_keeps_daily_buckets_by_default():
+    conn = MagicMock()
+    conn.cursor.return_value.fetchone.return_value = {"compacted": 3, "daily": 1, "expired": 0}
+
+    report = compact_vote_buckets(conn, keep_hours=48)
+
+    _, params = conn.cursor.return_value.execute.call_args.args
+    assert params == {"keep_hours": timedelta(hours=48), "keep_days": None}
+    assert report["compacted"] == 3
+    conn.commit.assert_called_once()
+
+
+# Rollups maintained by the triggers in schema.sql
+def fetch(conn, query):
+    with conn.cursor() as cur:
+        cur.execute(query)
+        return cur.fetchall()
+
+
+def add_story(conn, title, url):
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO stories (title, url) VALUES (%s, %s) RETURNING id", (title, url))
+        story_id = cur.fetchone()[0]
+    conn.commit()
+    return story_id
+
+
+def test_domains_follow_story_writes(test_database_connection):
+    conn = test_database_connection
+    first = add_story(conn, "First", "https://www.example.com/a")
+    add_story(conn, "Second", "example.com:8080/b?c=d")
+    third = add_story(conn, "Third", "http://news.org")
+
+    create_new_votes_record(conn, first, "up", "alice")
+    create_new_votes_record(conn, first, "down", "alice")
+    create_new_votes_record(conn, third, "up", "alice")
+    with conn.cursor() as cur:
+        cur.execute("UPDATE stories SET title = 'Renamed' WHERE id = %s", (first, ))
+        cur.execute("DELETE FROM stories WHERE id = %s", (third, ))
+    conn.commit()
+
+    # Votes only log their changes until they are folded in
+    assert fetch(conn, "SELECT domain, stories, score FROM domain_stats "
+                       "ORDER BY domain") == [("example.com", 2, 0), ("news.org", 0, -1)]
+    assert fold_domain_stats(conn) == {"changes": 3, "domains": 2}
+    assert fetch(conn, "SELECT domain, stories, score, upvotes, downvotes FROM domain_stats "
+                       "ORDER BY domain") == [("example.com", 2, -1, 0, 1), ("news.org", 0, 0, 0, 0)]
+    assert [dict(row) for row in load_domain_stats(conn, "stories", 10)] == [
+        {"domain": "example.com", "stories": 2, "score": -1, "upvotes": 0, "downvotes": 1}]
+
+
+def test_stories_moving_domain_before_a_fold_keep_exact_totals(test_database_connection):
+    conn = test_database_connection
+    story = add_story(conn, "Moving", "example.com/a")
+
+    create_new_votes_record(conn, story, "up", "alice")
+    create_new_votes_record(conn, story, "up", "bob")
+    with conn.cursor() as cur:
+        cur.execute("UPDATE stories SET url = 'news.org/a' WHERE id = %s", (story, ))
+    conn.commit()
+    create_new_votes_record(conn, story, "down", "bob")
+
+    # Reading the domains folds the logged changes in
+    assert [dict(row) for row in load_domain_stats(conn, "score", 10)] == [
+        {"domain": "news.org", "stories": 1, "score": 0, "upvotes": 1, "downvotes": 1}]
+    assert fetch(conn, "SELECT domain, stories, score, upvotes, downvotes FROM domain_stats "
+                       "ORDER BY domain") == [("example.com", 0, 0, 0, 0), ("news.org", 1, 0, 1, 1)]
+    assert fetch(conn, "SELECT COUNT(*) FROM domain_stat_changes") == [(0, )]
+
+
+def test_vote_buckets_count_net_votes(test_database_connection):
+    conn = test_database_connection
+    first = add_story(conn, "First", "example.com")
+    second = add_story(conn, "Second", "example.org")
+
+    create_new_votes_record(conn, first, "up", "alice")
+    create_new_votes_record(conn, first, "up", "alice")
+    create_new_votes_record(conn, first, "down", "alice")
+    create_new_votes_record(conn, second, "up", "bob")
+
+    # The changed vote takes its up back, so changes match the scores
+    assert fetch(conn, "SELECT story_id, upvotes, downvotes FROM vote_buckets "
+                       "ORDER BY story_id") == [(first, 0, 1), (second, 1, 0)]
+    activity = load_vote_activity(conn, "hour", 3)
+    assert [(row["upvotes"], row["downvotes"]) for row in activity] == [(0, 0), (0, 0), (1, 1)]
+    movers = load_top_movers(conn, hours=1, limit=5)
+    assert [(row["id"], row["change"], row["score"]) for row in movers] == [
+        (second, 1, 1), (first, -1, -1)]
+
+
+def test_compaction_and_rebuild_keep_the_totals(test_database_connection):
+    conn = test_database_connection
+    story = add_story(conn, "Old", "example.com")
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO votes (direction, created_at, updated_at, story_id)
+                    SELECT 'up', ts, ts, %s
+                    FROM generate_series(LOCALTIMESTAMP - INTERVAL '10 days',
+                                         LOCALTIMESTAMP - INTERVAL '9 days',
+                                         INTERVAL '1 hour') AS ts""", (story, ))
+    conn.commit()
+    hourly = fetch(conn, "SELECT COUNT(*), SUM(upvotes) FROM vote_buckets")[0]
+
+    report = compact_vote_buckets(conn, keep_hours=48)
+
+    assert report["compacted"] == hourly[0]
+    assert fetch(conn, "SELECT granularity, SUM(upvotes) FROM vote_buckets "
+                       "GROUP BY granularity") == [("day", hourly[1])]
+    assert sum(row["upvotes"] for row in load_vote_activity(conn, "day", 30)) == hourly[1]
+
+    rebuild_stats(conn)
+
+    assert fetch(conn, "SELECT SUM(upvotes) FROM vote_buckets") == [(hourly[1], )]
+    assert fetch(conn, "SELECT domain, stories FROM domain_stats") == [("example.com", 1)]
+
+
+def test_compaction_expires_old_daily_buckets(test_database_connection):
+    conn = test_database_connection
+    story = add_story(conn, "Old", "example.com")
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO votes (direction, created_at, updated_at, story_id)
+                    VALUES ('up', LOCALTIMESTAMP - INTERVAL '10 days',
+                            LOCALTIMESTAMP - INTERVAL '10 days', %s),
+                    ('up', LOCALTIMESTAMP - INTERVAL '3 days', LOCALTIMESTAMP - INTERVAL '3 days', %s)
+                    """, (story, story))
+    conn.commit()
+
+    report = compact_vote_buckets(conn, keep_hours=48, keep_days=7)
+
+    assert (report["compacted"], report["daily"], report["expired"]) == (2, 2, 0)
+    # Days compacted by a run are expired by the next one
+    assert compact_vote_buckets(conn, keep_hours=48, keep_days=7)["expired"] == 1
+    assert fetch(conn, "SELECT granularity, SUM(upvotes) FROM vote_buckets GROUP BY 1") == [("day", 1)]
+
+
+def test_hourly_activity_is_served_only_within_the_retention(test_database_connection):
+    conn = test_database_connection
+    story = add_story(conn, "Old", "example.com")
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO votes (direction, created_at, updated_at, story_id)
+                    VALUES ('up', LOCALTIMESTAMP - INTERVAL '47 hours',
+                            LOCALTIMESTAMP - INTERVAL '47 hours', %s)""", (story, ))
+    conn.commit()
+
+    compact_vote_buckets(conn, keep_hours=HOURLY_RETENTION)
+
+    activity = load_vote_activity(conn, "hour", MAX_PERIODS["hour"])
+    assert sum(row["upvotes"] for row in activity) == 1
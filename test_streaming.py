@@ -0,0 +1,82 @@
+"""Tests for streaming query results as JSON"""
+import json
+from datetime import datetime
+
+from unittest.mock import MagicMock
+
+from streaming import encode_json_array, encode_ndjson, stream_query
+
+
+def cursor_over(conn, columns, rows):
+    cur = conn.cursor.return_value
+    cur.__iter__.return_value = iter(rows)
+    cur.description = [MagicMock() for _ in columns]
+    for column, name in zip(cur.description, columns):
+        column.name = name
+    return cur
+
+
+def test_stream_query_reads_rows_through_named_cursor():
+    conn = MagicMock()
+    cur = cursor_over(conn, ["id", "title"], [(1, "HI"), (2, "BYE")])
+
+    rows = stream_query(conn, "SELECT id, title FROM stories", itersize=50, name="listing")
+
+    conn.cursor.assert_not_called()
+    assert list(rows) == [{"id": 1, "title": "HI"}, {"id": 2, "title": "BYE"}]
+    conn.cursor.assert_called_once_with(name="listing")
+    assert cur.itersize == 50
+    cur.close.assert_called_once()
+    conn.commit.assert_called_once()
+
+
+def test_stream_query_yields_column_names_then_arrays():
+    conn = MagicMock()
+    cursor_over(conn, ["id", "title"], [(1, "HI"), (2, "BYE")])
+
+    rows = stream_query(conn, "SELECT id, title FROM stories", arrays=True)
+
+    assert list(rows) == [["id", "title"], (1, "HI"), (2, "BYE")]
+
+
+def test_empty_stream_still_names_its_columns():
+    conn = MagicMock()
+    cursor_over(conn, ["id"], [])
+
+    assert list(stream_query(conn, "SELECT id FROM stories", arrays=True)) == [["id"]]
+    assert list(stream_query(conn, "SELECT id FROM stories")) == []
+
+
+def test_abandoned_stream_closes_its_cursor():
+    conn = MagicMock()
+    cur = cursor_over(conn, ["id"], [(1,), (2,)])
+
+    rows = stream_query(conn, "SELECT id FROM stories")
+    next(rows)
+    rows.close()
+
+    cur.close.assert_called_once()
+
+
+def test_ndjson_is_encoded_in_chunks_with_iso_timestamps():
+    rows = [{"id": id, "created_at": datetime(2022, 6, 24, 17, 25, 16)} for id in range(3)]
+
+    chunks = list(encode_ndjson(iter(rows), chunk_rows=2))
+
+    assert len(chunks) == 2
+    lines = b"".join(chunks).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": id, "created_at": "2022-06-24T17:25:16"} for id in range(3)]
+
+
+def test_json_array_is_encoded_in_chunks():
+    rows = [{"id": id} for id in range(5)]
+
+    chunks = list(encode_json_array(iter(rows), chunk_rows=2))
+
+    assert json.loads(b"".join(chunks)) == rows
+    assert len(chunks) == 5
+
+
+def test_empty_json_array():
+    assert b"".join(encode_json_array(iter([]))) == b"[]"
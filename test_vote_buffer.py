@@ -0,0 +1,113 @@
+"""Tests for the write-behind vote buffer"""
+import threading
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from vote_buffer import VoteBuffer
+
+
+def test_votes_are_coalesced_per_voter_and_story():
+    write = MagicMock()
+    buffer = VoteBuffer(write)
+
+    buffer.submit("alice", 1, "up")
+    buffer.submit("bob", 1, "up")
+    buffer.submit("alice", 1, "down")
+    buffer.submit("alice", 2, "down")
+
+    assert buffer.flush() == 3
+    write.assert_called_once_with({("alice", 1): "down", ("bob", 1): "up", ("alice", 2): "down"})
+
+
+def test_flush_with_nothing_pending_does_not_write():
+    write = MagicMock()
+
+    assert VoteBuffer(write).flush() == 0
+    write.assert_not_called()
+
+
+def test_full_buffer_rejects_new_votes_but_accepts_changed_ones():
+    buffer = VoteBuffer(MagicMock(), max_pending=2)
+
+    assert buffer.submit("alice", 1, "up")
+    assert buffer.submit("bob", 1, "up")
+    assert not buffer.submit("carol", 1, "up")
+    assert buffer.submit("alice", 1, "down")
+    assert buffer.stats()["rejected"] == 1
+    assert buffer.stats()["pending"] == 2
+
+
+def test_failed_flush_requeues_votes():
+    write = MagicMock(side_effect=[RuntimeError, None])
+    buffer = VoteBuffer(write)
+    buffer.submit("alice", 1, "up")
+    buffer.submit("bob", 1, "up")
+
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+    buffer.submit("alice", 1, "down")
+
+    assert buffer.flush() == 2
+    write.assert_called_with({("alice", 1): "down", ("bob", 1): "up"})
+
+
+def test_requeue_stays_within_max_pending():
+    batches = []
+
+    def write(batch):
+        batches.append(dict(batch))
+        if len(batches) == 1:
+            buffer.submit("carol", 1, "up")
+            raise RuntimeError
+
+    buffer = VoteBuffer(write, max_pending=2)
+    buffer.submit("alice", 1, "up")
+    buffer.submit("bob", 1, "up")
+
+    with pytest.raises(RuntimeError):
+        buffer.flush()
+
+    assert buffer.stats()["pending"] == 2
+    assert buffer.stats()["dropped"] == 1
+    assert buffer.flush() == 2
+    assert ("carol", 1) in batches[-1]
+
+
+def test_votes_are_dropped_after_max_attempts():
+    write = MagicMock(side_effect=RuntimeError)
+    buffer = VoteBuffer(write, max_attempts=2)
+    buffer.submit("alice", 1, "up")
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            buffer.flush()
+
+    assert buffer.stats()["pending"] == 0
+    assert buffer.stats()["dropped"] == 1
+    assert buffer.flush() == 0
+
+
+def test_flusher_writes_once_flush_size_is_reached():
+    written = threading.Event()
+    buffer = VoteBuffer(lambda tallies: written.set(), flush_interval=60, flush_size=2)
+    buffer.start()
+
+    buffer.submit("alice", 1, "up")
+    buffer.submit("alice", 2, "up")
+
+    assert written.wait(2)
+    buffer.close()
+
+
+def test_close_flushes_pending_votes_and_refuses_new_ones():
+    write = MagicMock()
+    buffer = VoteBuffer(write, flush_interval=60)
+    buffer.start()
+    buffer.submit("alice", 3, "down")
+
+    buffer.close()
+
+    write.assert_called_once_with({("alice", 3): "down"})
+    assert not buffer.submit("alice", 3, "down")
@@ -0,0 +1,158 @@
+"""
+Module Name: vote_buffer.py
+
+Description:
+A write-behind buffer for votes. Instead of writing every vote to the
+database as it arrives, votes are held in memory and flushed together,
+either every `flush_interval` seconds or as soon as `flush_size` votes
+are waiting, whichever comes first. Each voter has one vote per story,
+so a voter's later vote on a story replaces their pending one.
+
+The buffer holds at most `max_pending` votes; once full, `submit`
+refuses new votes so the API can answer with backpressure (429) rather
+than queueing without bound. Votes of a failed flush are requeued,
+within the same bound, and dropped after `max_attempts` failed flushes
+so a batch the database keeps rejecting is not retried forever. `close`
+stops the background flusher and writes out whatever is still pending,
+so votes survive a clean shutdown.
+"""
+
+
+import logging
+import threading
+from typing import Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+class VoteBuffer:
+    """Coalesces votes per voter and story and hands them to `write` in batches"""
+
+    def __init__(self, write: Callable[[dict[tuple[str, int], str]], None],
+                 max_pending: int = 10000,
+                 flush_interval: float = 0.5, flush_size: int = 500,
+                 max_attempts: int = 5) -> None:
+        self._write = write
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # (voter_id, story_id) -> direction
+        self._attempts = {}  # (voter_id, story_id) -> failed flushes of its pending vote
+        self._thread = None
+        self._stopping = False
+
+        self._accepted = 0
+        self._rejected = 0
+        self._flushes = 0
+        self._flush_failures = 0
+        self._dropped = 0
+
+    def start(self) -> None:
+        """Starts the background flusher"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="vote-buffer", daemon=True)
+                self._thread.start()
+
+    def submit(self, voter_id: str, story_id: int, direction: str) -> bool:
+        """Queues a voter's vote on a story, returning False if the buffer is full"""
+        key = (voter_id, story_id)
+        with self._cond:
+            if self._stopping or (key not in self._pending
+                                  and len(self._pending) >= self.max_pending):
+                self._rejected += 1
+                return False
+
+            self._pending[key] = direction
+            self._attempts.pop(key, None)
+            self._accepted += 1
+
+            if len(self._pending) >= self.flush_size:
+                self._cond.notify()
+        return True
+
+    def flush(self) -> int:
+        """Writes every pending vote, returning how many were written"""
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+
+            if not batch:
+                return 0
+
+            try:
+                self._write(batch)
+            except Exception:
+                logger.exception("Failed to flush %s votes, requeueing them", len(batch))
+                with self._cond:
+                    self._flush_failures += 1
+                    self._requeue(batch)
+                raise
+
+            with self._cond:
+                self._flushes += 1
+                for key in batch:
+                    self._attempts.pop(key, None)
+            return len(batch)
+
+    def _requeue(self, batch: dict[tuple[str, int], str]) -> None:
+        """
+        Puts the votes of a failed flush back in front of those submitted
+        since, which are newer and so win. Votes that have failed
+        `max_attempts` times, or no longer fit in the buffer, are dropped
+        """
+        requeued = {}
+        room = self.max_pending - len(self._pending)
+        for key, direction in batch.items():
+            if key in self._pending:
+                continue
+            attempts = self._attempts.pop(key, 0) + 1
+            if attempts < self.max_attempts and len(requeued) < room:
+                requeued[key] = direction
+                self._attempts[key] = attempts
+
+        dropped = len(batch) - len(requeued) - sum(key in self._pending for key in batch)
+        if dropped:
+            self._dropped += dropped
+            logger.error("Dropped %s votes that could not be flushed", dropped)
+        self._pending = {**requeued, **self._pending}
+
+    def close(self) -> None:
+        """Stops accepting votes, stops the flusher and flushes what is left"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self) -> dict[str, int]:
+        """Returns a snapshot of the buffer metrics"""
+        with self._cond:
+            return {
+                "pending": len(self._pending),
+                "max_pending": self.max_pending,
+                "accepted": self._accepted,
+                "rejected": self._rejected,
+                "flushes": self._flushes,
+                "flush_failures": self._flush_failures,
+                "dropped": self._dropped
+            }
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._pending) < self.flush_size:
+                    self._cond.wait(self.flush_interval)
+                if self._stopping:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                pass  # Already logged; the votes are requeued for the next flush